@@ -0,0 +1,135 @@
+# answer_cache.py: Reuses grader results for answers that say the same thing in the same words.
+#
+# Students in a class often type the same sentence with different case,
+# punctuation or a filler word. Each graded answer is stored under
+# (concept, ground truth, difficulty) and its words after normalize(),
+# without FILLER_WORDS, and a later answer with exactly those words reuses
+# the grade. Fuzzier matching is not safe: "is not" and "is" share almost
+# all their characters but have opposite meanings. Entries are kept in
+# memory per worker, up to config.ANSWER_CACHE_SIZE, least recently used
+# first out. Off by default: a reused result includes the feedback written
+# for the first student.
+
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
+import config
+import metrics
+from pregrader import normalize
+
+# Words two answers may differ by and still share a grade. Nothing that can
+# change what an answer says (negations, quantifiers, content words) or how
+# sure the student sounds ("I think", "um": the grader reports uncertainty).
+FILLER_WORDS = frozenset({"a", "an", "the", "basically", "so", "well"})
+
+metrics.describe('tutor_answer_cache_lookups_total', "Grader result lookups in the answer cache, by result.")
+
+
+def answer_words(answer):
+    """The answer's words after normalize(), without FILLER_WORDS."""
+    return tuple(word for word in normalize(answer or "").split() if word not in FILLER_WORDS)
+
+
+class AnswerCache:
+    """Size-bounded LRU of graded answers keyed by (concept, ground truth, difficulty, answer words)."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()   # key -> evaluation, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(concept, ground_truth, difficulty, words):
+        # The ground truth is part of the key so editing a lesson invalidates its entries
+        truth_digest = hashlib.sha256(ground_truth.encode('utf-8')).hexdigest()[:16]
+        return (concept.lower(), truth_digest, difficulty, words)
+
+    def lookup(self, concept, ground_truth, answer, difficulty):
+        """Returns a copy of the evaluation of a cached answer with the same words, or None."""
+        words = answer_words(answer)
+        if not words:
+            return None
+        key = self.make_key(concept, ground_truth, difficulty, words)
+
+        with self._lock:
+            evaluation = self._entries.get(key)
+            if evaluation is None:
+                self.misses += 1
+                metrics.inc('tutor_answer_cache_lookups_total', result='miss')
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.inc('tutor_answer_cache_lookups_total', result='hit')
+            evaluation = copy.deepcopy(evaluation)
+
+        evaluation["graded_from_cache"] = True
+        return evaluation
+
+    def store(self, concept, ground_truth, answer, difficulty, evaluation):
+        """Remembers an evaluation for answers with these words."""
+        words = answer_words(answer)
+        if not words:
+            return
+        key = self.make_key(concept, ground_truth, difficulty, words)
+
+        with self._lock:
+            self._entries[key] = copy.deepcopy(evaluation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """Returns hit/miss counters and size for this worker."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "evictions": self.evictions,
+            }
+
+
+# --- Shared Instance ---
+_cache = AnswerCache(config.ANSWER_CACHE_SIZE) if config.ANSWER_CACHE_ENABLED else None
+
+if _cache is not None:
+    metrics.register_gauge('tutor_answer_cache_entries', lambda: len(_cache), "Graded answers held by the answer cache.")
+
+
+def get_answer_cache():
+    """Returns the shared cache, or None when it is disabled."""
+    return _cache
+
+
+def is_reusable(evaluation):
+    """Only real grader results are worth reusing: not local, fallback or follow-up-specific ones."""
+    follow_up = evaluation.get("follow_up_question", "None")
+    return (
+        "scores" in evaluation
+        and not evaluation.get("graded_locally")
+        and not evaluation.get("grading_failed")
+        and (not follow_up or follow_up.lower() == "none")
+    )
+
+
+def lookup(concept, ground_truth, answer, difficulty):
+    """Returns a cached evaluation for an answer with the same words, or None."""
+    if _cache is None:
+        return None
+    return _cache.lookup(concept, ground_truth, answer, difficulty)
+
+
+def store(concept, ground_truth, answer, difficulty, evaluation):
+    """Caches a grader result if it can be reused for other students."""
+    if _cache is not None and is_reusable(evaluation):
+        _cache.store(concept, ground_truth, answer, difficulty, evaluation)
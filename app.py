@@ -1,16 +1,24 @@
 # app.py: Main Flask application for the AI Tutor
 
-from flask import Flask, request, jsonify, send_from_directory, render_template
+from flask import Flask, Response, g, request, jsonify, send_from_directory, render_template, stream_with_context
 from flask_cors import CORS
 import os
+import json
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 import config
+import metrics
+import prefetch
 
 # Import all necessary functions
 from data_logger import setup_local_csv_logging, get_log_payload, log_to_csv, LOGGING_DISABLED
-from knowledge_base import load_kb, get_concept_list, get_ground_truth, get_random_question
-from tutor import generate_remediation, generate_fallout_message, answer_follow_up, generate_hint
+from knowledge_base import load_kb, get_lesson, get_lesson_ids, get_concept_list, get_ground_truth
+from tutor import generate_remediation, generate_fallout_message, answer_follow_up, generate_hint, stream_remediation, stream_follow_up
 from evaluator import evaluate_answer
+from session_store import QuizSession, create_session_store
+from batch_grader import find_invalid_item, grade_batch, format_rows
+from log_analytics import get_stats
 
 # Initialize Flask App
 app = Flask(__name__, static_folder='static', template_folder='templates')
@@ -20,39 +28,150 @@ CORS(app)
 app.config['API_KEY'] = os.environ.get('GEMINI_API_KEY', config.API_KEY)
 
 # --- Session Management ---
-user_sessions = {}
+# Backend (memory, sqlite or redis) is chosen in settings.ini [Sessions].
+user_sessions = create_session_store()
+
+# --- Concurrent LLM Calls ---
+# Shared pool for the follow-up, remediation and hint calls in /api/ask.
+_llm_executor = ThreadPoolExecutor(max_workers=config.LLM_FANOUT_WORKERS, thread_name_prefix='llm')
 
 # --- Run setup functions ---
 setup_local_csv_logging()
 load_kb()
 
+# --- Instrumentation ---
+metrics.register_gauge('tutor_active_sessions', lambda: len(user_sessions), "Quiz sessions currently held by the session store.")
+
+@app.before_request
+def start_request_trace():
+    """Collects timing spans for this request (and starts the profiler if enabled)."""
+    metrics.maybe_start_profiler()
+    g.trace_token = metrics.start_trace()
+
+@app.after_request
+def add_server_timing(response):
+    """Reports the request's spans in a Server-Timing header."""
+    token = g.pop('trace_token', None)
+    if token is not None:
+        trace = metrics.end_trace(token)
+        if trace:
+            response.headers['Server-Timing'] = metrics.server_timing_header(trace)
+    return response
+
+def clean_hint(hint):
+    """Cleans up the hint text (removes quotes if the AI added them)."""
+    return hint.replace('"', '').replace("'", "")
+
+@prefetch.prefetchable
+def fetch_hint(concept):
+    """Generates a cleaned-up Easy Mode hint, or returns None if generation fails."""
+    try:
+        # Generate a hint on the fly!
+        return clean_hint(generate_hint(concept))
+    except Exception as e:
+        # If hint generation fails for any reason, just show the question
+        print(f"Hint generation failed: {e}")
+        return None
+
+def format_question(concept, hint=None):
+    """Formats a question, attaching the hint if one is given."""
+    question_text = f"**{concept}**"
+    if hint:
+        question_text += f"\n\n*💡 Hint: {hint}*"
+    return question_text
+
+@metrics.timed('prepare_question_response')
 def prepare_question_response(concept, ground_truth):
     """Helper to attach a hint if Easy Mode is on."""
-    question_text = f"**{concept}**"
-    
     # Check Difficulty from Config
-    if config.GRADER_DIFFICULTY == 'Easy':
-        try:
-            # Generate a hint on the fly!
-            hint = generate_hint(concept)
-            # Clean up the hint text (remove quotes if the AI added them)
-            hint = hint.replace('"', '').replace("'", "")
-            question_text += f"\n\n*💡 Hint: {hint}*"
-        except Exception as e:
-            # If hint generation fails for any reason, just show the question
-            print(f"Hint generation failed: {e}")
-            pass
-        
-    return question_text
+    hint = fetch_hint(concept) if config.GRADER_DIFFICULTY == 'Easy' else None
+    return format_question(concept, hint)
+
+def schedule_prefetch(session_id, session_data):
+    """
+    Starts the LLM calls the session's next answer will likely need: the
+    next question's hint (Easy mode) and remediation for the current one.
+    """
+    jobs = []
+    if has_active_question(session_data):
+        if config.PREFETCH_REMEDIATION:
+            jobs.append((generate_remediation, (session_data.concept, session_data.ground_truth)))
+        if config.GRADER_DIFFICULTY == 'Easy':
+            next_concept = session_data.next_question()[0]
+            if next_concept:
+                jobs.append((fetch_hint, (next_concept,)))
+    prefetch.schedule(session_id, jobs)
+
+def run_concurrently(tasks):
+    """
+    Runs independent LLM calls in parallel and joins them under one deadline.
+
+    Args:
+        tasks (dict): Maps a result name to a (function, args) tuple.
+
+    Returns a dict of the same names. A call that raised or missed the
+    deadline maps to None so the caller can fall back to a default.
+    """
+    futures = {name: _llm_executor.submit(metrics.bind_trace(func), *args) for name, (func, args) in tasks.items()}
+    done, _ = wait(futures.values(), timeout=config.LLM_FANOUT_DEADLINE)
+
+    results = {}
+    for name, future in futures.items():
+        if future in done and future.exception() is None:
+            results[name] = future.result()
+        else:
+            if future in done:
+                print(f"Concurrent LLM call '{name}' failed: {future.exception()}")
+            else:
+                print(f"Concurrent LLM call '{name}' missed the {config.LLM_FANOUT_DEADLINE}s deadline.")
+                future.cancel()
+            results[name] = None
+    return results
 
 # --- API Routes ---
 
+@app.route('/api/lessons', methods=['GET'])
+def get_lessons():
+    """Lists the lesson ids that can be passed to /api/start and /api/concepts."""
+    return jsonify(get_lesson_ids())
+
 @app.route('/api/concepts', methods=['GET'])
 def get_concepts():
-    """Serves the list of concepts for the frontend."""
-    concepts = get_concept_list()
+    """Serves the list of concepts for the frontend (optionally ?lesson_id=...)."""
+    lesson_id = request.args.get('lesson_id')
+    if get_lesson(lesson_id) is None:
+        return jsonify({"error": f"Unknown lesson: {lesson_id}"}), 404
+    concepts = get_concept_list(lesson_id)
     return jsonify(concepts)
 
+def new_session(lesson_id):
+    """
+    Creates the state for a new quiz session and pops its first question.
+
+    Returns (session_data, concept, ground_truth); concept is None if the
+    lesson has no questions.
+    """
+    # Initialize session state
+    session_data = QuizSession.new(lesson_id)
+
+    # Get the first question
+    concept, ground_truth, index = session_data.next_question()
+
+    if concept:
+        session_data.ask(index, concept)
+    return session_data, concept, ground_truth
+
+def start_payload(question_text):
+    """The /api/start response for a session's first question."""
+    return {
+        "evaluation_text": "Let's get started!",
+        "remediation_text": "Here is your first question:",
+        "sme_answer": "",
+        "next_question": question_text
+    }
+
+EMPTY_LESSON_ERROR = ({"error": "Knowledge base is empty. Cannot start quiz."}, 500)
+
 @app.route('/api/start', methods=['POST'])
 def start_quiz():
     """Starts a new quiz session for a user."""
@@ -60,36 +179,198 @@ def start_quiz():
     session_id = data.get('session_id')
     if not session_id:
         return jsonify({"error": "Missing session_id."}), 400
+
+    # Optional: which lesson to quiz on (defaults to settings.ini lesson_file)
+    lesson_id = data.get('lesson_id')
+    if get_lesson(lesson_id) is None:
+        return jsonify({"error": f"Unknown lesson: {lesson_id}"}), 404
+
+    session_data, concept, ground_truth = new_session(lesson_id)
+    if concept:
+        user_sessions.save(session_id, session_data)
+        schedule_prefetch(session_id, session_data)
+        return jsonify(start_payload(prepare_question_response(concept, ground_truth)))
+    else:
+        return jsonify(EMPTY_LESSON_ERROR[0]), EMPTY_LESSON_ERROR[1]
+
+
+# --- /api/ask Turn Handling ---
+# An answer is handled in three steps shared by the JSON and streaming
+# endpoints: grade_turn() evaluates it and decides what happens next,
+# plan_llm_calls() lists the independent LLM calls that decision needs, and
+# finish_turn() applies their results to the session and builds the response.
+# asgi_app.py reuses the parts that do no I/O (build_turn, plan_llm_calls,
+# apply_turn) around its own async calls.
+
+NO_ACTIVE_QUESTION_ERROR = ({"error": "Invalid session or no question is active. Please start the quiz."}, 400)
+QUESTION_REMOVED_ERROR = ({"error": "The lesson was updated and your question is no longer in it. Please start the quiz again."}, 409)
+
+def has_active_question(session_data):
+    return session_data is not None and session_data.concept is not None
+
+def no_question_error(session_data):
+    """The error for an answer sent while the session has no current question."""
+    if session_data is not None and session_data.question_removed:
+        return QUESTION_REMOVED_ERROR
+    return NO_ACTIVE_QUESTION_ERROR
+
+def grade_turn(session_id, user_answer):
+    """
+    Evaluates an answer against the session's current question.
+
+    Returns (turn, None) on success, or (None, (error_dict, status)) if the
+    request cannot be handled.
+    """
+    # --- 1. GET CURRENT SESSION STATE ---
+    session_data = user_sessions.get(session_id)
+    concept, ground_truth = session_data.question() if session_data is not None else (None, None)
+    if concept is None:
+        return None, no_question_error(session_data)
+
+    # --- 2. EVALUATE THE ANSWER ---
+    evaluation_data = evaluate_answer(
+        concept=concept,
+        ground_truth=ground_truth,
+        user_answer=user_answer, 
+        difficulty=config.GRADER_DIFFICULTY
+    )
+    return build_turn(session_id, session_data, user_answer, evaluation_data)
+
+def build_turn(session_id, session_data, user_answer, evaluation_data):
+    """Turns an evaluation into the turn dict (or an error), deciding what happens next."""
+    current_concept, current_ground_truth = session_data.question()
+    if current_concept is None:
+        # The lesson was reloaded without this question while it was graded
+        return None, no_question_error(session_data)
+    time_taken = round(time.time() - session_data.started, 2)
     
-    # Initialize session state
-    user_sessions[session_id] = {
-        'asked_indices': [],
-        'current_concept': None,
-        'current_ground_truth': None,
-        'attempts_on_current': 0,
-        'start_time_on_current': None
+    # --- 3. PARSE EVALUATION & HANDLE ERRORS ---
+    if 'error' in evaluation_data:
+        # If it's a critical API error (not just a glitch), return it
+        if "API Key is missing" in evaluation_data['error']:
+             return None, ({"error": "Error during evaluation.", "details": evaluation_data.get('error')}, 500)
+        # Otherwise, proceed with safe defaults if keys are missing
+        
+    scores = evaluation_data.get("scores", {})
+    final_score = scores.get("final", 0)
+
+    # --- 4. DECIDE WHAT HAPPENS NEXT ---
+    time_exceeded = time_taken > config.MAX_TIME_ON_QUESTION
+    attempts_exceeded = session_data.attempts >= config.MAX_ATTEMPTS
+    passed = final_score >= config.REMEDIATION_THRESHOLD
+    fallout_triggered = not passed and (time_exceeded or attempts_exceeded)
+    retry = not passed and not fallout_triggered
+
+    # The next question only depends on the evaluation, so pick it now
+    # and let its hint be generated alongside the other LLM calls.
+    next_question = (None, None, -1)
+    if not retry:
+        next_question = session_data.next_question()
+
+    turn = {
+        "session_id": session_id,
+        "session_data": session_data,
+        "user_answer": user_answer,
+        "concept": current_concept,
+        "ground_truth": current_ground_truth,
+        "scores": scores,
+        "signals": evaluation_data.get("signals", {}),
+        "evaluation_text": evaluation_data.get("evaluation_text", "I received your answer."),
+        "follow_up_question": evaluation_data.get("follow_up_question", "None"),
+        "time_taken": time_taken,
+        "time_exceeded": time_exceeded,
+        "attempts_exceeded": attempts_exceeded,
+        "passed": passed,
+        "fallout_triggered": fallout_triggered,
+        "retry": retry,
+        "next_question": next_question,
     }
-    
-    # Get the first question
-    concept, ground_truth, index = get_random_question(user_sessions[session_id]['asked_indices'])
+    return turn, None
 
-    if concept:
-        user_sessions[session_id]['asked_indices'].append(index)
-        user_sessions[session_id]['current_concept'] = concept
-        user_sessions[session_id]['current_ground_truth'] = ground_truth
-        user_sessions[session_id]['attempts_on_current'] = 1
-        user_sessions[session_id]['start_time_on_current'] = time.time()
+def plan_llm_calls(turn):
+    """Lists the LLM calls a turn needs as {name: (function, args)}; they are independent."""
+    tasks = {}
+    follow_up_question = turn["follow_up_question"]
+    next_concept = turn["next_question"][0]
+    easy_mode = config.GRADER_DIFFICULTY == 'Easy'
+
+    # The fallout reference answer replaces the SME answer, so skip the call then.
+    if follow_up_question and follow_up_question.lower() != 'none' and not turn["fallout_triggered"]:
+        tasks["sme_answer"] = (answer_follow_up, (turn["concept"], follow_up_question))
+    if turn["retry"]:
+        tasks["remediation_text"] = (generate_remediation, (turn["concept"], turn["ground_truth"]))
+        if easy_mode:
+            tasks["hint"] = (fetch_hint, (turn["concept"],))
+    elif next_concept and easy_mode:
+        tasks["hint"] = (fetch_hint, (next_concept,))
+    return tasks
+
+def finish_turn(turn, tasks, results):
+    """Applies the LLM results, logs the attempt, saves the session, and returns the response payload."""
+    response_payload = apply_turn(turn, tasks, results)
+
+    # --- 7. LOG THE ATTEMPT ---
+    if not LOGGING_DISABLED:
+        log_to_csv(turn_log_payload(turn))
+
+    user_sessions.save(turn["session_id"], turn["session_data"])
+    schedule_prefetch(turn["session_id"], turn["session_data"])
+    return response_payload
+
+def turn_log_payload(turn):
+    return get_log_payload(turn["session_id"], turn["concept"], turn["user_answer"], turn["scores"], turn["signals"], turn["time_taken"], turn["evaluation_text"], turn["fallout_triggered"])
+
+def apply_turn(turn, tasks, results):
+    """Applies the LLM results to the session and returns the response payload."""
+    session_data = turn["session_data"]
+    current_concept = turn["concept"]
+    current_ground_truth = turn["ground_truth"]
+
+    response_payload = {
+        "evaluation_text": turn["evaluation_text"],
+        "remediation_text": "",
+        "sme_answer": "",
+        "next_question": "",
+        "scores": turn["scores"]
+    }
+
+    if "sme_answer" in tasks:
+        response_payload["sme_answer"] = results.get("sme_answer") or "Sorry, I couldn't answer your follow-up question right now."
+
+    # --- 6. FALLOUT & REMEDIATION LOGIC ---
+    if turn["fallout_triggered"]:
+        response_payload["remediation_text"] = generate_fallout_message(current_concept, turn["time_exceeded"], turn["attempts_exceeded"])
+        response_payload["sme_answer"] = f"For reference, the key idea for **{current_concept}** was: *{current_ground_truth}*"
+
+    elif turn["retry"]:
+        session_data.attempts += 1
+        response_payload["remediation_text"] = results.get("remediation_text") or f"Let's look at **{current_concept}** again."
         
-        response = {
-            "evaluation_text": "Let's get started!",
-            "remediation_text": "Here is your first question:",
-            "sme_answer": "",
-            "next_question": prepare_question_response(concept, ground_truth) # Use new helper
-        }
-        return jsonify(response)
+        # Instead of just the topic name, we add a friendly bridge.
+        # The hint (if any) was generated concurrently with the remediation.
+        base_question = format_question(current_concept, results.get("hint"))
+        
+        response_payload["next_question"] = f"**Let's give it another shot!**\n\nBased on the explanation above, how would you describe: {base_question}"
+
+    elif response_payload["sme_answer"]:
+        response_payload["remediation_text"] = "Great job! I've answered your follow-up question below."
     else:
-        return jsonify({"error": "Knowledge base is empty. Cannot start quiz."}), 500
+        response_payload["remediation_text"] = "Well done!"
+    
+    if turn["retry"]:
+        return response_payload
 
+    # --- 8. MOVE TO THE NEXT QUESTION ---
+    concept, ground_truth, index = turn["next_question"]
+    if concept:
+        session_data.ask(index, concept)
+
+        response_payload['next_question'] = f"Here is your next question: {format_question(concept, results.get('hint'))}"
+    else:
+        response_payload['next_question'] = "You've completed all the questions! Great job!"
+        session_data.finish()
+    
+    return response_payload
 
 @app.route('/api/ask', methods=['POST'])
 def ask():
@@ -102,108 +383,15 @@ def ask():
         if not session_id or not user_answer:
             return jsonify({"error": "Missing session_id or answer."}), 400
 
-        # --- 1. GET CURRENT SESSION STATE ---
-        session_data = user_sessions.get(session_id)
-        if not session_data or not session_data.get('current_concept'):
-            return jsonify({"error": "Invalid session or no question is active. Please start the quiz."}), 400
+        turn, error = grade_turn(session_id, user_answer)
+        if error:
+            return jsonify(error[0]), error[1]
 
-        current_concept = session_data['current_concept']
-        current_ground_truth = session_data['current_ground_truth']
-        
-        # --- 2. EVALUATE THE ANSWER ---
-        start_time = session_data.get('start_time_on_current', time.time())
-        
-        evaluation_data = evaluate_answer(
-            concept=current_concept,
-            ground_truth=current_ground_truth,
-            user_answer=user_answer, 
-            difficulty=config.GRADER_DIFFICULTY
-        )
-        
-        time_taken = round(time.time() - start_time, 2)
-        
-        # --- 3. PARSE EVALUATION & HANDLE ERRORS ---
-        if 'error' in evaluation_data:
-            # If it's a critical API error (not just a glitch), return it
-            if "API Key is missing" in evaluation_data['error']:
-                 return jsonify({"error": "Error during evaluation.", "details": evaluation_data.get('error')}), 500
-            # Otherwise, proceed with safe defaults if keys are missing
-            
-        scores = evaluation_data.get("scores", {})
-        signals = evaluation_data.get("signals", {})
-        evaluation_text = evaluation_data.get("evaluation_text", "I received your answer.")
-        follow_up_question = evaluation_data.get("follow_up_question", "None")
-
-        final_score = scores.get("final", 0)
-        
-        response_payload = {
-            "evaluation_text": evaluation_text,
-            "remediation_text": "",
-            "sme_answer": "",
-            "next_question": "",
-            "scores": scores 
-        }
-
-        # --- 4. HANDLE FOLLOW-UP QUESTION ---
-        if follow_up_question and follow_up_question.lower() != 'none':
-            response_payload["sme_answer"] = answer_follow_up(current_concept, follow_up_question)
-
-        # --- 5. FALLOUT & REMEDIATION LOGIC ---
-        time_exceeded = time_taken > config.MAX_TIME_ON_QUESTION
-        attempts_exceeded = session_data['attempts_on_current'] >= config.MAX_ATTEMPTS
-        passed = final_score >= config.REMEDIATION_THRESHOLD
-
-        fallout_triggered = False
-
-        if not passed and (time_exceeded or attempts_exceeded):
-            fallout_triggered = True
-            response_payload["remediation_text"] = generate_fallout_message(current_concept, time_exceeded, attempts_exceeded)
-            response_payload["sme_answer"] = f"For reference, the key idea for **{current_concept}** was: *{current_ground_truth}*"
-
-        elif not passed:
-            session_data['attempts_on_current'] += 1
-            response_payload["remediation_text"] = generate_remediation(current_concept, current_ground_truth)
-            
-            # Instead of just the topic name, we add a friendly bridge.
-            # We re-call the helper to ensure the hint is included if needed.
-            base_question = prepare_question_response(current_concept, current_ground_truth)
-            
-            response_payload["next_question"] = f"**Let's give it another shot!**\n\nBased on the explanation above, how would you describe: {base_question}"
-            
-            if not LOGGING_DISABLED:
-                log_payload = get_log_payload(session_id, current_concept, user_answer, scores, signals, time_taken, evaluation_text, fallout_triggered)
-                log_to_csv(log_payload)
-            
-            return jsonify(response_payload) 
-
-        elif passed:
-            if response_payload["sme_answer"]:
-                response_payload["remediation_text"] = "Great job! I've answered your follow-up question below."
-            else:
-                response_payload["remediation_text"] = "Well done!"
-        
-        # --- 6. LOG THE FINAL ATTEMPT ---
-        if not LOGGING_DISABLED:
-            log_payload = get_log_payload(session_id, current_concept, user_answer, scores, signals, time_taken, evaluation_text, fallout_triggered)
-            log_to_csv(log_payload)
+        # --- 5. FAN OUT THE INDEPENDENT LLM CALLS ---
+        tasks = plan_llm_calls(turn)
+        results = run_concurrently(tasks) if tasks else {}
 
-        # --- 7. GET NEXT QUESTION ---
-        concept, ground_truth, index = get_random_question(session_data['asked_indices'])
-        
-        if concept:
-            session_data['asked_indices'].append(index)
-            session_data['current_concept'] = concept
-            session_data['current_ground_truth'] = ground_truth
-            session_data['attempts_on_current'] = 1
-            session_data['start_time_on_current'] = time.time()
-            
-
-            response_payload['next_question'] = f"Here is your next question: {prepare_question_response(concept, ground_truth)}"
-        else:
-            response_payload['next_question'] = "You've completed all the questions! Great job!"
-            session_data['current_concept'] = None
-        
-        return jsonify(response_payload)
+        return jsonify(finish_turn(turn, tasks, results))
 
     except Exception as e:
         print(f"Error in /ask route: {e}")
@@ -211,6 +399,200 @@ def ask():
         traceback.print_exc()
         return jsonify({"error": "An internal server error occurred.", "details": str(e)}), 500
 
+# --- Streaming /api/ask ---
+
+# Streaming variants of the calls whose text is pushed to the browser as it arrives.
+STREAMED_CALLS = {
+    "remediation_text": stream_remediation,
+    "sme_answer": stream_follow_up,
+}
+
+def sse_event(event, data):
+    """Formats one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def _pump_stream(chunks, out_queue):
+    """Copies a text stream into a queue from a worker thread; None marks the end."""
+    try:
+        for chunk in chunks:
+            out_queue.put(chunk)
+    except Exception as e:
+        print(f"Streaming LLM call failed: {e}")
+    finally:
+        out_queue.put(None)
+
+@app.route('/api/ask_stream', methods=['POST'])
+def ask_stream():
+    """
+    Streaming version of /api/ask using server-sent events.
+
+    Events: 'evaluation' once grading is done, 'delta' for each chunk of
+    remediation_text / sme_answer, then 'done' with the same payload
+    /api/ask returns (or 'error').
+    """
+    data = request.json or {}
+    session_id = data.get('session_id')
+    user_answer = data.get('answer')
+
+    if not session_id or not user_answer:
+        return jsonify({"error": "Missing session_id or answer."}), 400
+
+    def generate():
+        try:
+            turn, error = grade_turn(session_id, user_answer)
+            if error:
+                yield sse_event('error', error[0])
+                return
+            yield sse_event('evaluation', {"evaluation_text": turn["evaluation_text"], "scores": turn["scores"]})
+
+            deadline = time.monotonic() + config.LLM_FANOUT_DEADLINE
+            tasks = plan_llm_calls(turn)
+
+            # Start every call at once: streamed ones fill a queue in the
+            # background while we forward the first one to the browser.
+            # Prefetched ones are already (nearly) done, so they are not streamed.
+            streams = {}
+            futures = {}
+            for name, (func, args) in tasks.items():
+                if name in STREAMED_CALLS and not prefetch.is_prefetched(func, args):
+                    streams[name] = queue.Queue()
+                    _llm_executor.submit(_pump_stream, STREAMED_CALLS[name](*args), streams[name])
+                else:
+                    futures[name] = _llm_executor.submit(metrics.bind_trace(func), *args)
+
+            results = {}
+            # Remediation is shown before the SME answer, matching /api/ask.
+            for name in ("remediation_text", "sme_answer"):
+                if name in futures:
+                    try:
+                        results[name] = futures.pop(name).result(timeout=max(0, deadline - time.monotonic()))
+                    except Exception as e:
+                        print(f"Concurrent LLM call '{name}' failed: {e}")
+                        results[name] = None
+                    if results[name]:
+                        yield sse_event('delta', {"field": name, "text": results[name]})
+                if name not in streams:
+                    continue
+                parts = []
+                while True:
+                    try:
+                        chunk = streams[name].get(timeout=max(0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        print(f"Streaming LLM call '{name}' missed the {config.LLM_FANOUT_DEADLINE}s deadline.")
+                        break
+                    if chunk is None:
+                        break
+                    parts.append(chunk)
+                    yield sse_event('delta', {"field": name, "text": chunk})
+                results[name] = "".join(parts)
+
+            for name, future in futures.items():
+                try:
+                    results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+                except Exception as e:
+                    print(f"Concurrent LLM call '{name}' failed: {e}")
+                    results[name] = None
+
+            yield sse_event('done', finish_turn(turn, tasks, results))
+
+        except Exception as e:
+            print(f"Error in /ask_stream route: {e}")
+            import traceback
+            traceback.print_exc()
+            yield sse_event('error', {"error": "An internal server error occurred.", "details": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# --- Batch Grading ---
+
+def parse_batch_request(data):
+    """Validates a /api/grade_batch body; returns (batch, None) or (None, (error_dict, status))."""
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return None, ({"error": "Missing items."}, 400)
+    if len(items) > config.BATCH_MAX_ITEMS:
+        return None, ({"error": f"Too many items (max {config.BATCH_MAX_ITEMS})."}, 400)
+    invalid = find_invalid_item(items)
+    if invalid is not None:
+        return None, ({"error": "Every item needs a concept and an answer (both text).", "item": invalid[0]}, 400)
+
+    lesson_id = data.get('lesson_id')
+    if get_lesson(lesson_id) is None:
+        return None, ({"error": f"Unknown lesson: {lesson_id}"}, 404)
+    difficulty = data.get('difficulty')
+    if difficulty not in (None, 'Easy', 'Normal', 'Strict'):
+        return None, ({"error": f"Unknown difficulty: {difficulty}"}, 400)
+
+    output_format = 'csv' if data.get('format') == 'csv' else 'jsonl'
+    return {
+        "items": items,
+        "lesson_id": lesson_id,
+        "difficulty": difficulty,
+        "format": output_format,
+        "mimetype": 'text/csv' if output_format == 'csv' else 'application/x-ndjson',
+    }, None
+
+@app.route('/api/grade_batch', methods=['POST'])
+def grade_batch_route():
+    """
+    Grades a whole class's answers in one request.
+
+    Body: {"items": [{"session_id", "concept", "answer"}, ...], "lesson_id",
+    "difficulty", "format": "jsonl" | "csv"}. Rows (tutor_log.csv columns)
+    are streamed back as each batch of answers is graded.
+    """
+    batch, error = parse_batch_request(request.json or {})
+    if error:
+        return jsonify(error[0]), error[1]
+
+    rows = grade_batch(batch["items"], difficulty=batch["difficulty"], lesson_id=batch["lesson_id"])
+    return Response(
+        stream_with_context(format_rows(rows, batch["format"])),
+        mimetype=batch["mimetype"]
+    )
+
+# --- Monitoring ---
+
+def stats_request(args):
+    """Reads /api/stats query args; returns (by, key)."""
+    by = 'session' if args.get('by') == 'session' else 'concept'
+    return by, args.get('session_id') if by == 'session' else args.get('concept')
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    """
+    Teacher report over the whole log: pass rate, average score and time,
+    fallout and uncertainty rates per concept (default) or per session
+    (?by=session). ?concept=... or ?session_id=... limits it to one entry.
+    """
+    by, key = stats_request(request.args)
+    return jsonify(get_stats(by=by, key=key))
+
+def session_report():
+    """Session count and approximate memory (bytes on disk for sqlite) of this worker's session store."""
+    count = len(user_sessions)
+    approx_bytes = user_sessions.approx_bytes()
+    return {
+        "backend": config.SESSION_BACKEND,
+        "sessions": count,
+        "approx_bytes": approx_bytes,
+        "bytes_per_session": round(approx_bytes / count) if approx_bytes and count else None,
+    }
+
+@app.route('/api/debug/sessions', methods=['GET'])
+def debug_sessions():
+    """Reports how many sessions this worker holds and roughly how much memory they use."""
+    return jsonify(session_report())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Serves this worker's counters and timings in Prometheus text format."""
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 # --- Frontend Serving Routes ---
 
 @app.route('/')
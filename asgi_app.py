@@ -0,0 +1,387 @@
+# asgi_app.py: Async (ASGI) entry point serving the same API as app.py.
+#
+# In app.py every student waiting on Gemini holds a worker thread for the
+# whole LLM round-trip. Here a waiting request is a suspended coroutine, so
+# one process can hold hundreds of students mid-answer. The quiz logic
+# (sessions, lessons, turn decisions) is shared with app.py; only the I/O
+# differs: LLM calls are awaited, and session/cache storage and full-queue
+# log writes run on worker threads. Routing, CORS and static files are
+# Starlette's.
+#
+# Usage: uvicorn asgi_app:app --port 5001
+
+import asyncio
+import contextlib
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from starlette.applications import Starlette
+from starlette.datastructures import MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+import config
+import llm_client
+import metrics
+import prefetch
+
+from app import (
+    app as flask_app, user_sessions, clean_hint, fetch_hint, format_question, schedule_prefetch, new_session, start_payload,
+    build_turn, plan_llm_calls, apply_turn, turn_log_payload, parse_batch_request,
+    sse_event, stats_request, session_report, no_question_error, EMPTY_LESSON_ERROR,
+)
+from batch_grader import grade_batch, format_rows
+from data_logger import flush_logs, log_to_csv_async
+from evaluator import evaluate_answer_async
+from knowledge_base import get_lesson, get_lesson_ids, get_concept_list
+from log_analytics import get_stats
+from session_store import MemorySessionStore
+from tutor import (
+    generate_remediation_async, answer_follow_up_async, generate_hint_async,
+    stream_remediation_async, stream_follow_up_async,
+)
+
+TEMPLATE_PATH = os.path.join(flask_app.root_path, flask_app.template_folder, 'aitutor.html')
+STATIC_DIR = os.path.realpath(flask_app.static_folder)
+
+
+# --- Requests & Responses ---
+
+async def read_json(request):
+    """The parsed JSON body, or {} if it is missing or invalid."""
+    body = await request.body()
+    try:
+        return (json.loads(body) if body else None) or {}
+    except ValueError:
+        return {}
+
+
+def json_response(data, status=200):
+    return JSONResponse(data, status)
+
+
+# --- Blocking I/O Helpers ---
+
+async def _sessions(method, *args):
+    """Calls a session store method; SQLite and Redis stores run on a worker thread."""
+    if isinstance(user_sessions, MemorySessionStore):
+        return method(*args)
+    return await asyncio.to_thread(method, *args)
+
+
+# --- Async LLM Calls ---
+
+async def fetch_hint_async(concept):
+    """Async version of app.fetch_hint."""
+    prefetched, hint = await prefetch.take_async(fetch_hint, (concept,))
+    if prefetched:
+        return hint
+    try:
+        return clean_hint(await generate_hint_async(concept))
+    except Exception as e:
+        print(f"Hint generation failed: {e}")
+        return None
+
+@metrics.timed('prepare_question_response')
+async def prepare_question_response_async(concept, ground_truth):
+    """Async version of app.prepare_question_response."""
+    hint = await fetch_hint_async(concept) if config.GRADER_DIFFICULTY == 'Easy' else None
+    return format_question(concept, hint)
+
+# Async versions of the calls named by app.plan_llm_calls (same arguments).
+ASYNC_CALLS = {
+    "sme_answer": answer_follow_up_async,
+    "remediation_text": generate_remediation_async,
+    "hint": fetch_hint_async,
+}
+
+ASYNC_STREAMED_CALLS = {
+    "remediation_text": stream_remediation_async,
+    "sme_answer": stream_follow_up_async,
+}
+
+async def run_concurrently_async(tasks):
+    """Async version of app.run_concurrently: same names, None for failed or late calls."""
+    futures = {name: asyncio.ensure_future(ASYNC_CALLS[name](*args)) for name, (func, args) in tasks.items()}
+    if not futures:
+        return {}
+    done, _ = await asyncio.wait(futures.values(), timeout=config.LLM_FANOUT_DEADLINE)
+
+    results = {}
+    for name, future in futures.items():
+        if future in done and future.exception() is None:
+            results[name] = future.result()
+        else:
+            if future in done:
+                print(f"Concurrent LLM call '{name}' failed: {future.exception()}")
+            else:
+                print(f"Concurrent LLM call '{name}' missed the {config.LLM_FANOUT_DEADLINE}s deadline.")
+                future.cancel()
+            results[name] = None
+    return results
+
+
+# --- Turn Handling (see app.py) ---
+
+async def grade_turn_async(session_id, user_answer):
+    session_data = await _sessions(user_sessions.get, session_id)
+    concept, ground_truth = session_data.question() if session_data is not None else (None, None)
+    if concept is None:
+        return None, no_question_error(session_data)
+
+    evaluation_data = await evaluate_answer_async(
+        concept=concept,
+        ground_truth=ground_truth,
+        user_answer=user_answer,
+        difficulty=config.GRADER_DIFFICULTY
+    )
+    return build_turn(session_id, session_data, user_answer, evaluation_data)
+
+async def finish_turn_async(turn, tasks, results):
+    response_payload = apply_turn(turn, tasks, results)
+    await log_to_csv_async(turn_log_payload(turn))
+    await _sessions(user_sessions.save, turn["session_id"], turn["session_data"])
+    schedule_prefetch(turn["session_id"], turn["session_data"])
+    return response_payload
+
+
+# --- API Routes ---
+
+async def get_lessons(request):
+    return json_response(get_lesson_ids())
+
+async def get_concepts(request):
+    lesson_id = request.query_params.get('lesson_id')
+    if get_lesson(lesson_id) is None:
+        return json_response({"error": f"Unknown lesson: {lesson_id}"}, 404)
+    return json_response(get_concept_list(lesson_id))
+
+async def start_quiz(request):
+    data = await read_json(request)
+    session_id = data.get('session_id')
+    if not session_id:
+        return json_response({"error": "Missing session_id."}, 400)
+
+    lesson_id = data.get('lesson_id')
+    if get_lesson(lesson_id) is None:
+        return json_response({"error": f"Unknown lesson: {lesson_id}"}, 404)
+
+    session_data, concept, ground_truth = new_session(lesson_id)
+    if not concept:
+        return json_response(*EMPTY_LESSON_ERROR)
+    await _sessions(user_sessions.save, session_id, session_data)
+    schedule_prefetch(session_id, session_data)
+    return json_response(start_payload(await prepare_question_response_async(concept, ground_truth)))
+
+async def ask(request):
+    data = await read_json(request)
+    session_id = data.get('session_id')
+    user_answer = data.get('answer')
+    if not session_id or not user_answer:
+        return json_response({"error": "Missing session_id or answer."}, 400)
+
+    try:
+        turn, error = await grade_turn_async(session_id, user_answer)
+        if error:
+            return json_response(*error)
+        tasks = plan_llm_calls(turn)
+        results = await run_concurrently_async(tasks)
+        return json_response(await finish_turn_async(turn, tasks, results))
+    except Exception as e:
+        print(f"Error in /ask route: {e}")
+        traceback.print_exc()
+        return json_response({"error": "An internal server error occurred.", "details": str(e)}, 500)
+
+async def _pump_stream_async(chunks, out_queue):
+    """Copies an async text stream into a queue; None marks the end."""
+    try:
+        async for chunk in chunks:
+            await out_queue.put(chunk)
+    except Exception as e:
+        print(f"Streaming LLM call failed: {e}")
+    finally:
+        await out_queue.put(None)
+
+async def ask_stream(request):
+    """Same events as app.ask_stream: 'evaluation', 'delta'..., then 'done' or 'error'."""
+    data = await read_json(request)
+    session_id = data.get('session_id')
+    user_answer = data.get('answer')
+    if not session_id or not user_answer:
+        return json_response({"error": "Missing session_id or answer."}, 400)
+
+    async def generate():
+        loop = asyncio.get_running_loop()
+        pumps = []
+        try:
+            turn, error = await grade_turn_async(session_id, user_answer)
+            if error:
+                yield sse_event('error', error[0])
+                return
+            yield sse_event('evaluation', {"evaluation_text": turn["evaluation_text"], "scores": turn["scores"]})
+
+            deadline = loop.time() + config.LLM_FANOUT_DEADLINE
+            tasks = plan_llm_calls(turn)
+
+            streams = {}
+            futures = {}
+            for name, (func, args) in tasks.items():
+                if name in ASYNC_STREAMED_CALLS and not prefetch.is_prefetched(func, args):
+                    streams[name] = asyncio.Queue()
+                    pumps.append(asyncio.ensure_future(_pump_stream_async(ASYNC_STREAMED_CALLS[name](*args), streams[name])))
+                else:
+                    futures[name] = asyncio.ensure_future(ASYNC_CALLS[name](*args))
+
+            results = {}
+            # Remediation is shown before the SME answer, matching /api/ask.
+            for name in ("remediation_text", "sme_answer"):
+                if name in futures:
+                    # Prefetched: sent as one chunk
+                    try:
+                        results[name] = await asyncio.wait_for(futures.pop(name), max(0, deadline - loop.time()))
+                    except Exception as e:
+                        print(f"Concurrent LLM call '{name}' failed: {e!r}")
+                        results[name] = None
+                    if results[name]:
+                        yield sse_event('delta', {"field": name, "text": results[name]})
+                if name not in streams:
+                    continue
+                parts = []
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(streams[name].get(), max(0, deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        print(f"Streaming LLM call '{name}' missed the {config.LLM_FANOUT_DEADLINE}s deadline.")
+                        break
+                    if chunk is None:
+                        break
+                    parts.append(chunk)
+                    yield sse_event('delta', {"field": name, "text": chunk})
+                results[name] = "".join(parts)
+
+            for name, future in futures.items():
+                try:
+                    results[name] = await asyncio.wait_for(future, max(0, deadline - loop.time()))
+                except Exception as e:
+                    print(f"Concurrent LLM call '{name}' failed: {e!r}")
+                    results[name] = None
+
+            yield sse_event('done', await finish_turn_async(turn, tasks, results))
+
+        except Exception as e:
+            print(f"Error in /ask_stream route: {e}")
+            traceback.print_exc()
+            yield sse_event('error', {"error": "An internal server error occurred.", "details": str(e)})
+        finally:
+            for pump in pumps:
+                pump.cancel()
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def grade_batch_route(request):
+    batch, error = parse_batch_request(await read_json(request))
+    if error:
+        return json_response(*error)
+
+    # Batch grading has its own bounded thread pool; stream its rows as they come
+    rows = grade_batch(batch["items"], difficulty=batch["difficulty"], lesson_id=batch["lesson_id"])
+    return StreamingResponse(llm_client.iterate_in_thread(format_rows(rows, batch["format"])), media_type=batch["mimetype"])
+
+async def stats(request):
+    # Reading new log rows is file I/O, so it runs on a worker thread
+    by, key = stats_request(request.query_params)
+    return json_response(await asyncio.to_thread(get_stats, by, key))
+
+async def debug_sessions(request):
+    return json_response(await _sessions(session_report))
+
+async def prometheus_metrics(request):
+    return Response(metrics.render_prometheus(), media_type='text/plain; version=0.0.4')
+
+
+# --- Frontend Serving ---
+
+async def index(request):
+    """Serves the main HTML page."""
+    return FileResponse(TEMPLATE_PATH)
+
+async def serve_static(request):
+    """Serves other files from the 'static' folder at their own path, as app.py does."""
+    path = os.path.realpath(os.path.join(STATIC_DIR, request.path_params['filename']))
+    if not path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(path):
+        raise HTTPException(404)
+    return FileResponse(path)
+
+ERROR_MESSAGES = {404: "Not found.", 405: "Method not allowed."}
+
+async def http_error(request, exc):
+    """JSON errors for unknown paths and methods, like the API's own errors."""
+    return json_response({"error": ERROR_MESSAGES.get(exc.status_code, exc.detail)}, exc.status_code)
+
+
+# --- ASGI Entry Point ---
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=config.ASYNC_THREADS, thread_name_prefix='asgi-io'))
+    metrics.maybe_start_profiler()
+    yield
+    await llm_client.close_async_client()
+    await asyncio.to_thread(flush_logs)
+
+
+class ServerTimingMiddleware:
+    """Collects each request's spans for a Server-Timing header, as app.py does."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                trace = metrics.current_trace()
+                if trace:
+                    MutableHeaders(scope=message).append('Server-Timing', metrics.server_timing_header(trace))
+            await send(message)
+
+        token = metrics.start_trace()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            metrics.end_trace(token)
+
+
+routes = [
+    Route('/api/lessons', get_lessons, methods=['GET']),
+    Route('/api/concepts', get_concepts, methods=['GET']),
+    Route('/api/start', start_quiz, methods=['POST']),
+    Route('/api/ask', ask, methods=['POST']),
+    Route('/api/ask_stream', ask_stream, methods=['POST']),
+    Route('/api/grade_batch', grade_batch_route, methods=['POST']),
+    Route('/api/stats', stats, methods=['GET']),
+    Route('/api/debug/sessions', debug_sessions, methods=['GET']),
+    Route('/metrics', prometheus_metrics, methods=['GET']),
+    Route('/', index, methods=['GET']),
+    Route('/{filename:path}', serve_static, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        # CORS as flask_cors answers it for app.py
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['GET', 'POST', 'OPTIONS'],
+                   allow_headers=['Content-Type']),
+        Middleware(ServerTimingMiddleware),
+    ],
+    exception_handlers={HTTPException: http_error},
+    lifespan=lifespan,
+)
@@ -0,0 +1,168 @@
+# batch_grader.py: Grades many (concept, answer) pairs with a few packed LLM calls.
+#
+# Used by the /api/grade_batch endpoint and 'python manage.py grade-batch'
+# for answers collected offline. Answers to the same concept are packed into
+# one structured-JSON prompt, packs run with bounded concurrency, and each
+# result comes out as a row in data_logger.LOG_HEADER format as soon as its
+# pack is graded.
+
+import csv
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import answer_cache
+import config
+import metrics
+import prompts
+from data_logger import LOG_HEADER, get_log_payload
+from evaluator import fallback_evaluation, get_llm_response
+from knowledge_base import get_lesson
+from pregrader import pregrade
+
+
+def build_batch_prompt(concept, ground_truth, answers, difficulty):
+    """Builds one grading prompt for several answers to the same concept."""
+    return prompts.batch_grader_prompt(concept, ground_truth, answers, difficulty)
+
+
+@metrics.timed('grade_pack')
+def grade_pack(concept, ground_truth, answers, difficulty):
+    """Grades answers to one concept in a single LLM call; returns one evaluation per answer."""
+    raw_response = get_llm_response(build_batch_prompt(concept, ground_truth, answers, difficulty), force_json=True)
+
+    by_id = {}
+    try:
+        for result in json.loads(raw_response).get("results", []):
+            by_id[int(result["id"])] = result
+    except (json.JSONDecodeError, TypeError, AttributeError, KeyError, ValueError) as e:
+        print(f"Error parsing batch grading JSON: {e}")
+        print(f"Raw output was: {raw_response}")
+
+    # Any answer the grader skipped gets the usual SAFETY NET result
+    return [by_id.get(i) or fallback_evaluation() for i in range(len(answers))]
+
+
+def _row(item, evaluation):
+    payload = get_log_payload(
+        item.get("session_id", ""), item["concept"], item["answer"],
+        evaluation.get("scores", {}), evaluation.get("signals", {}),
+        "N/A", evaluation.get("evaluation_text", ""), False
+    )
+    return payload["row_data"]
+
+
+def find_invalid_item(items):
+    """Returns (position, item) of the first item without a text concept and answer, or None."""
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            return position, item
+        concept, answer = item.get("concept"), item.get("answer")
+        if not isinstance(concept, str) or not isinstance(answer, str) or not concept.strip() or not answer.strip():
+            return position, item
+    return None
+
+
+def grade_batch(items, difficulty=None, lesson_id=None, pack_size=None, workers=None):
+    """
+    Grades a list of answers and yields LOG_HEADER rows as results become available.
+
+    Args:
+        items (list): Dicts with 'concept' and 'answer' (and optionally 'session_id').
+        difficulty (str): Grading mode; defaults to config.GRADER_DIFFICULTY.
+        lesson_id (str): Lesson the concepts come from; defaults to the default lesson.
+        pack_size (int): Max answers per LLM call; defaults to config.BATCH_PACK_SIZE.
+        workers (int): Max concurrent LLM calls; defaults to config.BATCH_WORKERS.
+
+    Rows are yielded in completion order, not input order. Raises
+    ValueError before grading anything if an item's concept or answer is
+    not a non-empty string, or if the lesson does not exist.
+    """
+    invalid = find_invalid_item(items)
+    if invalid is not None:
+        raise ValueError(f"Item {invalid[0]} needs a text concept and answer: {invalid[1]!r}")
+    lesson = get_lesson(lesson_id)
+    if lesson is None:
+        raise ValueError(f"Unknown lesson: {lesson_id}")
+    difficulty = difficulty or config.GRADER_DIFFICULTY
+    pack_size = pack_size or config.BATCH_PACK_SIZE
+
+    # Group by concept, grading clear-cut and already-seen answers locally on the way
+    by_concept = {}
+    for item in items:
+        index = lesson.concept_index.get(item["concept"].lower())
+        if index is None:
+            yield _row(item, {"evaluation_text": f"Unknown concept: {item['concept']}"})
+            continue
+        ground_truth = lesson.items[index]["description"]
+        if config.PREGRADER_ENABLED:
+            local_result = pregrade(item["concept"], ground_truth, item["answer"], difficulty)
+            if local_result is not None:
+                metrics.inc('tutor_local_grades_total')
+                yield _row(item, local_result)
+                continue
+        cached = answer_cache.lookup(item["concept"], ground_truth, item["answer"], difficulty)
+        if cached is not None:
+            yield _row(item, cached)
+            continue
+        by_concept.setdefault((item["concept"], ground_truth), []).append(item)
+
+    packs = []
+    for (concept, ground_truth), concept_items in by_concept.items():
+        for start in range(0, len(concept_items), pack_size):
+            packs.append((concept, ground_truth, concept_items[start:start + pack_size]))
+
+    if not packs:
+        return
+
+    with ThreadPoolExecutor(max_workers=workers or config.BATCH_WORKERS) as pool:
+        futures = {
+            pool.submit(grade_pack, concept, ground_truth, [item["answer"] for item in pack], difficulty): (ground_truth, pack)
+            for concept, ground_truth, pack in packs
+        }
+        for future in as_completed(futures):
+            ground_truth, pack = futures[future]
+            try:
+                evaluations = future.result()
+            except Exception as e:
+                print(f"Batch grading call failed: {e}")
+                evaluations = [fallback_evaluation() for _ in pack]
+            for item, evaluation in zip(pack, evaluations):
+                answer_cache.store(item["concept"], ground_truth, item["answer"], difficulty, evaluation)
+                yield _row(item, evaluation)
+
+
+def format_rows(rows, output_format):
+    """Turns LOG_HEADER rows into JSONL lines or CSV text (header first), one chunk per row."""
+    if output_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(LOG_HEADER)
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for row in rows:
+            yield json.dumps(dict(zip(LOG_HEADER, row))) + "\n"
+
+
+def read_items(file_path):
+    """
+    Reads answers to grade from a file.
+
+    Accepts CSV with "Session ID", "Question" and "Answer" columns (the
+    tutor_log.csv names) or JSONL with session_id, concept and answer keys.
+    """
+    items = []
+    with open(file_path, newline='', encoding='utf-8') as f:
+        if file_path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    items.append({"session_id": record.get("session_id", ""), "concept": record.get("concept"), "answer": record.get("answer")})
+        else:
+            for record in csv.DictReader(f):
+                items.append({"session_id": record.get("Session ID", ""), "concept": record.get("Question"), "answer": record.get("Answer")})
+    return items
@@ -0,0 +1,196 @@
+# load_test.py: Simulates a classroom of students taking the quiz and reports latency.
+#
+# By default everything runs in-process: a mock Gemini server is started
+# (see mock_gemini.py) and the Flask app is driven through app.test_client().
+# To benchmark a real deployment instead, start the mock and the server
+# yourself and pass --url:
+#   python benchmarks/mock_gemini.py --port 8765 &
+#   GEMINI_API_BASE=http://127.0.0.1:8765/v1beta GEMINI_API_KEY=mock gunicorn -w 4 app:app &
+#   python benchmarks/load_test.py --url http://127.0.0.1:8000 --mock-url http://127.0.0.1:8765
+# The async server is benchmarked the same way, started with
+#   GEMINI_API_BASE=... GEMINI_API_KEY=mock uvicorn asgi_app:app --port 8000
+#
+# Usage: python benchmarks/load_test.py [--sessions 30] [--questions 20] ...
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mock_gemini import start_mock_server
+
+# What simulated students type. "I don't know" answers exercise the local pregrader.
+SAMPLE_ANSWERS = [
+    "It is a set of steps the computer follows to solve a problem.",
+    "I think it means the AI learns patterns from lots of examples.",
+    "Something to do with data and predictions?",
+    "It's when a computer copies how people think and makes choices.",
+    "I don't know",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Recorder:
+    """Collects per-endpoint latencies from all session threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self.answers = 0
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.failures[endpoint] += 1
+            if endpoint == '/api/ask':
+                self.answers += 1
+
+
+class TestClientTransport:
+    """Sends requests to the app in this process."""
+
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def post(self, path, payload):
+        response = self.client.post(path, json=payload)
+        return response.status_code, response.get_json(silent=True) or {}
+
+
+class HTTPTransport:
+    """Sends requests to a running server (e.g. gunicorn)."""
+
+    def __init__(self, base_url):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def post(self, path, payload):
+        response = self.session.post(self.base_url + path, json=payload, timeout=120)
+        try:
+            return response.status_code, response.json()
+        except ValueError:
+            return response.status_code, {}
+
+
+def run_session(number, make_transport, recorder, questions, rng_seed):
+    """One simulated student: start the quiz, then answer up to `questions` times."""
+    rng = random.Random(rng_seed + number)
+    transport = make_transport()
+    session_id = f"bench-{rng_seed}-{number}"
+
+    start = time.perf_counter()
+    status, _ = transport.post('/api/start', {"session_id": session_id})
+    recorder.record('/api/start', time.perf_counter() - start, status == 200)
+    if status != 200:
+        return
+
+    for _ in range(questions):
+        start = time.perf_counter()
+        status, body = transport.post('/api/ask', {"session_id": session_id, "answer": rng.choice(SAMPLE_ANSWERS)})
+        recorder.record('/api/ask', time.perf_counter() - start, status == 200 and 'error' not in body)
+        if status != 200 or "completed all the questions" in body.get('next_question', ''):
+            break
+
+
+def mock_calls(settings, mock_url):
+    """Returns the number of LLM calls the mock has served so far."""
+    if settings is not None:
+        with settings.lock:
+            return settings.counts["requests"]
+    if mock_url:
+        import requests
+        return requests.get(mock_url.rstrip('/') + '/stats', timeout=5).json()["requests"]
+    return None
+
+
+def print_report(recorder, elapsed, calls):
+    print(f"\n{'endpoint':<14}{'count':>7}{'fail':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    total = 0
+    for endpoint, values in sorted(recorder.latencies.items()):
+        total += len(values)
+        print(f"{endpoint:<14}{len(values):>7}{recorder.failures[endpoint]:>6}"
+              f"{percentile(values, 50) * 1000:>9.0f}{percentile(values, 95) * 1000:>9.0f}"
+              f"{percentile(values, 99) * 1000:>9.0f}{max(values) * 1000:>9.0f}")
+    print(f"\n{total} requests in {elapsed:.1f}s = {total / elapsed:.1f} requests/s")
+    if calls is not None and recorder.answers:
+        print(f"{calls} LLM calls for {recorder.answers} answers = {calls / recorder.answers:.2f} LLM calls per answer")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Classroom load test for the AI Tutor API.")
+    parser.add_argument('--sessions', type=int, default=30, help="Concurrent students (default: 30).")
+    parser.add_argument('--questions', type=int, default=20, help="Answers per student (default: 20).")
+    parser.add_argument('--url', help="Benchmark a running server instead of the in-process app.")
+    parser.add_argument('--mock-url', help="Mock Gemini base URL, to read call counts when using --url.")
+    parser.add_argument('--latency', type=float, default=0.5, help="In-process mock: mean seconds per LLM call.")
+    parser.add_argument('--jitter', type=float, default=0.2, help="In-process mock: latency jitter in seconds.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="In-process mock: fraction of 429/503 replies.")
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help="In-process mock: fraction of broken grader JSON.")
+    parser.add_argument('--pass-rate', type=float, default=0.6, help="In-process mock: fraction of passing answers.")
+    parser.add_argument('--difficulty', choices=['Easy', 'Normal', 'Strict'], help="Override grader_difficulty.")
+    parser.add_argument('--warm-cache', action='store_true', help="Keep the configured LLM cache instead of a cold, temporary one.")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    settings = None
+    if args.url:
+        make_transport = lambda: HTTPTransport(args.url)
+    else:
+        server, settings = start_mock_server(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+            malformed_rate=args.malformed_rate, pass_rate=args.pass_rate, seed=args.seed
+        )
+        os.environ['GEMINI_API_BASE'] = f"http://127.0.0.1:{server.server_address[1]}/v1beta"
+        os.environ['GEMINI_API_KEY'] = 'mock'
+        os.environ.setdefault('DISABLE_LOGGING', 'true')
+
+        import config
+        if args.difficulty:
+            config.GRADER_DIFFICULTY = args.difficulty
+        if not args.warm_cache:
+            config.LLM_CACHE_FILE = os.path.join(tempfile.mkdtemp(), 'bench_cache.sqlite3')
+        from app import app as flask_app
+        make_transport = lambda: TestClientTransport(flask_app)
+
+    calls_before = mock_calls(settings, args.mock_url)
+    recorder = Recorder()
+    print(f"Running {args.sessions} sessions x {args.questions} answers...")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as pool:
+        futures = [pool.submit(run_session, number, make_transport, recorder, args.questions, args.seed)
+                   for number in range(args.sessions)]
+        for future in futures:
+            future.result()  # Surface errors from the session threads
+    elapsed = time.perf_counter() - start
+
+    calls_after = mock_calls(settings, args.mock_url)
+    calls = calls_after - calls_before if calls_before is not None else None
+    print_report(recorder, elapsed, calls)
+    if settings is not None:
+        print("Mock counters:", json.dumps(settings.counts))
+
+
+if __name__ == '__main__':
+    main()
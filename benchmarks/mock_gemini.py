@@ -0,0 +1,177 @@
+# mock_gemini.py: Local stand-in for the Gemini API, used by the benchmarks.
+#
+# Speaks the generateContent and streamGenerateContent (alt=sse) response
+# shapes that evaluator.py parses, with configurable latency, error rate and
+# malformed-JSON rate. Point the tutor at it with:
+#   GEMINI_API_BASE=http://127.0.0.1:8765/v1beta GEMINI_API_KEY=mock python app.py
+#
+# Usage: python benchmarks/mock_gemini.py [--port 8765] [--latency 0.8] ...
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockSettings:
+    """Behaviour knobs shared by every request handler."""
+
+    def __init__(self, latency=0.5, jitter=0.2, error_rate=0.0, malformed_rate=0.0,
+                 pass_rate=0.6, stream_chunks=8, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.pass_rate = pass_rate
+        self.stream_chunks = stream_chunks
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "json_requests": 0, "stream_requests": 0, "errors": 0, "malformed": 0}
+
+    def roll(self):
+        with self.lock:
+            return self.random.random()
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def delay(self):
+        with self.lock:
+            seconds = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, seconds))
+
+
+def grade(settings):
+    """One grader result; passes with probability pass_rate."""
+    passed = settings.roll() < settings.pass_rate
+    correctness, explanation = (45, 35) if passed else (15, 10)
+    return {
+        "scores": {"correctness": correctness, "explanation": explanation, "bonus": 0, "final": correctness + explanation},
+        "signals": {"correctness_explanation_gap": False, "uncertainty_detected": not passed, "persona": "Benchmark Student"},
+        "evaluation_text": f"**Scores: {correctness + explanation}/100** Mock evaluation.",
+        "follow_up_question": "None"
+    }
+
+
+def grader_response(settings, prompt):
+    """Grader JSON: one result, or a "results" list for batch_grader.py prompts."""
+    batch_ids = re.findall(r'^- id (\d+): ', prompt, re.MULTILINE)
+    if batch_ids:
+        return json.dumps({"results": [dict(grade(settings), id=int(i)) for i in batch_ids]})
+    return json.dumps(grade(settings))
+
+
+def text_response(prompt):
+    return f"Mock tutor reply ({len(prompt)} prompt chars). " + "This explains the concept simply. " * 4
+
+
+class MockGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    settings = MockSettings()
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    def _send(self, status, body, content_type='application/json'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # /stats reports how many calls were served, for "LLM calls per answer"
+        if self.path.startswith('/stats'):
+            with self.settings.lock:
+                self._send(200, json.dumps(self.settings.counts))
+        else:
+            self._send(404, '{"error": "not found"}')
+
+    def do_POST(self):
+        settings = self.settings
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt = body.get("contents", [{}])[0].get("parts", [{}])[0].get("text", "")
+        force_json = body.get("generationConfig", {}).get("response_mime_type") == "application/json"
+        streaming = 'streamGenerateContent' in self.path
+
+        settings.count("requests")
+        settings.count("stream_requests" if streaming else "json_requests")
+        settings.delay()
+
+        if settings.roll() < settings.error_rate:
+            settings.count("errors")
+            status = 429 if settings.roll() < 0.5 else 503
+            self._send(status, json.dumps({"error": {"code": status, "message": "Mock upstream error"}}))
+            return
+
+        if force_json:
+            text = grader_response(settings, prompt)
+            if settings.roll() < settings.malformed_rate:
+                settings.count("malformed")
+                text = text[:len(text) // 2]  # Truncated JSON, like a cut-off generation
+        else:
+            text = text_response(prompt)
+
+        if streaming:
+            self._stream(text)
+        else:
+            self._send(200, json.dumps({"candidates": [{"content": {"parts": [{"text": text}], "role": "model"}}]}))
+
+    def _stream(self, text):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        size = max(1, len(text) // self.settings.stream_chunks)
+        for start in range(0, len(text), size):
+            event = {"candidates": [{"content": {"parts": [{"text": text[start:start + size]}], "role": "model"}}]}
+            data = f"data: {json.dumps(event)}\r\n\r\n".encode('utf-8')
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class MockServer(ThreadingHTTPServer):
+    # The default listen backlog of 5 makes bursts of new connections (e.g.
+    # from the async server) wait on SYN retries instead of the mock latency.
+    request_queue_size = 1024
+
+
+def start_mock_server(port=0, **settings):
+    """Starts the mock in a background thread; returns (server, settings). Port 0 picks a free port."""
+    handler = type('ConfiguredHandler', (MockGeminiHandler,), {'settings': MockSettings(**settings)})
+    server = MockServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-gemini', daemon=True).start()
+    return server, handler.settings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gemini API.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.5, help="Mean seconds per call.")
+    parser.add_argument('--jitter', type=float, default=0.2, help="+/- seconds added to the latency.")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of calls answered with 429/503.")
+    parser.add_argument('--malformed-rate', type=float, default=0.0, help="Fraction of grader calls returning broken JSON.")
+    parser.add_argument('--pass-rate', type=float, default=0.6, help="Fraction of graded answers that pass.")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    server, _ = start_mock_server(
+        args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate, pass_rate=args.pass_rate, seed=args.seed
+    )
+    print(f"Mock Gemini listening on http://127.0.0.1:{server.server_address[1]}/v1beta")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
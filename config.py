@@ -33,14 +33,157 @@ if not API_KEY:
         # raise ValueError("API Key not found. Set it in settings.ini or as GEMINI_API_KEY env var.")
 
 KB_FILE_PATH = os.path.join(os.path.dirname(__file__), config.get('General', 'lesson_file', fallback='LessonAILiteracy.txt'))
+# Other lessons are the *.txt files in this folder, selected by file name
+# (without .txt) as 'lesson_id'. They are loaded on first use, at most
+# max_loaded_lessons are kept in memory, and edited files are reloaded
+# (checked every lesson_reload_interval seconds).
+LESSONS_DIR = os.path.join(os.path.dirname(__file__), config.get('General', 'lessons_dir', fallback='lessons'))
+MAX_LOADED_LESSONS = config.getint('General', 'max_loaded_lessons', fallback=32)
+LESSON_RELOAD_INTERVAL = config.getfloat('General', 'lesson_reload_interval', fallback=2.0)
+# Parsed lessons are cached here (keyed by file hash) so workers skip parsing.
+LESSON_CACHE_ENABLED = config.getboolean('General', 'lesson_cache', fallback=True)
+LESSON_CACHE_DIR = os.path.join(os.path.dirname(__file__), config.get('General', 'lesson_cache_dir', fallback='.lesson_cache'))
 
 # [Tutor Behavior] Section
 REMEDIATION_THRESHOLD = config.getint('Tutor Behavior', 'passing_score', fallback=70)
 MAX_ATTEMPTS = config.getint('Tutor Behavior', 'max_attempts', fallback=2)
 MAX_TIME_ON_QUESTION = config.getint('Tutor Behavior', 'max_time_on_question', fallback=120)
 GRADER_DIFFICULTY = config.get('Tutor Behavior', 'grader_difficulty', fallback='Normal')
+# Grade "I don't know" answers locally (pregrader.py) instead of calling the LLM.
+PREGRADER_ENABLED = config.getboolean('Tutor Behavior', 'local_pregrade', fallback=True)
+
+# [LLM] Section
+# Connection pool and timeouts for llm_client.py. The API base can be pointed
+# at a local stand-in server (e.g. for benchmarks) via GEMINI_API_BASE.
+LLM_API_BASE = os.environ.get('GEMINI_API_BASE') or config.get('LLM', 'api_base', fallback='https://generativelanguage.googleapis.com/v1beta')
+LLM_MODEL = config.get('LLM', 'model', fallback='gemini-flash-latest')
+LLM_POOL_SIZE = config.getint('LLM', 'pool_size', fallback=10)
+LLM_CONNECT_TIMEOUT = config.getfloat('LLM', 'connect_timeout', fallback=5)
+LLM_READ_TIMEOUT = config.getfloat('LLM', 'read_timeout', fallback=40)
+# Follow-up, remediation and hint calls in /api/ask run in parallel on a
+# thread pool and are joined under a single deadline (seconds).
+LLM_FANOUT_WORKERS = config.getint('LLM', 'fanout_workers', fallback=16)
+LLM_FANOUT_DEADLINE = config.getfloat('LLM', 'fanout_deadline', fallback=30)
+# Client-side protection against throttling (per worker): a token bucket of
+# rate_limit calls/second (0 = off) with bursts of rate_burst, waiting at
+# most rate_limit_wait seconds for a token; up to max_retries retries of
+# 429/5xx and connection errors with jittered backoff, all within
+# retry_deadline seconds (keep it below fanout_deadline; a retry is only
+# made if at least retry_min_attempt seconds would be left for it, and a
+# retry's read timeout never runs past the deadline, while the first
+# attempt always gets the full read_timeout); a circuit breaker that fails fast for
+# breaker_cooldown seconds after breaker_failures failures in a row (0 = off);
+# and a duplicate grader call after hedge_delay seconds (0 = off).
+LLM_RATE_LIMIT = config.getfloat('LLM', 'rate_limit', fallback=20)
+LLM_RATE_BURST = config.getfloat('LLM', 'rate_burst', fallback=40)
+LLM_RATE_LIMIT_WAIT = config.getfloat('LLM', 'rate_limit_wait', fallback=10)
+LLM_MAX_RETRIES = config.getint('LLM', 'max_retries', fallback=3)
+LLM_RETRY_BACKOFF = config.getfloat('LLM', 'retry_backoff', fallback=0.5)
+LLM_RETRY_BACKOFF_MAX = config.getfloat('LLM', 'retry_backoff_max', fallback=8)
+LLM_RETRY_DEADLINE = config.getfloat('LLM', 'retry_deadline', fallback=25)
+LLM_RETRY_MIN_ATTEMPT = config.getfloat('LLM', 'retry_min_attempt', fallback=5)
+LLM_BREAKER_FAILURES = config.getint('LLM', 'breaker_failures', fallback=5)
+LLM_BREAKER_COOLDOWN = config.getfloat('LLM', 'breaker_cooldown', fallback=30)
+LLM_HEDGE_DELAY = config.getfloat('LLM', 'hedge_delay', fallback=8)
+# Identical prompts in flight at the same time share one call (coalesce);
+# with coalesce_across_workers, workers also share calls through a SQLite
+# file, waiting at most coalesce_wait seconds for another worker's result.
+LLM_COALESCE = config.getboolean('LLM', 'coalesce', fallback=True)
+LLM_COALESCE_ACROSS_WORKERS = config.getboolean('LLM', 'coalesce_across_workers', fallback=False)
+LLM_COALESCE_FILE = os.path.join(os.path.dirname(__file__), config.get('LLM', 'coalesce_file', fallback='llm_inflight.sqlite3'))
+LLM_COALESCE_WAIT = config.getfloat('LLM', 'coalesce_wait', fallback=30)
+
+# [Cache] Section
+# Hints and remediation only depend on the lesson, so they are cached in
+# memory and in a SQLite file shared by all workers.
+LLM_CACHE_ENABLED = config.getboolean('Cache', 'enabled', fallback=True)
+LLM_CACHE_MEMORY_SIZE = config.getint('Cache', 'memory_size', fallback=1024)
+LLM_CACHE_FILE = os.path.join(os.path.dirname(__file__), config.get('Cache', 'cache_file', fallback='llm_cache.sqlite3'))
+# Grader results are reused for later answers to the same question whose
+# words are the same as a graded answer's, ignoring case, punctuation and
+# filler words. Off by default: a reused result includes the feedback
+# written for the first student. Kept in memory per worker, at most
+# answer_cache_size answers.
+ANSWER_CACHE_ENABLED = config.getboolean('Cache', 'answer_cache', fallback=False)
+ANSWER_CACHE_SIZE = config.getint('Cache', 'answer_cache_size', fallback=5000)
+
+# [Prefetch] Section
+# While a student answers, the hint for their next question (Easy mode) and
+# the remediation for the current one (only with remediation = true, since
+# most answers pass and never use it) are generated on up to workers
+# threads per worker process, tracking at most max_entries calls.
+PREFETCH_ENABLED = config.getboolean('Prefetch', 'enabled', fallback=True)
+PREFETCH_WORKERS = config.getint('Prefetch', 'workers', fallback=4)
+PREFETCH_MAX_ENTRIES = config.getint('Prefetch', 'max_entries', fallback=1000)
+PREFETCH_REMEDIATION = config.getboolean('Prefetch', 'remediation', fallback=False)
+
+# [Prompts] Section
+# Student answers and ground truths are cut to these many (estimated) tokens
+# before they go into a grading prompt; 0 disables the limit.
+PROMPT_ANSWER_TOKENS = config.getint('Prompts', 'answer_tokens', fallback=400)
+PROMPT_GROUND_TRUTH_TOKENS = config.getint('Prompts', 'ground_truth_tokens', fallback=800)
+
+# [Batch] Section
+# Offline grading (/api/grade_batch, 'python manage.py grade-batch') packs up
+# to pack_size answers to the same concept into one LLM call and runs at
+# most workers calls at a time.
+BATCH_PACK_SIZE = config.getint('Batch', 'pack_size', fallback=10)
+BATCH_WORKERS = config.getint('Batch', 'workers', fallback=4)
+BATCH_MAX_ITEMS = config.getint('Batch', 'max_items', fallback=2000)
+
+# [Async] Section
+# Used by the ASGI server (asgi_app.py): connections its async HTTP client
+# (httpx) may open to the LLM API, and threads for blocking work
+# (SQLite/Redis sessions, the SQLite cache, batch grading).
+LLM_ASYNC_POOL_SIZE = config.getint('Async', 'llm_pool_size', fallback=100)
+ASYNC_THREADS = config.getint('Async', 'threads', fallback=64)
+
+# [Sessions] Section
+# Where quiz session state lives. 'memory' only works with a single worker;
+# use 'sqlite' (shared file, one machine) or 'redis' (any Redis-protocol
+# server, many machines) when running several gunicorn workers. Sessions
+# idle for ttl seconds are swept every reap_interval seconds.
+SESSION_BACKEND = config.get('Sessions', 'backend', fallback='memory')
+SESSION_TTL = config.getint('Sessions', 'ttl', fallback=4 * 60 * 60)
+SESSION_MAX_SESSIONS = config.getint('Sessions', 'max_sessions', fallback=10000)
+SESSION_REAP_INTERVAL = config.getfloat('Sessions', 'reap_interval', fallback=60)
+SESSION_SQLITE_FILE = os.path.join(os.path.dirname(__file__), config.get('Sessions', 'sqlite_file', fallback='sessions.sqlite3'))
+SESSION_REDIS_URL = os.environ.get('SESSION_REDIS_URL') or config.get('Sessions', 'redis_url', fallback='redis://127.0.0.1:6379/0')
 
 
 # --- Local CSV Configuration ---
 # This remains the same, but data_logger.py will control if it's used
 LOCAL_LOG_FILE = os.path.join(os.path.dirname(__file__), 'tutor_log.csv')
+
+# [Logging] Section
+# Rows are queued and written in batches by a background thread.
+# log_mode 'single' appends every worker's batches to tutor_log.csv under a
+# file lock; 'per_worker' gives each worker its own file, merged afterwards
+# with 'python manage.py merge-logs'.
+LOG_MODE = config.get('Logging', 'log_mode', fallback='single')
+LOG_QUEUE_SIZE = config.getint('Logging', 'queue_size', fallback=10000)
+LOG_BATCH_SIZE = config.getint('Logging', 'batch_size', fallback=200)
+LOG_FLUSH_INTERVAL = config.getfloat('Logging', 'flush_interval', fallback=1.0)
+LOG_FSYNC_INTERVAL = config.getfloat('Logging', 'fsync_interval', fallback=5.0)
+# tutor_log.csv is rotated to tutor_log.<time>.csv when it reaches rotate_mb
+# or its first row is rotate_hours old (0 turns either off). Rotated files
+# are gzipped if compress_rotated is set; the oldest are deleted once they
+# add up to more than keep_mb or are older than keep_days (0 = no limit).
+LOG_ROTATE_BYTES = int(config.getfloat('Logging', 'rotate_mb', fallback=50) * 1024 * 1024)
+LOG_ROTATE_SECONDS = config.getfloat('Logging', 'rotate_hours', fallback=24) * 60 * 60
+LOG_ROTATE_COMPRESS = config.getboolean('Logging', 'compress_rotated', fallback=True)
+LOG_KEEP_BYTES = int(config.getfloat('Logging', 'keep_mb', fallback=1024) * 1024 * 1024)
+LOG_KEEP_SECONDS = config.getfloat('Logging', 'keep_days', fallback=0) * 24 * 60 * 60
+
+# [Analytics] Section
+# 'python manage.py compact-logs' moves logged rows into typed, compressed
+# column files in segments_dir (at most segment_rows rows each); /api/stats
+# reads their stored totals plus the rows logged since.
+ANALYTICS_DIR = os.path.join(os.path.dirname(__file__), config.get('Analytics', 'segments_dir', fallback='log_segments'))
+ANALYTICS_SEGMENT_ROWS = config.getint('Analytics', 'segment_rows', fallback=100000)
+
+# [Replay] Section
+# 'python manage.py replay-log' re-grades logged answers with up to workers
+# concurrent calls and keeps the results in cache_file so runs can resume.
+REPLAY_WORKERS = config.getint('Replay', 'workers', fallback=8)
+REPLAY_CACHE_FILE = os.path.join(os.path.dirname(__file__), config.get('Replay', 'cache_file', fallback='replay_cache.sqlite3'))
@@ -1,9 +1,26 @@
 # data_logger.py: Handles logging results to a local CSV file.
 
 import os
+import asyncio
+import atexit
 import datetime
 import csv
+import glob
+import gzip
+import heapq
+import io
+import queue
+import re
+import shutil
+import threading
+import time
 import config
+import metrics
+
+try:
+    import fcntl  # POSIX only; used to keep batches from different processes apart
+except ImportError:
+    fcntl = None
 
 
 LOGGING_DISABLED = os.environ.get('DISABLE_LOGGING', 'False').lower() == 'true'
@@ -18,39 +35,454 @@ LOG_HEADER = [
     "Concept Gap", "Persona", "Evaluation", "Fallout Triggered"
 ]
 
+
+def _write_header_if_missing(path):
+    """Creates a CSV file containing only the header row, if it does not exist yet."""
+    try:
+        # 'x' fails if another worker created the file first
+        with open(path, 'x', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(LOG_HEADER)
+        print(f"Created local log file: {path}")
+    except FileExistsError:
+        pass
+
+
+def _open_locked(path):
+    """
+    Opens a log file for appending and takes its lock (where supported).
+
+    If another worker rotated the file while we waited for the lock, the
+    path now names a new file, so it is reopened. An empty file gets its
+    header first.
+    """
+    while True:
+        f = open(path, 'a', newline='', encoding='utf-8')
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                current = os.stat(path).st_ino
+            except FileNotFoundError:
+                current = None
+            if current != os.fstat(f.fileno()).st_ino:
+                f.close()
+                continue
+        if os.fstat(f.fileno()).st_size == 0:
+            csv.writer(f).writerow(LOG_HEADER)
+        return f
+
+
+def _unlock(f):
+    if fcntl:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+# --- Rotation ---
+# The main log is renamed to tutor_log.<YYYYmmdd-HHMMSS>.csv once it reaches
+# config.LOG_ROTATE_BYTES or its first row is config.LOG_ROTATE_SECONDS old.
+# The worker whose batch crossed the limit renames it while holding the file
+# lock, and other workers notice the new file when they take the lock (see
+# _open_locked), so no batch is lost or split. Rotated files keep their
+# header row. They are then gzipped if config.LOG_ROTATE_COMPRESS is set, and
+# the oldest are deleted to stay within config.LOG_KEEP_BYTES and
+# config.LOG_KEEP_SECONDS.
+
+_first_row_times = {}   # (device, inode) of the main log -> [size last seen, timestamp of its first row]
+
+
+def rotated_log_paths(path=None):
+    """Rotated segments of a log file (plain or gzipped), oldest first."""
+    path = path or config.LOCAL_LOG_FILE
+    root, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(os.path.basename(root)) + r'\.(\d{8}-\d{6})(?:-(\d+))?' + re.escape(ext) + r'(\.gz)?$')
+    segments = []
+    for candidate in glob.glob(f"{glob.escape(root)}.*"):
+        match = pattern.match(os.path.basename(candidate))
+        if match:
+            segments.append(((match.group(1), int(match.group(2) or 0)), candidate))
+    return [candidate for _, candidate in sorted(segments)]
+
+
+def open_log(path):
+    """Opens a live or rotated log file (gzipped or not) for reading bytes."""
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def _first_row_time(f):
+    stat = os.fstat(f.fileno())
+    key = (stat.st_dev, stat.st_ino)
+    cached = _first_row_times.get(key)
+    # Another worker may have rotated the log and a new one reused its inode;
+    # logs only grow, so a smaller file is a new one.
+    if cached is None or stat.st_size < cached[0]:
+        with open(f.name, 'rb') as reader:
+            reader.readline()  # Header
+            first = reader.readline().decode('utf-8', errors='replace')
+        try:
+            timestamp = datetime.datetime.strptime(first[:19], "%Y-%m-%d %H:%M:%S").timestamp()
+        except ValueError:
+            return None  # No rows yet
+        _first_row_times.clear()  # Only the current main log is checked
+        cached = _first_row_times[key] = [stat.st_size, timestamp]
+    cached[0] = stat.st_size
+    return cached[1]
+
+
+def _rotation_due(f):
+    size = os.fstat(f.fileno()).st_size
+    if config.LOG_ROTATE_BYTES and size >= config.LOG_ROTATE_BYTES:
+        return True
+    if config.LOG_ROTATE_SECONDS:
+        first = _first_row_time(f)
+        return first is not None and time.time() - first >= config.LOG_ROTATE_SECONDS
+    return False
+
+
+def _maybe_rotate(f, path):
+    """Renames the locked main log if it is due; returns the rotated path or None."""
+    if path != config.LOCAL_LOG_FILE or not _rotation_due(f):
+        return None
+    root, ext = os.path.splitext(path)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    rotated, n = f"{root}.{stamp}{ext}", 0
+    while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+        n += 1
+        rotated = f"{root}.{stamp}-{n}{ext}"
+    try:
+        os.fsync(f.fileno())
+        os.rename(path, rotated)
+    except OSError as e:
+        print(f"Error rotating local CSV file: {e}")
+        return None
+    _first_row_times.clear()
+    metrics.inc('tutor_log_rotations_total')
+    return rotated
+
+
+def _compress(path):
+    # Write to a temp file and rename, so a half-written .gz never appears
+    tmp_path = f"{path}.gz.{os.getpid()}.tmp"
+    with open(path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1 << 20)
+    shutil.copystat(path, tmp_path)
+    os.replace(tmp_path, path + '.gz')
+    os.remove(path)
+
+
+def apply_retention(path=None):
+    """Deletes the oldest rotated segments beyond the configured size and age; returns how many."""
+    segments = rotated_log_paths(path)
+    sizes, ages = {}, {}
+    for segment in segments:
+        try:
+            stat = os.stat(segment)
+        except FileNotFoundError:
+            continue  # Removed by another worker
+        sizes[segment], ages[segment] = stat.st_size, time.time() - stat.st_mtime
+
+    total = sum(sizes.values())
+    removed = 0
+    for segment in segments:
+        if segment not in sizes:
+            continue
+        too_big = config.LOG_KEEP_BYTES and total > config.LOG_KEEP_BYTES
+        too_old = config.LOG_KEEP_SECONDS and ages[segment] > config.LOG_KEEP_SECONDS
+        if not (too_big or too_old):
+            break
+        try:
+            os.remove(segment)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= sizes[segment]
+    return removed
+
+
+def _finish_rotation(rotated):
+    """Compresses a freshly rotated segment and applies retention (outside the file lock)."""
+    try:
+        if config.LOG_ROTATE_COMPRESS:
+            _compress(rotated)
+        apply_retention()
+    except OSError as e:
+        print(f"Error finishing log rotation for '{rotated}': {e}")
+
+
+# Suffix of worker files taken by merge_worker_logs
+MERGING_SUFFIX = '.merging'
+
+
+def worker_log_path(pid=None):
+    """Returns the per-worker log file used when log_mode = per_worker."""
+    root, ext = os.path.splitext(config.LOCAL_LOG_FILE)
+    return f"{root}.worker-{pid or os.getpid()}{ext}"
+
+
+class BufferedCSVWriter:
+    """
+    Writes log rows from a background thread so requests never wait on disk I/O.
+
+    Rows go into a bounded queue. The flusher thread drains it in batches,
+    writes each batch with a single locked write (so rows from different
+    gunicorn workers never interleave), and fsyncs at most every
+    fsync_interval seconds. If the queue is full the row is written
+    synchronously rather than dropped, so the audit log stays complete.
+    """
+
+    def __init__(self, path_func, queue_size=10000, batch_size=200, flush_interval=1.0, fsync_interval=5.0):
+        self.path_func = path_func
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._last_fsync = time.monotonic()
+        self._dirty = False
+        self._closed = False
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so each worker starts its own flusher.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue(maxsize=self.queue_size)
+            self._thread = threading.Thread(target=self._run, name='csv-log-flusher', daemon=True)
+            self._pid = os.getpid()
+            self._closed = False
+            self._thread.start()
+
+    def try_write(self, row):
+        """Queues a row for writing; returns False if the queue is full."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            return False
+
+    def write(self, row):
+        """Queues a row for writing."""
+        if not self.try_write(row):
+            print("Log queue is full; writing row synchronously.")
+            self._write_batch([row])
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self._maybe_fsync(force=False)
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            rows = [row for row in batch if row is not None]
+            if rows:
+                self._write_batch(rows)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    @metrics.timed('log_write_batch')
+    def _write_batch(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        data = buffer.getvalue()
+
+        rotated = None
+        with self._write_lock:
+            try:
+                path = self.path_func()
+                with _open_locked(path) as f:
+                    try:
+                        f.write(data)
+                        f.flush()
+                        if time.monotonic() - self._last_fsync >= self.fsync_interval:
+                            os.fsync(f.fileno())
+                            self._last_fsync = time.monotonic()
+                            self._dirty = False
+                        else:
+                            self._dirty = True
+                        rotated = _maybe_rotate(f, path)
+                    finally:
+                        _unlock(f)
+            except Exception as e:
+                print(f"Error writing to local CSV file: {e}")
+        if rotated:
+            _finish_rotation(rotated)
+
+    def _maybe_fsync(self, force):
+        # Files are opened per batch, so an idle interval only needs to make
+        # sure the last batch reached the disk.
+        if not self._dirty or (not force and time.monotonic() - self._last_fsync < self.fsync_interval):
+            return
+        with self._write_lock:
+            path = self.path_func()
+            if os.path.exists(path):
+                try:
+                    with open(path, 'a', encoding='utf-8') as f:
+                        os.fsync(f.fileno())
+                except OSError as e:
+                    print(f"Error syncing local CSV file: {e}")
+            self._last_fsync = time.monotonic()
+            self._dirty = False
+
+    def flush(self):
+        """Blocks until every queued row has been written and synced."""
+        if self._pid != os.getpid() or self._closed:
+            return
+        self._queue.join()
+        self._maybe_fsync(force=True)
+
+    def close(self):
+        """Flushes remaining rows and stops the flusher thread (called at exit)."""
+        if self._pid != os.getpid() or self._closed:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout=10)
+        self._closed = True
+        self._maybe_fsync(force=True)
+
+
+_writer = BufferedCSVWriter(
+    worker_log_path if config.LOG_MODE == 'per_worker' else (lambda: config.LOCAL_LOG_FILE),
+    queue_size=config.LOG_QUEUE_SIZE,
+    batch_size=config.LOG_BATCH_SIZE,
+    flush_interval=config.LOG_FLUSH_INTERVAL,
+    fsync_interval=config.LOG_FSYNC_INTERVAL
+)
+atexit.register(_writer.close)
+
+
 def setup_local_csv_logging():
     """Checks if the local CSV log file exists and creates it with a header if not."""
-    
+
     global LOGGING_DISABLED
 
     if LOGGING_DISABLED:
         return # Do nothing
 
-    if not os.path.exists(config.LOCAL_LOG_FILE):
-        try:
-            with open(config.LOCAL_LOG_FILE, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(LOG_HEADER)
-            print(f"Created local log file: {config.LOCAL_LOG_FILE}")
-        except Exception as e:
-            print(f"Error creating local log file (check permissions): {e}")
-            print("--- Logging will be disabled for this session. ---")
-            # Disable logging for this session if we can't create the file
-            LOGGING_DISABLED = True
+    try:
+        _write_header_if_missing(config.LOCAL_LOG_FILE)
+    except Exception as e:
+        print(f"Error creating local log file (check permissions): {e}")
+        print("--- Logging will be disabled for this session. ---")
+        # Disable logging for this session if we can't create the file
+        LOGGING_DISABLED = True
 
 
+@metrics.timed('log_to_csv')
 def log_to_csv(payload):
-    """Appends a new row to the local CSV file."""
+    """Queues a new row for the local CSV file; the write happens in the background."""
     # --- NEW: Check if logging is disabled ---
     if LOGGING_DISABLED:
         return # Do nothing
 
+    _writer.write(payload['row_data'])
+
+
+@metrics.timed('log_to_csv')
+async def log_to_csv_async(payload):
+    """log_to_csv() for the event loop: if the queue is full, the row is written on a worker thread."""
+    if LOGGING_DISABLED:
+        return
+
+    if not _writer.try_write(payload['row_data']):
+        print("Log queue is full; writing row from a worker thread.")
+        await asyncio.to_thread(_writer._write_batch, [payload['row_data']])
+
+
+def flush_logs():
+    """Writes out every queued row now (e.g. before reading the log file)."""
+    _writer.flush()
+
+
+def merge_worker_logs(include_live=False):
+    """
+    Merges per-worker log files into the main log file in timestamp order.
+
+    Files of workers that are still running are skipped unless include_live
+    is set. Each file is renamed before it is read: a live worker whose next
+    batch is still waiting for the lock then sees that the path names a
+    different file and starts a new one, so no row lands in a file that is
+    about to be removed. Merged files are removed. Returns the number of
+    rows merged.
+    """
+    root, ext = os.path.splitext(config.LOCAL_LOG_FILE)
+    # Files renamed by a merge that was interrupted are picked up again
+    paths = sorted(glob.glob(f"{root}.worker-*{ext}{MERGING_SUFFIX}"))
+    for path in sorted(glob.glob(f"{root}.worker-*{ext}")):
+        pid = path[len(root) + len(".worker-"):-len(ext) or None]
+        if not include_live and pid.isdigit() and _process_alive(int(pid)):
+            continue
+        try:
+            os.rename(path, path + MERGING_SUFFIX)
+        except FileNotFoundError:
+            continue
+        paths.append(path + MERGING_SUFFIX)
+
+    if not paths:
+        return 0
+
+    handles = [open(path, newline='', encoding='utf-8') for path in paths]
     try:
-        with open(config.LOCAL_LOG_FILE, 'a', newline='', encoding='utf-8') as f:
-            writer = csv.writer(f)
-            writer.writerow(payload['row_data'])
-    except Exception as e:
-        print(f"Error writing to local CSV file: {e}")
+        readers = []
+        for handle in handles:
+            # Wait for a batch that was being written when the file was renamed
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_SH)
+            reader = csv.reader(handle)
+            next(reader, None)  # Skip each worker file's header
+            readers.append(reader)
+
+        count = 0
+        rotated = None
+        with _open_locked(config.LOCAL_LOG_FILE) as out:
+            writer = csv.writer(out)
+            # Each worker file is already in time order, so a k-way merge is enough
+            for row in heapq.merge(*readers, key=lambda r: r[0] if r else ""):
+                writer.writerow(row)
+                count += 1
+            out.flush()
+            os.fsync(out.fileno())
+            rotated = _maybe_rotate(out, config.LOCAL_LOG_FILE)
+            _unlock(out)
+    finally:
+        for handle in handles:
+            handle.close()
+
+    for path in paths:
+        os.remove(path)
+    if rotated:
+        _finish_rotation(rotated)
+    return count
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+metrics.describe('tutor_log_rotations_total', "Times the main CSV log was rotated.")
+
 
 def get_log_payload(session_id, question, answer, scores, signals, time_taken, evaluation, fallout=False):
     """Prepares the data row for logging."""
@@ -67,4 +499,3 @@ def get_log_payload(session_id, question, answer, scores, signals, time_taken, e
         final, time_taken, uncertainty, concept_gap, persona, evaluation, fallout
     ]
     return {"row_data": row_data}
-
@@ -2,116 +2,243 @@
 import requests
 import json
 import config
+import answer_cache
+import llm_client
+import metrics
+import prompts
+from pregrader import pregrade
 
-def get_llm_response(prompt, force_json=False):
+metrics.describe('tutor_llm_errors_total', "LLM calls that failed, by kind (http, network, unavailable, format).")
+metrics.describe('tutor_grader_json_fallbacks_total', "Grader replies that were not valid JSON (SAFETY NET path).")
+metrics.describe('tutor_local_grades_total', "Answers graded locally by the pregrader without an LLM call.")
+
+class LLMStreamError(Exception):
+    """A streamed response failed or was cut off; the chunks received so far are incomplete."""
+
+def _api_key_missing():
+    return not config.API_KEY or config.API_KEY == 'YOUR_GEMINI_API_KEY_HERE'
+
+def _build_payload(prompt, force_json=False):
+    # Basic payload
+    payload = {
+        "contents": [{"parts": [{"text": prompt}]}]
+    }
+
+    # --- Force JSON Mode ---
+    if force_json:
+        payload["generationConfig"] = {"response_mime_type": "application/json"}
+    return payload
+
+def _extract_text(result):
+    """Pulls the text out of a generateContent reply, or returns a JSON error string."""
+    if 'candidates' in result and result['candidates']:
+        content = result['candidates'][0].get('content', {})
+        if 'parts' in content and content['parts']:
+            return content['parts'][0].get('text', '{"error": "No text part in response"}')
+    metrics.inc('tutor_llm_errors_total', kind='format')
+    return '{"error": "Invalid LLM API response format"}'
+
+def _chunk_texts(result):
+    """Yields the text parts of one streamed (SSE) reply."""
+    for candidate in result.get('candidates', [])[:1]:
+        for part in candidate.get('content', {}).get('parts', []):
+            if part.get('text'):
+                yield part['text']
+
+def _http_error(error_details):
+    print(f"API request failed with details: {error_details}")
+    metrics.inc('tutor_llm_errors_total', kind='http')
+    error_payload = {"error": "API request failed", "details": error_details}
+    return json.dumps(error_payload)
+
+def _unavailable_error(e):
+    print(f"LLM call skipped: {e}")
+    metrics.inc('tutor_llm_errors_total', kind='unavailable')
+    return json.dumps({"error": "LLM temporarily unavailable", "details": str(e)})
+
+def _network_error(e):
+    print(f"A network or other error occurred: {e}")
+    metrics.inc('tutor_llm_errors_total', kind='network')
+    error_payload = {"error": "Network or other error", "details": str(e)}
+    return json.dumps(error_payload)
+
+def _call_kind(force_json):
+    # JSON calls are the grader's; plain text ones are the tutor's
+    return 'grader' if force_json else 'text'
+
+def get_llm_response(prompt, force_json=False, hedge=False):
     """
     Sends a prompt to the Gemini API and returns the text response.
     
     Args:
         prompt (str): The text prompt to send.
         force_json (bool): If True, instructs the API to output strictly valid JSON.
+        hedge (bool): If True, sends a duplicate call when the first one is slow
+            (see llm_client.post_json_hedged). Meant for short grading calls.
+
+    Identical prompts already in flight share one call (llm_client.coalesced).
     """
     # Check if API Key is loaded (either from Env Var or settings.ini)
-    if not config.API_KEY or config.API_KEY == 'YOUR_GEMINI_API_KEY_HERE':
+    if _api_key_missing():
         return '{"error": "API Key is missing. Check settings.ini or environment variables."}'
-    
-    api_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-flash-latest:generateContent?key={config.API_KEY}"
-    headers = {'Content-Type': 'application/json'}
-    
-    # Basic payload
-    payload = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
 
-    # --- Force JSON Mode ---
-    if force_json:
-        payload["generationConfig"] = {"response_mime_type": "application/json"}
+    return llm_client.coalesced(['generateContent', prompt, force_json], lambda: _request_text(prompt, force_json, hedge))
+
+def _request_text(prompt, force_json, hedge):
+    api_url = llm_client.build_url()
+    payload = _build_payload(prompt, force_json)
     
     try:
-        response = requests.post(api_url, headers=headers, json=payload, timeout=45)
-        response.raise_for_status()
-        result = response.json()
-    
-        if 'candidates' in result and result['candidates']:
-            content = result['candidates'][0].get('content', {})
-            if 'parts' in content and content['parts']:
-                return content['parts'][0].get('text', '{"error": "No text part in response"}')
-        return '{"error": "Invalid LLM API response format"}'
-    except requests.exceptions.HTTPError as e:
-        error_details = e.response.text
-        print(f"API request failed with details: {error_details}")
-        error_payload = {"error": "API request failed", "details": error_details}
-        return json.dumps(error_payload)
+        if hedge:
+            response = llm_client.post_json_hedged(api_url, payload)
+        else:
+            response = llm_client.post_json(api_url, payload)
+        if response.status_code >= 400:
+            return _http_error(response.text)
+        text = _extract_text(response.json())
+        prompts.record_call(_call_kind(force_json), prompt, text)
+        return text
+    except llm_client.LLMUnavailableError as e:
+        return _unavailable_error(e)
     except Exception as e:
-        print(f"A network or other error occurred: {e}")
-        error_payload = {"error": "Network or other error", "details": str(e)}
-        return json.dumps(error_payload)
+        return _network_error(e)
 
-def evaluate_answer(concept, ground_truth, user_answer, difficulty):
-    """Evaluates the user's answer and returns a parsed JSON object."""
-    
-    # --- DIFFICULTY SETTINGS ---
-    if difficulty == "Strict":
-        system_role = "You are a strict academic professor grading a university exam."
-        leniency_instruction = "Deduct points for any missing technical details, lack of precision, or informal language."
-    elif difficulty == "Easy":
-        system_role = "You are a supportive middle-school tutor."
-        leniency_instruction = (
-            "EXTREME LENIENCY MODE ENABLED:\n"
-            "1. CONTEXT ASSUMPTION: If the student provides a correct GENERAL definition, COUNT IT AS 100% CORRECT.\n"
-            "2. NO NITPICKING: Ignore spelling/grammar.\n"
-            "3. ENCOURAGEMENT: Focus entirely on what they got RIGHT."
-        )
-    else: # Normal
-        system_role = "You are a fair high-school teacher."
-        leniency_instruction = "Balance precision with understanding. Award high points for the core concept, but require some specific details for a perfect score."
-
-    eval_prompt = f"""
-**Role:** {system_role}
-
-**Task:** Evaluate a student's answer against a Ground Truth definition.
-
-**Context:**
-- Topic: "{concept}"
-- Student's Answer: "{user_answer}"
-- Ground Truth (Reference Material): "{ground_truth}"
-- Grading Mode: "{difficulty}"
-
-**Grading Instructions:**
-1. {leniency_instruction}
-2. **Correctness (0-50):** How factually accurate is the answer?
-3. **Explanation (0-50):** Did they use their own words?
-4. **Feedback:** Write a helpful evaluation. Start with the score.
-5. **REDUNDANCY BLOCKER (CRITICAL):** - If the student scores less than 30 points OR says "I don't know":
-   - **DO NOT** explain the concept in the `evaluation_text`. 
-   - **DO NOT** give the definition.
-   - ONLY say "Thanks for your honesty" or "Good effort" and mention that a helpful explanation is coming up next. Keep it under 20 words.
-   - *Reason:* The system will display a separate Remediation card immediately after this, so your explanation would be repetitive.
-
-**CRITICAL LOGIC FOR FOLLOW-UP QUESTIONS:**
-- **Constraint:** If the student is simply answering the quiz question (even incorrectly), set 'follow_up_question' to "None".
-- **Prevention:** Do NOT infer a question. If they didn't ask, the value MUST be "None".
-
-**JSON Output Format:**
-{{
-  "scores": {{
-    "correctness": <int>,
-    "explanation": <int>,
-    "bonus": <0 or 5>,
-    "final": <int>
-  }},
-  "signals": {{
-    "correctness_explanation_gap": <bool>,
-    "uncertainty_detected": <bool>,
-    "persona": "<string>"
-  }},
-  "evaluation_text": "<string starting with '**Scores: ...**'>",
-  "follow_up_question": "<string or 'None'>"
-}}
+async def get_llm_response_async(prompt, force_json=False, hedge=False):
+    """get_llm_response() for the ASGI server: awaits the API instead of blocking a thread."""
+    if _api_key_missing():
+        return '{"error": "API Key is missing. Check settings.ini or environment variables."}'
+
+    return await llm_client.coalesced_async(['generateContent', prompt, force_json],
+                                            lambda: _request_text_async(prompt, force_json, hedge))
+
+async def _request_text_async(prompt, force_json, hedge):
+    api_url = llm_client.build_url()
+    payload = _build_payload(prompt, force_json)
+
+    try:
+        if hedge:
+            response = await llm_client.async_post_json_hedged(api_url, payload)
+        else:
+            response = await llm_client.async_post_json(api_url, payload)
+        if response.status_code >= 400:
+            return _http_error(response.text)
+        text = _extract_text(response.json())
+        prompts.record_call(_call_kind(force_json), prompt, text)
+        return text
+    except llm_client.LLMUnavailableError as e:
+        return _unavailable_error(e)
+    except Exception as e:
+        return _network_error(e)
+
+def stream_llm_response(prompt):
     """
-    
-    raw_response = get_llm_response(eval_prompt, force_json=True)
-    
+    Streams a text response from the Gemini API as it is generated.
+
+    Yields text chunks in order. On any failure the error is printed and
+    LLMStreamError is raised, even after some chunks were yielded, so
+    callers never mistake a cut-off reply for a complete one.
+    """
+    if _api_key_missing():
+        print("Streaming skipped: API Key is missing.")
+        return
+
+    # alt=sse makes Gemini send one server-sent event per partial response
+    api_url = llm_client.build_url('streamGenerateContent') + "&alt=sse"
+    payload = _build_payload(prompt)
+
+    received = []
+    try:
+        with llm_client.post_json(api_url, payload, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data:'):
+                    continue
+                for text in _chunk_texts(json.loads(line[len('data:'):])):
+                    received.append(text)
+                    yield text
+    except requests.exceptions.HTTPError as e:
+        print(f"Streaming API request failed with details: {e.response.text}")
+        metrics.inc('tutor_llm_errors_total', kind='http')
+        raise LLMStreamError(f"HTTP {e.response.status_code}") from e
+    except Exception as e:
+        print(f"A network or other error occurred while streaming: {e}")
+        metrics.inc('tutor_llm_errors_total', kind='network')
+        raise LLMStreamError(str(e)) from e
+    prompts.record_call('stream', prompt, "".join(received))
+
+async def stream_llm_response_async(prompt):
+    """Async version of stream_llm_response(); same chunks, same error behaviour."""
+    if _api_key_missing():
+        print("Streaming skipped: API Key is missing.")
+        return
+
+    api_url = llm_client.build_url('streamGenerateContent') + "&alt=sse"
+    payload = _build_payload(prompt)
+
+    received = []
+    try:
+        response = await llm_client.async_post_json(api_url, payload, stream=True)
+    except Exception as e:
+        print(f"A network or other error occurred while streaming: {e!r}")
+        metrics.inc('tutor_llm_errors_total', kind='network')
+        raise LLMStreamError(str(e)) from e
+    try:
+        if response.status_code >= 400:
+            await response.aread()
+            print(f"Streaming API request failed with details: {response.text}")
+            metrics.inc('tutor_llm_errors_total', kind='http')
+            raise LLMStreamError(f"HTTP {response.status_code}")
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith('data:'):
+                    continue
+                for text in _chunk_texts(json.loads(line[len('data:'):])):
+                    received.append(text)
+                    yield text
+        except Exception as e:
+            print(f"A network or other error occurred while streaming: {e!r}")
+            metrics.inc('tutor_llm_errors_total', kind='network')
+            raise LLMStreamError(str(e)) from e
+    finally:
+        await response.aclose()
+    prompts.record_call('stream', prompt, "".join(received))
+
+def fallback_evaluation():
+    """The zero-score result used when the grader's reply can't be parsed."""
+    metrics.inc('tutor_grader_json_fallbacks_total')
+    return {
+        "scores": {
+            "correctness": 0,
+            "explanation": 0,
+            "bonus": 0,
+            "final": 0
+        },
+        "signals": {
+            "correctness_explanation_gap": False,
+            "uncertainty_detected": False,
+            "persona": "N/A"
+        },
+        "evaluation_text": "**Technical Glitch:** I had a little trouble reading your answer. Let's try the next one!",
+        "follow_up_question": "None",
+        "grading_failed": True
+    }
+
+def _local_grade(concept, ground_truth, user_answer, difficulty):
+    # Non-answers don't need the LLM.
+    if config.PREGRADER_ENABLED:
+        local_result = pregrade(concept, ground_truth, user_answer, difficulty)
+        if local_result is not None:
+            metrics.inc('tutor_local_grades_total')
+            return local_result
+    # Neither do answers with the same words as one graded before.
+    return answer_cache.lookup(concept, ground_truth, user_answer, difficulty)
+
+def build_evaluation_prompt(concept, ground_truth, user_answer, difficulty):
+    """Builds the grading prompt for one answer (see prompts.py for the template and size budgets)."""
+    return prompts.grader_prompt(concept, ground_truth, user_answer, difficulty)
+
+def parse_evaluation(raw_response):
+    """Parses the grader's JSON reply, falling back to the SAFETY NET result."""
     try:
         # Attempt to parse the JSON directly
         return json.loads(raw_response)
@@ -121,18 +248,32 @@ def evaluate_answer(concept, ground_truth, user_answer, difficulty):
         print(f"Raw output was: {raw_response}")
         
         # --- SAFETY NET ---
-        return {
-            "scores": {
-                "correctness": 0,
-                "explanation": 0,
-                "bonus": 0,
-                "final": 0
-            },
-            "signals": {
-                "correctness_explanation_gap": False,
-                "uncertainty_detected": False,
-                "persona": "N/A"
-            },
-            "evaluation_text": "**Technical Glitch:** I had a little trouble reading your answer. Let's try the next one!",
-            "follow_up_question": "None"
-        }
+        return fallback_evaluation()
+
+@metrics.timed('evaluate_answer')
+def evaluate_answer(concept, ground_truth, user_answer, difficulty):
+    """Evaluates the user's answer and returns a parsed JSON object."""
+
+    # --- LOCAL FAST PATH ---
+    local_result = _local_grade(concept, ground_truth, user_answer, difficulty)
+    if local_result is not None:
+        return local_result
+
+    eval_prompt = build_evaluation_prompt(concept, ground_truth, user_answer, difficulty)
+    raw_response = get_llm_response(eval_prompt, force_json=True, hedge=True)
+    evaluation = parse_evaluation(raw_response)
+    answer_cache.store(concept, ground_truth, user_answer, difficulty, evaluation)
+    return evaluation
+
+@metrics.timed('evaluate_answer')
+async def evaluate_answer_async(concept, ground_truth, user_answer, difficulty):
+    """Async version of evaluate_answer() for the ASGI server."""
+    local_result = _local_grade(concept, ground_truth, user_answer, difficulty)
+    if local_result is not None:
+        return local_result
+
+    eval_prompt = build_evaluation_prompt(concept, ground_truth, user_answer, difficulty)
+    raw_response = await get_llm_response_async(eval_prompt, force_json=True, hedge=True)
+    evaluation = parse_evaluation(raw_response)
+    answer_cache.store(concept, ground_truth, user_answer, difficulty, evaluation)
+    return evaluation
@@ -1,35 +1,130 @@
 # knowledge_base.py: Loads and manages the content from the lesson file.
 
+import hashlib
+import marshal
 import os
 import random
 import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
 import config
 
-# Global variable to store the loaded concepts
-_KNOWLEDGE_BASE = []
+# Markers that start a concept name and its description. Matched anywhere
+# in a line, case-insensitively, like the original whole-file regex.
+_TOPIC_MARKER = re.compile(r"Topic:", re.IGNORECASE)
+_ANSWER_MARKER = re.compile(r"Answer:", re.IGNORECASE)
+
+def iter_lesson_blocks(lines):
+    """
+    Streams (concept, description) pairs from an iterable of lesson lines.
+
+    Works line by line, so a lesson file never has to be read into a single
+    string. A block runs from "Topic:" to "Answer:" (the concept) and from
+    there to the next "Topic:" or the end of the input (the description).
+    """
+    state = None  # None before the first Topic:, then 'topic' or 'answer'
+    topic_parts, answer_parts = [], []
+
+    for line in lines:
+        pos = 0
+        while True:
+            marker = _ANSWER_MARKER if state == 'topic' else _TOPIC_MARKER
+            found = marker.search(line, pos)
+            end = found.start() if found else len(line)
+            if state == 'topic':
+                topic_parts.append(line[pos:end])
+            elif state == 'answer':
+                answer_parts.append(line[pos:end])
+            if not found:
+                break
+
+            if state == 'answer':
+                yield "".join(topic_parts).strip(), "".join(answer_parts).strip()
+            if state == 'topic':
+                state = 'answer'
+            else:
+                state = 'topic'
+                topic_parts, answer_parts = [], []
+            pos = found.end()
+
+    if state == 'answer':
+        yield "".join(topic_parts).strip(), "".join(answer_parts).strip()
+
+def parse_lesson_file(file_path):
+    """Parses a lesson file into a list of {"concept", "description"} dicts."""
+    knowledge_base = []
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for concept, description in iter_lesson_blocks(f):
+            if concept and description:
+                knowledge_base.append({"concept": concept, "description": description})
+    return knowledge_base
+
+# --- Compiled Lesson Cache ---
+# Parsed lessons are saved in config.LESSON_CACHE_DIR as marshal files named
+# after the SHA-256 of the lesson text. Every worker (and every restart)
+# loads that file instead of re-parsing, and an edited lesson gets a new
+# hash, so stale entries are never used.
+
+_CACHE_FORMAT_VERSION = 1
+
+def _file_digest(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _compiled_path(digest):
+    return os.path.join(config.LESSON_CACHE_DIR, f"{digest}.kbc")
+
+def _read_compiled(path):
+    try:
+        with open(path, 'rb') as f:
+            version, pairs = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != _CACHE_FORMAT_VERSION:
+        return None
+    return [{"concept": concept, "description": description} for concept, description in pairs]
+
+def _write_compiled(path, knowledge_base):
+    pairs = [(item["concept"], item["description"]) for item in knowledge_base]
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file and rename, so other workers never see a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            marshal.dump((_CACHE_FORMAT_VERSION, pairs), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not write compiled lesson cache '{path}': {e}")
+
+def compile_lesson(file_path):
+    """Parses a lesson and stores it in the compiled cache; returns the parsed topics."""
+    knowledge_base = parse_lesson_file(file_path)
+    if knowledge_base:
+        _write_compiled(_compiled_path(_file_digest(file_path)), knowledge_base)
+    return knowledge_base
 
 def load_and_parse_kb(file_path):
     """
     Loads a text file and parses it into a list of dictionaries.
+
+    Uses the compiled lesson cache when it has an entry for this exact file
+    content; otherwise parses the file and adds it to the cache.
     """
     if not os.path.exists(file_path):
         print(f"Error: Knowledge base file not found at '{file_path}'")
         return []
-        
-    knowledge_base = []
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
-    
-    # Regex to find Topic/Answer blocks.
-    pattern = re.compile(r"Topic:\s*(.*?)\s*Answer:\s*(.*?)(?=\s*Topic:|\Z)", re.DOTALL | re.IGNORECASE)
-    
-    matches = pattern.findall(content)
-    
-    for match in matches:
-        concept = match[0].strip()
-        description = match[1].strip()
-        if concept and description:
-            knowledge_base.append({"concept": concept, "description": description})
+
+    if config.LESSON_CACHE_ENABLED:
+        knowledge_base = _read_compiled(_compiled_path(_file_digest(file_path)))
+        if knowledge_base is None:
+            knowledge_base = compile_lesson(file_path)
+    else:
+        knowledge_base = parse_lesson_file(file_path)
             
     if not knowledge_base:
         print("Warning: Could not parse any topics from the lesson file. Check the format.")
@@ -38,39 +133,225 @@ def load_and_parse_kb(file_path):
 
 def load_kb():
     """
-    Loads the knowledge base from the file specified in config.
+    Loads the default lesson (the file specified in config) at startup.
+
+    Lesson content is always read through the lesson registry below, so a
+    hot reload is seen by every caller; other lessons load on first use.
     """
-    global _KNOWLEDGE_BASE
-    kb_path = getattr(config, 'KB_FILE_PATH', 'LessonAILiteracy.txt')
-    _KNOWLEDGE_BASE = load_and_parse_kb(kb_path)
-    
+    _registry.get(DEFAULT_LESSON_ID)
+
+def build_concept_index(knowledge_base):
+    """Maps each lowercase concept name to its index (first occurrence wins)."""
+    index = {}
+    for i, item in enumerate(knowledge_base):
+        index.setdefault(item["concept"].lower(), i)
+    return index
 
-def get_concept_list():
+# --- Lesson Registry ---
+# Lessons are the *.txt files in config.LESSONS_DIR, identified by file name
+# without the extension (e.g. "LessonAILiteracy"). Each one is parsed the
+# first time it is used, kept in an LRU of at most config.MAX_LOADED_LESSONS,
+# and re-parsed when its modification time changes. Sessions store question
+# indices, so each lesson has a version derived from its concept names and
+# the registry remembers the concept names of recent versions; a session
+# from before a reload is remapped by concept name (see
+# session_store.QuizSession).
+
+# Earlier lesson versions whose concept names are kept for remapping.
+MAX_LESSON_VERSIONS = 64
+
+DEFAULT_LESSON_ID = os.path.splitext(os.path.basename(config.KB_FILE_PATH))[0]
+
+# Lesson ids come from requests, so only allow plain file names.
+_LESSON_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+def concept_keys(knowledge_base):
+    """The lowercase concept names of a lesson, in file order."""
+    return tuple(item["concept"].lower() for item in knowledge_base)
+
+def lesson_version(keys):
+    """A number that changes whenever concepts are added, removed or reordered."""
+    return zlib.crc32("\n".join(keys).encode('utf-8'))
+
+class Lesson:
+    """One parsed lesson file and its concept index."""
+
+    def __init__(self, lesson_id, path, items, mtime):
+        self.lesson_id = lesson_id
+        self.path = path
+        self.items = items
+        self.concept_index = build_concept_index(items)
+        self.keys = concept_keys(items)
+        # Question indices stored in sessions are only valid for this version
+        self.version = lesson_version(self.keys)
+        self.mtime = mtime
+        self.checked_at = time.monotonic()
+
+class LessonRegistry:
+    """Lazily loads, caches and hot-reloads lesson files by lesson id."""
+
+    def __init__(self, lessons_dir, max_loaded, check_interval):
+        self.lessons_dir = lessons_dir
+        self.max_loaded = max_loaded
+        self.check_interval = check_interval
+        self._lessons = OrderedDict()  # lesson_id -> Lesson, least recently used first
+        self._versions = OrderedDict()  # (lesson_id, version) -> concept keys, so sessions can be remapped after a reload
+        self._lock = threading.Lock()
+
+    def path_for(self, lesson_id):
+        """Returns the file for a lesson id, or None if the id is invalid or unknown."""
+        if lesson_id == DEFAULT_LESSON_ID:
+            return config.KB_FILE_PATH
+        if not lesson_id or not _LESSON_ID_PATTERN.match(lesson_id):
+            return None
+        path = os.path.join(self.lessons_dir, lesson_id + '.txt')
+        return path if os.path.isfile(path) else None
+
+    def lesson_ids(self):
+        """Lists every available lesson id without parsing any file."""
+        ids = {DEFAULT_LESSON_ID}
+        if os.path.isdir(self.lessons_dir):
+            for name in os.listdir(self.lessons_dir):
+                stem, ext = os.path.splitext(name)
+                if ext == '.txt' and _LESSON_ID_PATTERN.match(stem):
+                    ids.add(stem)
+        return sorted(ids)
+
+    def get(self, lesson_id):
+        """Returns the Lesson for an id, loading or reloading it as needed, or None."""
+        with self._lock:
+            lesson = self._lessons.get(lesson_id)
+            if lesson is not None:
+                self._lessons.move_to_end(lesson_id)
+                # Only stat the file every check_interval seconds
+                if time.monotonic() - lesson.checked_at < self.check_interval:
+                    return lesson
+
+            path = self.path_for(lesson_id)
+            if path is None:
+                self._lessons.pop(lesson_id, None)
+                return None
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                self._lessons.pop(lesson_id, None)
+                return None
+
+            if lesson is not None and lesson.mtime == mtime:
+                lesson.checked_at = time.monotonic()
+                return lesson
+
+            if lesson is not None:
+                print(f"Lesson '{lesson_id}' changed on disk; reloading.")
+            lesson = Lesson(lesson_id, path, load_and_parse_kb(path), mtime)
+            self._versions[(lesson_id, lesson.version)] = lesson.keys
+            self._versions.move_to_end((lesson_id, lesson.version))
+            while len(self._versions) > MAX_LESSON_VERSIONS:
+                self._versions.popitem(last=False)
+            self._lessons[lesson_id] = lesson
+            self._lessons.move_to_end(lesson_id)
+            while len(self._lessons) > self.max_loaded:
+                self._lessons.popitem(last=False)
+            return lesson
+
+    def concepts_for_version(self, lesson_id, version):
+        """Returns the concept keys of an earlier version of a lesson, or None if this worker never loaded it."""
+        with self._lock:
+            return self._versions.get((lesson_id or DEFAULT_LESSON_ID, version))
+
+_registry = LessonRegistry(config.LESSONS_DIR, config.MAX_LOADED_LESSONS, config.LESSON_RELOAD_INTERVAL)
+
+def get_lesson(lesson_id=None):
+    """Returns the Lesson for an id (default lesson if None), or None if it doesn't exist."""
+    return _registry.get(lesson_id or DEFAULT_LESSON_ID)
+
+def lesson_concepts(lesson_id, version):
+    """Returns the concept keys a lesson had at an earlier version, or None if unknown."""
+    return _registry.concepts_for_version(lesson_id, version)
+
+def get_lesson_ids():
+    """Returns the ids of every lesson that can be served."""
+    return _registry.lesson_ids()
+
+def _items(lesson_id):
+    lesson = get_lesson(lesson_id)
+    return lesson.items if lesson else []
+
+def get_concept_list(lesson_id=None):
     """Returns a list of all concept names (topics)."""
-    return [item["concept"] for item in _KNOWLEDGE_BASE]
+    return [item["concept"] for item in _items(lesson_id)]
 
-def get_ground_truth(concept_name):
+def get_ground_truth(concept_name, lesson_id=None):
     """Finds a concept by its name and returns its description."""
-    for item in _KNOWLEDGE_BASE:
-        if item["concept"].lower() == concept_name.lower():
-            return item["description"]
+    lesson = get_lesson(lesson_id)
+    index = lesson.concept_index.get(concept_name.lower()) if lesson else None
+    if index is not None:
+        return lesson.items[index]["description"]
     return f"No ground truth found for concept: {concept_name}"
 
-def get_random_question(asked_indices):
-    """Selects a random, unasked question from the loaded knowledge base."""
-    global _KNOWLEDGE_BASE
+# --- Per-Session Question Order ---
+# Each session has its own random seed and remembers the indices it has
+# been asked as bits of one integer, plus a cursor into its order, so a
+# session record holds three numbers instead of a list of indices. The k-th
+# question of a seed's order is computed directly by a small keyed
+# permutation (a Feistel network over the next even power of two, walked
+# until it lands inside the lesson), so picking the next question costs the
+# same for a 20-topic lesson as for a 2000-topic one; nothing is shuffled
+# or cached.
+
+_MASK64 = (1 << 64) - 1
+_FEISTEL_ROUNDS = 4
 
-    if not _KNOWLEDGE_BASE:
-        print("Error: get_random_question called but _KNOWLEDGE_BASE is empty.")
-        return None, None, -1
+def new_question_seed():
+    """Returns the seed that fixes a new session's question order."""
+    return random.getrandbits(32)
 
-    available_indices = [i for i, _ in enumerate(_KNOWLEDGE_BASE) if i not in asked_indices]
+def _round_value(seed, round_number, value):
+    """splitmix64 of (seed, round, value): the Feistel round function."""
+    x = (value + seed * 0x9E3779B97F4A7C15 + round_number * 0xD1B54A32D192ED03) & _MASK64
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return x ^ (x >> 31)
 
-    if not available_indices:
-        # All questions have been asked
-        return None, None, -1
+def question_at_position(seed, position, count):
+    """Returns the index of the question at a position (0..count-1) of the seed's order."""
+    half = max(1, ((count - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    x = position
+    while True:
+        left, right = x >> half, x & mask
+        for round_number in range(_FEISTEL_ROUNDS):
+            left, right = right, left ^ (_round_value(seed, round_number, right) & mask)
+        x = (left << half) | right
+        # The permutation covers 2**(2*half) >= count values; follow the cycle back into range
+        if x < count:
+            return x
 
-    random_index = random.choice(available_indices)
-    item = _KNOWLEDGE_BASE[random_index]
+def question_order(seed, count):
+    """Returns the question indices of a count-question lesson in the seed's order."""
+    return [question_at_position(seed, position, count) for position in range(count)]
+
+def next_question(seed, asked, lesson, position=0):
+    """
+    Returns (concept, description, index, position) of the first question of
+    a Lesson at or after position in the seed's order that is not in the
+    asked bitset. Questions are asked in order, so this is normally the
+    question at position itself.
+    """
+    items = lesson.items if lesson else []
+    count = len(items)
+    while position < count:
+        index = question_at_position(seed, position, count)
+        if not asked >> index & 1:
+            item = items[index]
+            return item.get('concept'), item.get('description'), index, position
+        position += 1
+    # All questions have been asked
+    return None, None, -1, count
 
-    return item.get('concept'), item.get('description'), random_index
+def question_at(index, lesson):
+    """Returns (concept, description) of a question index in a Lesson, or (None, None) if there is none."""
+    items = lesson.items if lesson else []
+    if 0 <= index < len(items):
+        return items[index].get('concept'), items[index].get('description')
+    return None, None
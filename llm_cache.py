@@ -0,0 +1,216 @@
+# llm_cache.py: Content-addressed cache for LLM responses that only depend on lesson content.
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import config
+import metrics
+
+metrics.describe('tutor_llm_cache_lookups_total', "Hint/remediation cache lookups by result.")
+
+
+def make_key(kind, prompt, *parts):
+    """Hashes the prompt and the content it was built from into a cache key."""
+    digest = hashlib.sha256()
+    for piece in (kind, prompt) + parts:
+        digest.update(str(piece).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def is_error_response(text):
+    """True for the JSON error strings get_llm_response returns on failure."""
+    return not text or text.lstrip().startswith('{"error"')
+
+
+class LLMCache:
+    """
+    Two-level cache: an in-memory LRU in front of a SQLite file.
+
+    The SQLite file is shared by every worker on the machine and survives
+    restarts, so entries generated once (or by the warm-up command) are
+    reused everywhere.
+    """
+
+    def __init__(self, db_path, memory_size=1024):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self):
+        # SQLite connections must not cross a fork, so reconnect per process.
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, kind TEXT, value TEXT, created REAL)"
+            )
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def _remember(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Returns the cached value or None."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                metrics.inc('tutor_llm_cache_lookups_total', result='memory_hit')
+                return self._memory[key]
+            try:
+                row = self._connection().execute(
+                    "SELECT value FROM llm_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                print(f"LLM cache read failed: {e}")
+                row = None
+            if row is None:
+                self.misses += 1
+                metrics.inc('tutor_llm_cache_lookups_total', result='miss')
+                return None
+            self.hits += 1
+            metrics.inc('tutor_llm_cache_lookups_total', result='disk_hit')
+            self._remember(key, row[0])
+            return row[0]
+
+    def put(self, key, kind, value):
+        """Stores a value in memory and on disk."""
+        with self._lock:
+            self._remember(key, value)
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, kind, value, created) VALUES (?, ?, ?, ?)",
+                    (key, kind, value, time.time())
+                )
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"LLM cache write failed: {e}")
+
+    def stats(self):
+        """Returns hit/miss counters for this worker."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+
+# --- Shared Instance ---
+_cache = LLMCache(config.LLM_CACHE_FILE, config.LLM_CACHE_MEMORY_SIZE) if config.LLM_CACHE_ENABLED else None
+
+
+def get_cache():
+    """Returns the shared cache, or None when caching is disabled."""
+    return _cache
+
+
+def cached_call(kind, prompt, parts, generate):
+    """
+    Returns the cached response for this prompt, calling generate() on a miss.
+
+    Args:
+        kind (str): Response type, e.g. 'hint' or 'remediation'.
+        prompt (str): The exact prompt sent to the LLM.
+        parts (tuple): The content the prompt was built from (concept, ground truth).
+        generate (callable): Produces the response when it is not cached.
+
+    Error responses are returned but never cached.
+    """
+    if _cache is None:
+        return generate()
+
+    key = make_key(kind, prompt, *parts)
+    value = _cache.get(key)
+    if value is not None:
+        return value
+
+    value = generate()
+    if not is_error_response(value):
+        _cache.put(key, kind, value)
+    return value
+
+
+def cached_stream(kind, prompt, parts, stream):
+    """
+    Streaming counterpart of cached_call.
+
+    Yields the cached response as a single chunk on a hit. On a miss it
+    yields chunks from stream() as they arrive and caches the joined text
+    once the stream completes. A stream that raises (or is abandoned by the
+    caller) is not cached, so a cut-off reply is never served again.
+    """
+    if _cache is None:
+        yield from stream()
+        return
+
+    key = make_key(kind, prompt, *parts)
+    value = _cache.get(key)
+    if value is not None:
+        yield value
+        return
+
+    chunks = []
+    for chunk in stream():
+        chunks.append(chunk)
+        yield chunk
+    value = "".join(chunks)
+    if not is_error_response(value):
+        _cache.put(key, kind, value)
+
+
+# --- Async Variants (asgi_app.py) ---
+# Same behaviour, with the SQLite lookups and writes moved off the event loop.
+
+async def cached_call_async(kind, prompt, parts, generate):
+    """cached_call() where generate() returns an awaitable."""
+    if _cache is None:
+        return await generate()
+
+    key = make_key(kind, prompt, *parts)
+    value = await asyncio.to_thread(_cache.get, key)
+    if value is not None:
+        return value
+
+    value = await generate()
+    if not is_error_response(value):
+        await asyncio.to_thread(_cache.put, key, kind, value)
+    return value
+
+
+async def cached_stream_async(kind, prompt, parts, stream):
+    """cached_stream() where stream() returns an async iterator."""
+    if _cache is None:
+        async for chunk in stream():
+            yield chunk
+        return
+
+    key = make_key(kind, prompt, *parts)
+    value = await asyncio.to_thread(_cache.get, key)
+    if value is not None:
+        yield value
+        return
+
+    chunks = []
+    async for chunk in stream():
+        chunks.append(chunk)
+        yield chunk
+    value = "".join(chunks)
+    if not is_error_response(value):
+        await asyncio.to_thread(_cache.put, key, kind, value)
@@ -0,0 +1,843 @@
+# llm_client.py: Shared, pooled HTTP client for all calls to the Gemini API.
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+import config
+import metrics
+
+# --- Per-Worker Connection Pool ---
+# One requests.Session per process. Keep-alive connections in its pool are
+# reused across calls, so we only pay for TCP + TLS setup once per connection
+# instead of once per LLM call.
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+# --- Latency Counters ---
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+_stats_lock = threading.Lock()
+_stats = {
+    "requests": 0,
+    "errors": 0,
+    "total_seconds": 0.0,
+    "max_seconds": 0.0,
+    "last_seconds": 0.0,
+    "buckets": [0] * len(LATENCY_BUCKETS),
+}
+
+
+def _build_session():
+    """Creates a Session whose adapter keeps up to LLM_POOL_SIZE connections alive."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=config.LLM_POOL_SIZE,
+        pool_block=False
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({'Content-Type': 'application/json', 'Connection': 'keep-alive'})
+    return session
+
+
+def get_session():
+    """Returns this worker's pooled session, creating it on first use (and again after a fork)."""
+    global _session, _session_pid
+
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def build_url(method='generateContent'):
+    """Builds the Gemini endpoint URL for the configured model."""
+    return f"{config.LLM_API_BASE}/models/{config.LLM_MODEL}:{method}?key={config.API_KEY}"
+
+
+# --- Rate Limiting, Retries & Circuit Breaker ---
+# Every call first takes a token from a per-worker token bucket so a class
+# submitting at once is smoothed out instead of bursting into 429s. Calls
+# answered with a retryable status (429/5xx) or a connection error are
+# retried with jittered exponential backoff, and no retry (its backoff and
+# read timeout included) runs past LLM_RETRY_DEADLINE; the first attempt
+# always gets the full read timeout. A 429 also pauses
+# the token bucket, so the whole worker backs off rather than just the one
+# call. After LLM_BREAKER_FAILURES calls in a row fail (a call counts once,
+# however often it was retried; 429s don't count, the API is up) the breaker
+# opens and calls fail immediately for LLM_BREAKER_COOLDOWN seconds, then a
+# single trial call decides whether it closes again.
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+# Shortest read timeout an attempt is sent with, however close the deadline.
+MIN_READ_TIMEOUT = 1.0
+
+
+class LLMUnavailableError(requests.exceptions.RequestException):
+    """Raised instead of calling the API when the breaker is open or no rate-limit token came in time."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, holding at most `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self):
+        """Takes a token if one is available right now."""
+        return self._take() == 0
+
+    def _take(self):
+        """Takes a token and returns 0, or returns the seconds until one is available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """Hands out no tokens for the next `seconds` (the API asked us to slow down)."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def acquire(self, timeout):
+        """Waits up to `timeout` seconds for a token; returns False if none came."""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait_seconds = self._take()
+            if wait_seconds == 0:
+                return True
+            if time.monotonic() + wait_seconds > deadline:
+                return False
+            time.sleep(wait_seconds)
+
+    async def acquire_async(self, timeout):
+        """acquire() for the event loop: waits without blocking other requests."""
+        deadline = time.monotonic() + timeout
+        while True:
+            wait_seconds = self._take()
+            if wait_seconds == 0:
+                return True
+            if time.monotonic() + wait_seconds > deadline:
+                return False
+            await asyncio.sleep(wait_seconds)
+
+
+class CircuitBreaker:
+    """Closed -> open after `failure_threshold` failures in a row -> half-open after `cooldown` seconds."""
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, failure_threshold, cooldown):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if a call may go out now."""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                # Let exactly one trial call through
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def release(self):
+        """Ends a call that said nothing about the API's health; a half-open trial is handed to the next call."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold > 0:
+                if self.state != self.OPEN:
+                    print(f"LLM circuit breaker opened after {self.failures} failures; failing fast for {self.cooldown}s.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+_limiter = TokenBucket(config.LLM_RATE_LIMIT, config.LLM_RATE_BURST) if config.LLM_RATE_LIMIT > 0 else None
+_breaker = CircuitBreaker(config.LLM_BREAKER_FAILURES, config.LLM_BREAKER_COOLDOWN)
+
+metrics.describe('tutor_llm_retries_total', "LLM calls retried, by reason (status code or network).")
+metrics.describe('tutor_llm_rejected_total', "LLM calls not sent, by reason (circuit_open, rate_limited).")
+metrics.describe('tutor_llm_hedges_total', "Hedged grader calls, by outcome (launched, won).")
+metrics.register_gauge('tutor_llm_circuit_state', lambda: _breaker.state,
+                       "LLM circuit breaker state (0 closed, 1 half-open, 2 open).")
+
+
+def _backoff(attempt, response=None):
+    """Full-jitter exponential backoff, honouring a numeric Retry-After header."""
+    if response is not None:
+        try:
+            return min(float(response.headers.get('Retry-After', '')), config.LLM_RETRY_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(config.LLM_RETRY_BACKOFF_MAX, config.LLM_RETRY_BACKOFF * 2 ** attempt))
+
+
+def _read_timeout(attempt, deadline):
+    """
+    The read timeout for an attempt. The first attempt gets the full
+    LLM_READ_TIMEOUT (long batch and replay prompts need it); retries are
+    cut to what is left before the deadline.
+    """
+    if attempt == 0:
+        return config.LLM_READ_TIMEOUT
+    return max(min(config.LLM_READ_TIMEOUT, deadline - time.monotonic()), MIN_READ_TIMEOUT)
+
+
+def _send(url, payload, stream, attempt, deadline):
+    """One HTTP attempt through the pooled session, with its latency recorded."""
+    start = time.perf_counter()
+    failed = True
+    try:
+        response = get_session().post(
+            url,
+            json=payload,
+            timeout=(config.LLM_CONNECT_TIMEOUT, _read_timeout(attempt, deadline)),
+            stream=stream
+        )
+        failed = response.status_code >= 400
+        return response
+    finally:
+        _record_latency(time.perf_counter() - start, failed)
+
+
+def _check_breaker():
+    if not _breaker.allow():
+        metrics.inc('tutor_llm_rejected_total', reason='circuit_open')
+        raise LLMUnavailableError("LLM circuit breaker is open")
+
+
+def _rate_limited():
+    metrics.inc('tutor_llm_rejected_total', reason='rate_limited')
+    return LLMUnavailableError("Timed out waiting for the LLM rate limiter")
+
+
+def _retry_delay(attempt, deadline, reason, response=None):
+    """
+    Returns seconds to wait before retrying a failed attempt, or None to give
+    up: after LLM_MAX_RETRIES retries, when the breaker has opened, or when
+    the wait plus LLM_RETRY_MIN_ATTEMPT seconds for the retry itself would
+    not fit before the deadline.
+    """
+    delay = _backoff(attempt, response)
+    if response is not None and response.status_code == 429 and _limiter is not None:
+        _limiter.pause(delay)
+    if (attempt >= config.LLM_MAX_RETRIES or _breaker.state == CircuitBreaker.OPEN
+            or time.monotonic() + delay + config.LLM_RETRY_MIN_ATTEMPT > deadline):
+        return None
+    metrics.inc('tutor_llm_retries_total', reason=reason)
+    return delay
+
+
+def _record_gave_up(response=None):
+    """Counts a call that ran out of retries against the breaker, unless it was only throttled (429)."""
+    if response is not None and response.status_code == 429:
+        _breaker.release()
+    else:
+        _breaker.record_failure()
+
+
+def post_json(url, payload, stream=False, deadline=None):
+    """
+    POSTs a JSON payload through the pooled session and records its latency.
+
+    Uses separate connect and read timeouts so a dead host fails quickly while
+    a slow generation still has time to finish. Waits for a rate-limit token,
+    retries 429/5xx replies and connection errors with backoff until
+    `deadline` (a time.monotonic() value; defaults to LLM_RETRY_DEADLINE
+    seconds from now), and raises LLMUnavailableError without calling the
+    API while the circuit breaker is open. Otherwise raises the same
+    exceptions as requests.post; the last reply is returned even if it is an
+    error status.
+    """
+    if deadline is None:
+        deadline = time.monotonic() + config.LLM_RETRY_DEADLINE
+    _check_breaker()
+    attempt = 0
+    try:
+        while True:
+            if _limiter is not None and not _limiter.acquire(config.LLM_RATE_LIMIT_WAIT):
+                raise _rate_limited()
+
+            try:
+                response = _send(url, payload, stream, attempt, deadline)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                delay = _retry_delay(attempt, deadline, 'network')
+                if delay is None:
+                    raise
+                print(f"LLM call failed ({e}); retrying in {delay:.1f}s.")
+            else:
+                if response.status_code not in RETRYABLE_STATUSES:
+                    _breaker.record_success()
+                    return response
+                delay = _retry_delay(attempt, deadline, str(response.status_code), response)
+                if delay is None:
+                    _record_gave_up(response)
+                    return response
+                response.close()
+
+            time.sleep(delay)
+            attempt += 1
+    except LLMUnavailableError:
+        _breaker.release()  # Never sent, so it says nothing about the API
+        raise
+    except Exception:
+        _breaker.record_failure()  # Also resolves a half-open trial
+        raise
+
+
+# --- Hedged Requests ---
+# A grading call that has not answered after LLM_HEDGE_DELAY seconds gets a
+# second, identical call; whichever succeeds first wins. Hedges are only
+# sent when a rate-limit token is free right away, so they never add to a
+# throttling problem. The primary and the hedge each start on their own
+# thread at once: a shared fixed-size pool would queue calls during a burst,
+# and the time spent queued would count against hedge_delay and the retry
+# deadline.
+
+def _start_thread(func, *args):
+    """Runs func(*args) on a new daemon thread right away; returns a Future for its result."""
+    future = Future()
+    future.set_running_or_notify_cancel()
+
+    def run():
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name='llm-hedged-call', daemon=True).start()
+    return future
+
+
+def _close_when_done(future):
+    """Releases the connection of a call that lost the race."""
+    def close(f):
+        if not f.cancelled() and f.exception() is None:
+            f.result().close()
+    future.add_done_callback(close)
+
+
+def _send_hedge(url, payload, deadline):
+    """
+    The hedged duplicate: a single attempt. A success closes the breaker and
+    a 429 pauses the limiter; failures are left to the primary call, so a
+    hedged call still counts at most once against the breaker.
+    """
+    response = _send(url, payload, False, 0, deadline)
+    if response.status_code == 429 and _limiter is not None:
+        _limiter.pause(_backoff(0, response))
+    elif response.status_code < 400:
+        _breaker.record_success()
+    return response
+
+
+def post_json_hedged(url, payload):
+    """post_json() for short, latency-sensitive calls (the grader), with one hedged duplicate."""
+    if config.LLM_HEDGE_DELAY <= 0:
+        return post_json(url, payload)
+
+    deadline = time.monotonic() + config.LLM_RETRY_DEADLINE
+    primary = _start_thread(post_json, url, payload, False, deadline)
+    done, _ = wait([primary], timeout=config.LLM_HEDGE_DELAY)
+    if done or _breaker.state != CircuitBreaker.CLOSED or (_limiter is not None and not _limiter.try_acquire()):
+        return primary.result()
+
+    metrics.inc('tutor_llm_hedges_total', outcome='launched')
+    hedge = _start_thread(_send_hedge, url, payload, deadline)
+    pending = {primary, hedge}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().status_code < 400:
+                if future is hedge:
+                    metrics.inc('tutor_llm_hedges_total', outcome='won')
+                for other in pending:
+                    _close_when_done(other)
+                return future.result()
+    # Both failed: report the primary's outcome, which already went through retries
+    if hedge.exception() is None:
+        hedge.result().close()
+    return primary.result()
+
+
+
+# --- Async Client (asgi_app.py) ---
+# The ASGI server awaits LLM calls instead of parking a thread on each one.
+# Calls go out on one httpx.AsyncClient per event loop (keep-alive pool,
+# HTTPS_PROXY/NO_PROXY from the environment) and go through the same rate
+# limiter, retries and circuit breaker as post_json().
+
+_async_clients = {}  # event loop -> httpx.AsyncClient
+
+
+def get_async_client():
+    """Returns the running event loop's HTTP client, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=config.LLM_ASYNC_POOL_SIZE,
+                                max_keepalive_connections=config.LLM_ASYNC_POOL_SIZE),
+            timeout=httpx.Timeout(config.LLM_READ_TIMEOUT, connect=config.LLM_CONNECT_TIMEOUT),
+            headers={'Content-Type': 'application/json'},
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    """Closes the running event loop's client (called at server shutdown)."""
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def iterate_in_thread(iterable):
+    """Iterates a blocking iterable on worker threads, yielding to the event loop between items."""
+    iterator = iter(iterable)
+    done = object()
+    while True:
+        item = await asyncio.to_thread(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+async def _send_async(url, payload, stream, attempt, deadline):
+    start = time.perf_counter()
+    failed = True
+    try:
+        client = get_async_client()
+        timeout = httpx.Timeout(_read_timeout(attempt, deadline), connect=config.LLM_CONNECT_TIMEOUT)
+        request = client.build_request('POST', url, content=json.dumps(payload).encode('utf-8'), timeout=timeout)
+        response = await client.send(request, stream=stream)
+        failed = response.status_code >= 400
+        return response
+    finally:
+        _record_latency(time.perf_counter() - start, failed)
+
+
+async def async_post_json(url, payload, stream=False, deadline=None):
+    """
+    Async post_json(): same rate limiting, retries, deadline and circuit breaker.
+
+    Returns an httpx.Response. With stream=True the caller must close it
+    (`await response.aclose()`).
+    """
+    if deadline is None:
+        deadline = time.monotonic() + config.LLM_RETRY_DEADLINE
+    _check_breaker()
+    attempt = 0
+    try:
+        while True:
+            if _limiter is not None and not await _limiter.acquire_async(config.LLM_RATE_LIMIT_WAIT):
+                raise _rate_limited()
+
+            try:
+                response = await _send_async(url, payload, stream, attempt, deadline)
+            except httpx.TransportError as e:
+                delay = _retry_delay(attempt, deadline, 'network')
+                if delay is None:
+                    raise
+                print(f"LLM call failed ({e!r}); retrying in {delay:.1f}s.")
+            else:
+                if response.status_code not in RETRYABLE_STATUSES:
+                    _breaker.record_success()
+                    return response
+                delay = _retry_delay(attempt, deadline, str(response.status_code), response)
+                if delay is None:
+                    _record_gave_up(response)
+                    return response
+                await response.aclose()
+
+            await asyncio.sleep(delay)
+            attempt += 1
+    except LLMUnavailableError:
+        _breaker.release()
+        raise
+    except asyncio.CancelledError:
+        _breaker.release()  # A losing hedge race, not an API failure
+        raise
+    except Exception:
+        _breaker.record_failure()
+        raise
+
+
+async def _send_hedge_async(url, payload, deadline):
+    """Async _send_hedge()."""
+    response = await _send_async(url, payload, False, 0, deadline)
+    if response.status_code == 429 and _limiter is not None:
+        _limiter.pause(_backoff(0, response))
+    elif response.status_code < 400:
+        _breaker.record_success()
+    return response
+
+
+async def async_post_json_hedged(url, payload):
+    """Async post_json_hedged(); the losing call is cancelled."""
+    if config.LLM_HEDGE_DELAY <= 0:
+        return await async_post_json(url, payload)
+
+    deadline = time.monotonic() + config.LLM_RETRY_DEADLINE
+    primary = asyncio.ensure_future(async_post_json(url, payload, deadline=deadline))
+    done, _ = await asyncio.wait({primary}, timeout=config.LLM_HEDGE_DELAY)
+    if done or _breaker.state != CircuitBreaker.CLOSED or (_limiter is not None and not _limiter.try_acquire()):
+        return await primary
+
+    metrics.inc('tutor_llm_hedges_total', outcome='launched')
+    hedge = asyncio.ensure_future(_send_hedge_async(url, payload, deadline))
+    pending = {primary, hedge}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().status_code < 400:
+                if future is hedge:
+                    metrics.inc('tutor_llm_hedges_total', outcome='won')
+                for other in pending:
+                    other.cancel()
+                return future.result()
+    # Both failed: report the primary's outcome, which already went through retries
+    return primary.result()
+
+
+# --- Request Coalescing (Single-Flight) ---
+# When a class starts a quiz together, many sessions send the same prompt
+# within the same second. While a prompt is in flight, identical calls wait
+# for its result instead of sending their own. Within a worker this is a
+# table of in-flight calls. With coalesce_across_workers, the first worker
+# to claim a prompt in a shared SQLite file makes the call, and the others
+# poll that file for the result (up to coalesce_wait seconds) before calling
+# themselves. Only results that finished after a caller started are
+# shared, so this never serves stale answers the way a cache could.
+
+class _Flight:
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs func() once for concurrent calls with the same key; everyone gets its result."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            metrics.inc('tutor_llm_coalesced_total', scope='worker')
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = func()
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+
+class SharedFlights:
+    """In-flight claims and their results in a SQLite file shared by every worker."""
+
+    POLL_INTERVAL = 0.05
+    KEEP_SECONDS = 60
+
+    def __init__(self, db_path, wait):
+        self.db_path = db_path
+        self.wait = wait
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+
+    def _connection(self):
+        # SQLite connections must not cross a fork, so reconnect per process.
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS inflight ("
+                "key TEXT PRIMARY KEY, owner INTEGER, started REAL, value TEXT, finished REAL)"
+            )
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def claim(self, key, since):
+        """True if this worker should make the call: nobody else is making it, or they gave up."""
+        with self._lock:
+            conn = self._connection()
+            if conn.execute("INSERT OR IGNORE INTO inflight (key, owner, started) VALUES (?, ?, ?)",
+                            (key, os.getpid(), since)).rowcount:
+                return True
+            # Take over a finished call from before we started, or one that ran out of time
+            return bool(conn.execute(
+                "UPDATE inflight SET owner = ?, started = ?, value = NULL, finished = NULL "
+                "WHERE key = ? AND ((finished IS NOT NULL AND finished < ?) OR (finished IS NULL AND started < ?))",
+                (os.getpid(), since, key, since, since - self.wait)
+            ).rowcount)
+
+    def result(self, key, since):
+        """The other worker's result, if it finished after since; else None."""
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value, finished FROM inflight WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, finished = row
+        return value if finished is not None and finished >= since else None
+
+    def finish(self, key, value):
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("UPDATE inflight SET value = ?, finished = ? WHERE key = ? AND owner = ?",
+                         (value, now, key, os.getpid()))
+            if now - self._last_cleanup > self.KEEP_SECONDS:
+                self._last_cleanup = now
+                conn.execute("DELETE FROM inflight WHERE coalesce(finished, started) < ?", (now - self.KEEP_SECONDS,))
+
+    def abandon(self, key):
+        """Drops our claim after a failed call so waiting workers call themselves."""
+        with self._lock:
+            self._connection().execute("DELETE FROM inflight WHERE key = ? AND owner = ?", (key, os.getpid()))
+
+
+_flights = SingleFlight()
+_shared_flights = SharedFlights(config.LLM_COALESCE_FILE, config.LLM_COALESCE_WAIT) if config.LLM_COALESCE_ACROSS_WORKERS else None
+
+metrics.describe('tutor_llm_coalesced_total', "LLM calls answered by an identical call already in flight, by scope.")
+
+
+def _flight_key(key):
+    return hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+
+
+def _shared_call(key, call):
+    """Makes call() unless another worker is already making it (results must be strings)."""
+    if _shared_flights is None:
+        return call()
+    digest = _flight_key(key)
+    since = time.time()
+    try:
+        leader = _shared_flights.claim(digest, since)
+        if not leader:
+            deadline = time.monotonic() + _shared_flights.wait
+            while time.monotonic() < deadline:
+                time.sleep(SharedFlights.POLL_INTERVAL)
+                value = _shared_flights.result(digest, since)
+                if value is not None:
+                    metrics.inc('tutor_llm_coalesced_total', scope='shared')
+                    return value
+                # The other worker failed and dropped its claim: take over
+                leader = _shared_flights.claim(digest, since)
+                if leader:
+                    break
+    except sqlite3.Error as e:
+        print(f"Shared in-flight store failed: {e}")
+        return call()
+
+    try:
+        value = call()
+    except BaseException:
+        if leader:
+            _quietly(_shared_flights.abandon, digest)
+        raise
+    if leader and isinstance(value, str):
+        _quietly(_shared_flights.finish, digest, value)
+    elif leader:
+        _quietly(_shared_flights.abandon, digest)
+    return value
+
+
+def _quietly(func, *args):
+    try:
+        func(*args)
+    except sqlite3.Error as e:
+        print(f"Shared in-flight store failed: {e}")
+
+
+def coalesced(key, call):
+    """
+    Returns call(), sharing one call among concurrent callers with an equal
+    key (a JSON-serializable value describing the request).
+    """
+    if not config.LLM_COALESCE:
+        return call()
+    return _flights.do(json.dumps(key), lambda: _shared_call(key, call))
+
+
+_async_flights = {}  # (event loop, key) -> task making the call
+
+
+async def _shared_call_async(key, call):
+    """_shared_call() for coroutines; SQLite work runs on worker threads."""
+    if _shared_flights is None:
+        return await call()
+    digest = _flight_key(key)
+    since = time.time()
+    try:
+        leader = await asyncio.to_thread(_shared_flights.claim, digest, since)
+        if not leader:
+            deadline = time.monotonic() + _shared_flights.wait
+            while time.monotonic() < deadline:
+                await asyncio.sleep(SharedFlights.POLL_INTERVAL)
+                value = await asyncio.to_thread(_shared_flights.result, digest, since)
+                if value is not None:
+                    metrics.inc('tutor_llm_coalesced_total', scope='shared')
+                    return value
+                leader = await asyncio.to_thread(_shared_flights.claim, digest, since)
+                if leader:
+                    break
+    except sqlite3.Error as e:
+        print(f"Shared in-flight store failed: {e}")
+        return await call()
+
+    try:
+        value = await call()
+    except BaseException:
+        if leader:
+            await asyncio.to_thread(_quietly, _shared_flights.abandon, digest)
+        raise
+    if leader and isinstance(value, str):
+        await asyncio.to_thread(_quietly, _shared_flights.finish, digest, value)
+    elif leader:
+        await asyncio.to_thread(_quietly, _shared_flights.abandon, digest)
+    return value
+
+
+def _forget_flight(flight_key, task):
+    _async_flights.pop(flight_key, None)
+    if not task.cancelled():
+        task.exception()  # Retrieved here in case every waiter was cancelled
+
+
+async def coalesced_async(key, call):
+    """coalesced() for coroutines. A caller that is cancelled leaves the call running for the others."""
+    if not config.LLM_COALESCE:
+        return await call()
+    flight_key = (asyncio.get_running_loop(), json.dumps(key))
+    task = _async_flights.get(flight_key)
+    if task is None:
+        task = asyncio.ensure_future(_shared_call_async(key, call))
+        _async_flights[flight_key] = task
+        task.add_done_callback(lambda done: _forget_flight(flight_key, done))
+    else:
+        metrics.inc('tutor_llm_coalesced_total', scope='worker')
+    return await asyncio.shield(task)
+
+
+def _record_latency(seconds, failed):
+    with _stats_lock:
+        _stats["requests"] += 1
+        if failed:
+            _stats["errors"] += 1
+        _stats["total_seconds"] += seconds
+        _stats["last_seconds"] = seconds
+        if seconds > _stats["max_seconds"]:
+            _stats["max_seconds"] = seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                _stats["buckets"][i] += 1
+                break
+
+
+def get_latency_stats():
+    """Returns a snapshot of this worker's request latency counters."""
+    with _stats_lock:
+        snapshot = dict(_stats)
+        snapshot["buckets"] = list(_stats["buckets"])
+    count = snapshot["requests"]
+    snapshot["avg_seconds"] = snapshot["total_seconds"] / count if count else 0.0
+    return snapshot
+
+
+def reset_latency_stats():
+    """Clears the latency counters (used by benchmarks between runs)."""
+    with _stats_lock:
+        for key in ("requests", "errors"):
+            _stats[key] = 0
+        for key in ("total_seconds", "max_seconds", "last_seconds"):
+            _stats[key] = 0.0
+        _stats["buckets"] = [0] * len(LATENCY_BUCKETS)
+
+
+def _prometheus_lines():
+    """Exposes the latency counters on /metrics as tutor_llm_request_seconds."""
+    stats = get_latency_stats()
+    lines = [
+        "# HELP tutor_llm_request_seconds Latency of HTTP calls to the LLM API.",
+        "# TYPE tutor_llm_request_seconds histogram",
+    ]
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+        cumulative += count
+        le = "+Inf" if bound == float('inf') else repr(bound)
+        lines.append(f'tutor_llm_request_seconds_bucket{{le="{le}"}} {cumulative}')
+    lines.append(f"tutor_llm_request_seconds_count {stats['requests']}")
+    lines.append(f"tutor_llm_request_seconds_sum {stats['total_seconds']:.6f}")
+    lines.append("# TYPE tutor_llm_http_errors_total counter")
+    lines.append(f"tutor_llm_http_errors_total {stats['errors']}")
+    return lines
+
+metrics.register_collector(_prometheus_lines)
@@ -0,0 +1,536 @@
+# log_analytics.py: Columnar copies of tutor_log.csv and fast teacher reports over them.
+#
+# Compaction ('python manage.py compact-logs') reads the rows added to the
+# CSV log and its rotated segments since the last run and writes them to
+# config.ANALYTICS_DIR as immutable segment files. A segment stores each LOG_HEADER column on its
+# own, typed (timestamps and scores as integers, time taken as floats,
+# flags as bytes, repeated strings dictionary-encoded) and zlib-compressed,
+# together with the per-concept and per-session totals of its rows. Each
+# segment records which log and byte range it came from, so compaction
+# resumes exactly where it stopped. Logs are identified by their header and
+# first row, which stay the same when a log is rotated or gzipped.
+#
+# Reports (/api/stats) add up the stored totals of every segment and the
+# rows logged after the last compaction. Segments are read and summed once
+# per worker (again only when compaction adds one) and logs are parsed
+# incrementally, so a request only does work for rows logged since the
+# previous request.
+
+import array
+import calendar
+import csv
+import glob
+import hashlib
+import marshal
+import math
+import os
+import re
+import threading
+import zlib
+import config
+import metrics
+from data_logger import LOG_HEADER, open_log, rotated_log_paths
+
+try:
+    import fcntl  # POSIX only; lets compaction and writers see whole batches
+except ImportError:
+    fcntl = None
+
+_SEGMENT_FORMAT_VERSION = 1
+_SEGMENT_PATTERN = re.compile(r'segment-(\d+)\.tlc$')
+
+# How each LOG_HEADER column is stored
+COLUMN_TYPES = {
+    "Timestamp": 'time',
+    "Session ID": 'dict',
+    "Question": 'dict',
+    "Answer": 'str',
+    "Correctness Score": 'int',
+    "Explanation Score": 'int',
+    "Final Score": 'int',
+    "Time Taken (s)": 'float',
+    "Uncertainty": 'bool',
+    "Concept Gap": 'bool',
+    "Persona": 'dict',
+    "Evaluation": 'str',
+    "Fallout Triggered": 'bool',
+}
+
+MISSING_INT = -1        # 'N/A' scores
+MISSING_BOOL = -1       # 'N/A' flags; True/False are 1/0
+# Missing times are NaN
+
+# Totals kept per concept and per session; every field is summed except the
+# first/last timestamps.
+_ATTEMPTS, _PASSES, _FINAL_SUM, _FINAL_COUNT, _TIME_SUM, _TIME_COUNT, _FALLOUTS, _UNCERTAIN, _FIRST, _LAST = range(10)
+
+
+# --- Parsing ---
+
+def _parse_time(value):
+    # 'YYYY-MM-DD HH:MM:SS' (local time) as seconds since the epoch, read as if UTC
+    try:
+        return calendar.timegm((int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                int(value[11:13]), int(value[14:16]), int(value[17:19]), 0, 0, 0))
+    except ValueError:
+        return 0
+
+
+def _parse_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return int(float(value))
+        except ValueError:
+            return MISSING_INT
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        return math.nan
+
+
+def _parse_bool(value):
+    if value == 'True':
+        return 1
+    if value == 'False':
+        return 0
+    return MISSING_BOOL
+
+
+_PARSERS = {'time': _parse_time, 'int': _parse_int, 'float': _parse_float, 'bool': _parse_bool}
+
+
+def iter_log_rows(path, start, end=None):
+    """
+    Yields (row, offset) for each CSV row between two byte offsets of a log
+    file (to the end if end is None), where offset is the position just
+    after the row. The header row is skipped. Gzipped logs are read as if
+    uncompressed.
+    """
+    end = math.inf if end is None else end
+    with open_log(path) as f:
+        f.seek(start)
+        position = start
+
+        def lines():
+            nonlocal position
+            while position < end:
+                line = f.readline()
+                if not line:
+                    return
+                position += len(line)
+                yield line.decode('utf-8', errors='replace')
+
+        # csv pulls another line only while inside a quoted field, so the
+        # position after each row is exact even with multi-line answers
+        for row in csv.reader(lines()):
+            if row == LOG_HEADER or not row:
+                continue
+            yield row[:len(LOG_HEADER)] + [''] * (len(LOG_HEADER) - len(row)), position
+
+
+def complete_size(path):
+    """The log file's size, taken while no batch is being appended."""
+    with open(path, 'rb') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_SH)
+        try:
+            return os.fstat(f.fileno()).st_size
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def log_identity(path, end=None):
+    """A hash of the log's header and first row, or None while it has no rows."""
+    for _, offset in iter_log_rows(path, 0, end):
+        with open_log(path) as f:
+            return hashlib.sha256(f.read(offset)).hexdigest()[:32]
+    return None
+
+
+def log_files():
+    """Rotated logs, oldest first, then the live log."""
+    paths = rotated_log_paths()
+    if os.path.exists(config.LOCAL_LOG_FILE):
+        paths.append(config.LOCAL_LOG_FILE)
+    return paths
+
+
+def _readable_end(path):
+    # The live log may be mid-append; rotated logs are complete
+    return complete_size(path) if path == config.LOCAL_LOG_FILE else None
+
+
+# --- Totals ---
+
+def _new_totals(timestamp):
+    return [0, 0, 0, 0, 0.0, 0, 0, 0, timestamp, timestamp]
+
+
+def _add_row(totals, key, timestamp, final, time_taken, uncertain, fallout, threshold):
+    entry = totals.get(key)
+    if entry is None:
+        entry = totals[key] = _new_totals(timestamp)
+    entry[_ATTEMPTS] += 1
+    if final != MISSING_INT:
+        entry[_FINAL_SUM] += final
+        entry[_FINAL_COUNT] += 1
+        if final >= threshold:
+            entry[_PASSES] += 1
+    if not math.isnan(time_taken):
+        entry[_TIME_SUM] += time_taken
+        entry[_TIME_COUNT] += 1
+    if fallout == 1:
+        entry[_FALLOUTS] += 1
+    if uncertain == 1:
+        entry[_UNCERTAIN] += 1
+    if timestamp < entry[_FIRST]:
+        entry[_FIRST] = timestamp
+    if timestamp > entry[_LAST]:
+        entry[_LAST] = timestamp
+
+
+def _merge_totals(into, totals):
+    for key, other in totals.items():
+        entry = into.get(key)
+        if entry is None:
+            into[key] = list(other)
+            continue
+        # Entries may be shared with a copy(), so never change them in place
+        entry = into[key] = list(entry)
+        for i in range(_FIRST):
+            entry[i] += other[i]
+        entry[_FIRST] = min(entry[_FIRST], other[_FIRST])
+        entry[_LAST] = max(entry[_LAST], other[_LAST])
+
+
+class Totals:
+    """Per-concept and per-session totals for a set of log rows."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.rows = 0
+        self.concepts = {}
+        self.sessions = {}
+
+    def add(self, timestamp, session_id, concept, final, time_taken, uncertain, fallout):
+        self.rows += 1
+        _add_row(self.concepts, concept, timestamp, final, time_taken, uncertain, fallout, self.threshold)
+        _add_row(self.sessions, session_id, timestamp, final, time_taken, uncertain, fallout, self.threshold)
+
+    def add_row(self, row):
+        """Adds one CSV row (a list in LOG_HEADER order)."""
+        self.add(_parse_time(row[0]), row[1], row[2], _parse_int(row[6]), _parse_float(row[7]),
+                 _parse_bool(row[8]), _parse_bool(row[12]))
+
+    def merge(self, other):
+        self.rows += other.rows
+        _merge_totals(self.concepts, other.concepts)
+        _merge_totals(self.sessions, other.sessions)
+
+    def copy(self):
+        """A copy that can be merged into without changing this one."""
+        totals = Totals(self.threshold)
+        totals.rows = self.rows
+        totals.concepts = dict(self.concepts)
+        totals.sessions = dict(self.sessions)
+        return totals
+
+    def to_dict(self):
+        return {"threshold": self.threshold, "rows": self.rows, "concepts": self.concepts, "sessions": self.sessions}
+
+    @classmethod
+    def from_dict(cls, data):
+        totals = cls(data["threshold"])
+        totals.rows = data["rows"]
+        totals.concepts = data["concepts"]
+        totals.sessions = data["sessions"]
+        return totals
+
+
+def summarize(entry):
+    """Turns a totals entry into the report fields."""
+    attempts = entry[_ATTEMPTS]
+    return {
+        "attempts": attempts,
+        "pass_rate": entry[_PASSES] / entry[_FINAL_COUNT] if entry[_FINAL_COUNT] else None,
+        "avg_final_score": entry[_FINAL_SUM] / entry[_FINAL_COUNT] if entry[_FINAL_COUNT] else None,
+        "avg_time": entry[_TIME_SUM] / entry[_TIME_COUNT] if entry[_TIME_COUNT] else None,
+        "fallout_rate": entry[_FALLOUTS] / attempts if attempts else None,
+        "uncertainty_rate": entry[_UNCERTAIN] / attempts if attempts else None,
+        "first_seen": entry[_FIRST],
+        "last_seen": entry[_LAST],
+    }
+
+
+# --- Segment Files ---
+
+def _encode_column(kind, values):
+    if kind == 'time':
+        data = array.array('q', values).tobytes()
+    elif kind == 'int':
+        data = array.array('i', values).tobytes()
+    elif kind == 'float':
+        data = array.array('d', values).tobytes()
+    elif kind == 'bool':
+        data = array.array('b', values).tobytes()
+    elif kind == 'dict':
+        codes, index = [], {}
+        for value in values:
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(index)
+            codes.append(code)
+        data = marshal.dumps((list(index), array.array('I', codes).tobytes()))
+    else:
+        data = marshal.dumps(values)
+    return zlib.compress(data, 6)
+
+
+def _decode_column(kind, blob):
+    data = zlib.decompress(blob)
+    if kind in ('time', 'int', 'float', 'bool'):
+        values = array.array({'time': 'q', 'int': 'i', 'float': 'd', 'bool': 'b'}[kind])
+        values.frombytes(data)
+        return values
+    if kind == 'dict':
+        strings, codes_bytes = marshal.loads(data)
+        codes = array.array('I')
+        codes.frombytes(codes_bytes)
+        return [strings[code] for code in codes]
+    return marshal.loads(data)
+
+
+def segment_paths():
+    """Segment files in compaction order."""
+    paths = glob.glob(os.path.join(config.ANALYTICS_DIR, 'segment-*.tlc'))
+    return sorted(paths, key=lambda path: int(_SEGMENT_PATTERN.search(path).group(1)))
+
+
+def read_segment(path, columns=None):
+    """
+    Reads a segment; returns its metadata dict with "columns" holding the
+    requested columns (all by default) as sequences. Only requested columns
+    are decompressed.
+    """
+    with open(path, 'rb') as f:
+        segment = marshal.load(f)
+    if segment.get("version") != _SEGMENT_FORMAT_VERSION:
+        raise ValueError(f"Unsupported segment format in '{path}'")
+    blobs = segment["columns"]
+    names = LOG_HEADER if columns is None else columns
+    segment["columns"] = {name: _decode_column(COLUMN_TYPES[name], blobs[name]) for name in names}
+    return segment
+
+
+def _write_segment(number, columns, totals, source):
+    path = os.path.join(config.ANALYTICS_DIR, f"segment-{number:06d}.tlc")
+    segment = {
+        "version": _SEGMENT_FORMAT_VERSION,
+        "rows": totals.rows,
+        "source": source,
+        "columns": {name: _encode_column(COLUMN_TYPES[name], values) for name, values in zip(LOG_HEADER, columns)},
+        "totals": totals.to_dict(),
+    }
+    # Write to a temp file and rename, so readers never see a partial segment
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        marshal.dump(segment, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _segment_sources():
+    """Maps the identity of each compacted log to the furthest byte compacted."""
+    compacted = {}
+    for path in segment_paths():
+        with open(path, 'rb') as f:
+            source = marshal.load(f)["source"]
+        compacted[source["id"]] = max(compacted.get(source["id"], 0), source["end"])
+    return compacted
+
+
+# --- Compaction ---
+
+def compact_logs(paths=None, segment_rows=None):
+    """
+    Moves the rows added to each log (default: every rotated log, then the
+    live one) since the last compaction into new segments of at most
+    segment_rows rows. Returns the number of rows compacted. Safe to run
+    while the app is writing and rotating the log.
+    """
+    paths = log_files() if paths is None else paths
+    segment_rows = segment_rows or config.ANALYTICS_SEGMENT_ROWS
+    os.makedirs(config.ANALYTICS_DIR, exist_ok=True)
+
+    with open(os.path.join(config.ANALYTICS_DIR, 'compact.lock'), 'w') as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # One compaction at a time
+        compacted = _segment_sources()
+        count = 0
+        for path in paths:
+            try:
+                count += _compact_one(path, compacted, segment_rows)
+            except FileNotFoundError:
+                continue  # Rotated, gzipped or deleted meanwhile; picked up next run
+
+    metrics.inc('tutor_log_rows_compacted_total', count)
+    return count
+
+
+def _compact_one(path, compacted, segment_rows):
+    end = _readable_end(path)
+    identity = log_identity(path, end)
+    if identity is None:
+        return 0
+    start = compacted.get(identity, 0)
+    existing = segment_paths()
+    number = int(_SEGMENT_PATTERN.search(existing[-1]).group(1)) + 1 if existing else 1
+
+    count = 0
+    rows = iter_log_rows(path, start, end)
+    while True:
+        columns = [[] for _ in LOG_HEADER]
+        totals = Totals(config.REMEDIATION_THRESHOLD)
+        for row, offset in rows:
+            parsed = [_PARSERS.get(COLUMN_TYPES[name], str)(value) for name, value in zip(LOG_HEADER, row)]
+            for column, value in zip(columns, parsed):
+                column.append(value)
+            totals.add(parsed[0], parsed[1], parsed[2], parsed[6], parsed[7], parsed[8], parsed[12])
+            if totals.rows >= segment_rows:
+                break
+        if not totals.rows:
+            return count
+        source = {"path": os.path.basename(path), "id": identity, "start": start, "end": offset}
+        _write_segment(number, columns, totals, source)
+        number += 1
+        count += totals.rows
+        # A gzipped copy of the same log (same identity) continues from here
+        start = compacted[identity] = offset
+
+
+# --- Reports ---
+
+class LogStats:
+    """Totals over every segment plus the rows logged since, updated incrementally."""
+
+    def __init__(self):
+        self._segments = {}     # segment path -> (source, Totals); segments never change
+        self._logs = {}         # log identity -> [start, position read, Totals, fully read]
+        self._identities = {}   # (log path, inode) -> log identity
+        self._sealed = None     # ((segment paths, threshold), merged Totals, compacted ends)
+        self._lock = threading.Lock()
+
+    def _segment(self, path, threshold):
+        cached = self._segments.get(path)
+        if cached is None or cached[1].threshold != threshold:
+            segment = read_segment(path, columns=[])
+            totals = Totals.from_dict(segment["totals"])
+            if totals.threshold != threshold:
+                totals = self._recount(path, threshold)
+            cached = self._segments[path] = (segment["source"], totals)
+        return cached
+
+    @staticmethod
+    def _recount(path, threshold):
+        # The passing score changed since compaction; recount from the columns
+        names = ["Timestamp", "Session ID", "Question", "Final Score", "Time Taken (s)", "Uncertainty", "Fallout Triggered"]
+        columns = read_segment(path, columns=names)["columns"]
+        totals = Totals(threshold)
+        for values in zip(*(columns[name] for name in names)):
+            totals.add(*values)
+        return totals
+
+    def _identity(self, path):
+        key = (path, os.stat(path).st_ino)
+        identity = self._identities.get(key)
+        if identity is None:
+            identity = log_identity(path, _readable_end(path))
+            if identity is not None:
+                self._identities[key] = identity
+        return identity
+
+    def _log_totals(self, path, identity, start, threshold):
+        # Rows of a log past its last compacted byte, each parsed only once
+        entry = self._logs.get(identity)
+        if entry is None or entry[0] != start or entry[2].threshold != threshold:
+            entry = self._logs[identity] = [start, start, Totals(threshold), False]
+        if not entry[3]:
+            end = _readable_end(path)
+            position = entry[1]
+            for row, position in iter_log_rows(path, entry[1], end):
+                entry[2].add_row(row)
+            entry[1] = position
+            entry[3] = end is None  # Rotated logs never grow
+        return entry[2]
+
+    def _sealed_totals(self, threshold):
+        # Segments never change, so their sum is only redone when one is added or removed
+        paths = segment_paths()
+        key = (tuple(paths), threshold)
+        if self._sealed is None or self._sealed[0] != key:
+            for stale in set(self._segments) - set(paths):
+                del self._segments[stale]
+            merged = Totals(threshold)
+            compacted = {}
+            for path in paths:
+                source, totals = self._segment(path, threshold)
+                merged.merge(totals)
+                compacted[source["id"]] = max(compacted.get(source["id"], 0), source["end"])
+            self._sealed = (key, merged, compacted)
+        return self._sealed[1], self._sealed[2]
+
+    def totals(self, threshold=None):
+        """Returns a Totals covering every logged row."""
+        threshold = config.REMEDIATION_THRESHOLD if threshold is None else threshold
+        with self._lock:
+            sealed, compacted = self._sealed_totals(threshold)
+            result = sealed.copy()
+
+            seen = set()
+            for path in log_files():
+                try:
+                    identity = self._identity(path)
+                    # A log being gzipped briefly exists twice
+                    if identity is None or identity in seen:
+                        continue
+                    result.merge(self._log_totals(path, identity, compacted.get(identity, 0), threshold))
+                    seen.add(identity)
+                except FileNotFoundError:
+                    continue  # Rotated or deleted meanwhile
+            for gone in set(self._logs) - seen:
+                del self._logs[gone]
+            current = set(log_files())
+            self._identities = {key: value for key, value in self._identities.items() if key[0] in current}
+            return result
+
+    def report(self, by='concept', key=None):
+        """Summaries per concept or per session (optionally just one key)."""
+        totals = self.totals()
+        groups = totals.sessions if by == 'session' else totals.concepts
+        if key is not None:
+            groups = {key: groups[key]} if key in groups else {}
+        return {
+            "rows": totals.rows,
+            "passing_score": totals.threshold,
+            "concept_count": len(totals.concepts),
+            "session_count": len(totals.sessions),
+            ("sessions" if by == 'session' else "concepts"): {name: summarize(entry) for name, entry in groups.items()},
+        }
+
+
+metrics.describe('tutor_log_rows_compacted_total', "Log rows moved from CSV into columnar segments.")
+
+_stats = LogStats()
+
+
+def get_stats(by='concept', key=None):
+    """The shared report for /api/stats."""
+    return _stats.report(by=by, key=key)
@@ -0,0 +1,167 @@
+# manage.py: Command-line tasks for deploying and maintaining the AI Tutor.
+#
+# Usage: python manage.py <command> [options]
+#   warm-cache       Pre-generate hints and remediation for every lesson topic.
+#   merge-logs       Merge per-worker log files into tutor_log.csv.
+#   compile-lessons  Pre-build the compiled lesson cache for every lesson.
+#   grade-batch      Grade a file of collected answers (CSV or JSONL).
+#   compact-logs     Move logged rows into columnar segments for /api/stats.
+#   replay-log       Re-grade logged answers and report score changes per concept.
+
+import argparse
+import sys
+
+
+def cmd_warm_cache(args):
+    """Fills the LLM cache so students never wait on hint/remediation generation."""
+    import knowledge_base
+    import tutor
+    from llm_cache import get_cache
+
+    if get_cache() is None:
+        print("The LLM cache is disabled in settings.ini ([Cache] enabled = false).")
+        return 1
+
+    lesson_ids = [args.lesson] if args.lesson else knowledge_base.get_lesson_ids()
+    for lesson_id in lesson_ids:
+        lesson = knowledge_base.get_lesson(lesson_id)
+        if lesson is None:
+            print(f"Unknown lesson: {lesson_id}")
+            return 1
+        count = tutor.warm_cache(lesson.items, workers=args.workers)
+        print(f"Warmed hints and remediation for {count} topics in '{lesson_id}'.")
+    print(f"Cache stats: {get_cache().stats()}")
+    return 0
+
+
+def cmd_merge_logs(args):
+    """Folds per-worker CSV logs (log_mode = per_worker) into the main log file."""
+    import config
+    import data_logger
+
+    count = data_logger.merge_worker_logs(include_live=args.include_live)
+    print(f"Merged {count} rows into {config.LOCAL_LOG_FILE}.")
+    return 0
+
+
+def cmd_compile_lessons(args):
+    """Parses every lesson once so workers start from the compiled cache."""
+    import knowledge_base
+
+    for lesson_id in knowledge_base.get_lesson_ids():
+        path = knowledge_base._registry.path_for(lesson_id)
+        topics = knowledge_base.compile_lesson(path)
+        print(f"Compiled '{lesson_id}': {len(topics)} topics.")
+    return 0
+
+
+def cmd_grade_batch(args):
+    """Grades every answer in a file, writing tutor_log.csv-style rows."""
+    import batch_grader
+    import knowledge_base
+
+    if knowledge_base.get_lesson(args.lesson) is None:
+        print(f"Unknown lesson: {args.lesson}")
+        return 1
+    items = batch_grader.read_items(args.input)
+    invalid = batch_grader.find_invalid_item(items)
+    if invalid is not None:
+        print(f"Item {invalid[0]} in {args.input} needs a text concept and answer: {invalid[1]!r}")
+        return 1
+    rows = batch_grader.grade_batch(items, difficulty=args.difficulty, lesson_id=args.lesson,
+                                    pack_size=args.pack_size, workers=args.workers)
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for chunk in batch_grader.format_rows(rows, args.format):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Graded {len(items)} answers.", file=sys.stderr)
+    return 0
+
+
+def cmd_compact_logs(args):
+    """Copies rows logged since the last run (including rotated logs) into columnar segment files."""
+    import config
+    import data_logger
+    import log_analytics
+
+    if config.LOG_MODE == 'per_worker':
+        data_logger.merge_worker_logs()
+    paths = [args.log] if args.log else None
+    count = log_analytics.compact_logs(paths, segment_rows=args.segment_rows)
+    print(f"Compacted {count} rows into {config.ANALYTICS_DIR}.")
+    return 0
+
+
+def cmd_replay_log(args):
+    """Re-grades logged answers with the current prompt and reports how final scores would move."""
+    import json
+    import replay
+
+    def progress(counts):
+        print(f"Replayed {counts['rows']} rows ({counts['graded']} graded, {counts['from_cache']} from cache).", file=sys.stderr)
+
+    try:
+        report = replay.replay_log(args.log or None, difficulty=args.difficulty, lesson_id=args.lesson,
+                                   workers=args.workers, cache_file=args.cache, limit=args.limit, progress=progress)
+    except ValueError as e:
+        print(e)
+        return 1
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print(replay.format_report(report))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="AI Tutor maintenance commands.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    warm = subparsers.add_parser('warm-cache', help="Pre-generate hints and remediation for every topic.")
+    warm.add_argument('--lesson', help="Only warm this lesson id (default: every lesson).")
+    warm.add_argument('--workers', type=int, default=4, help="Concurrent LLM calls (default: 4).")
+    warm.set_defaults(func=cmd_warm_cache)
+
+    merge = subparsers.add_parser('merge-logs', help="Merge per-worker log files into tutor_log.csv.")
+    merge.add_argument('--include-live', action='store_true',
+                       help="Also merge files of workers that are still running.")
+    merge.set_defaults(func=cmd_merge_logs)
+
+    compile_parser = subparsers.add_parser('compile-lessons', help="Pre-build the compiled lesson cache.")
+    compile_parser.set_defaults(func=cmd_compile_lessons)
+
+    batch = subparsers.add_parser('grade-batch', help="Grade a file of collected answers.")
+    batch.add_argument('input', help="CSV with Session ID/Question/Answer columns, or .jsonl with session_id/concept/answer.")
+    batch.add_argument('--output', help="Write results here (default: stdout).")
+    batch.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help="Output format (default: csv).")
+    batch.add_argument('--lesson', help="Lesson id the concepts come from (default: lesson_file).")
+    batch.add_argument('--difficulty', choices=['Easy', 'Normal', 'Strict'], help="Override grader_difficulty.")
+    batch.add_argument('--pack-size', type=int, help="Answers per LLM call (default: [Batch] pack_size).")
+    batch.add_argument('--workers', type=int, help="Concurrent LLM calls (default: [Batch] workers).")
+    batch.set_defaults(func=cmd_grade_batch)
+
+    compact = subparsers.add_parser('compact-logs', help="Move logged rows into columnar segments.")
+    compact.add_argument('--log', help="Only compact this log file (default: tutor_log.csv and its rotated files).")
+    compact.add_argument('--segment-rows', type=int, help="Max rows per segment (default: [Analytics] segment_rows).")
+    compact.set_defaults(func=cmd_compact_logs)
+
+    replay_parser = subparsers.add_parser('replay-log', help="Re-grade logged answers and report score changes.")
+    replay_parser.add_argument('--log', action='append',
+                               help="Log file to replay; repeatable (default: rotated logs, then tutor_log.csv).")
+    replay_parser.add_argument('--difficulty', choices=['Easy', 'Normal', 'Strict'], help="Override grader_difficulty.")
+    replay_parser.add_argument('--lesson', help="Lesson id the logged concepts come from (default: lesson_file).")
+    replay_parser.add_argument('--workers', type=int, help="Concurrent grading calls (default: [Replay] workers).")
+    replay_parser.add_argument('--cache', help="Result cache file (default: [Replay] cache_file).")
+    replay_parser.add_argument('--limit', type=int, help="Only replay the first N rows.")
+    replay_parser.add_argument('--json', help="Also write the full report as JSON to this file.")
+    replay_parser.set_defaults(func=cmd_replay_log)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
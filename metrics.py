@@ -0,0 +1,282 @@
+# metrics.py: Lightweight counters, timing spans and a Prometheus text exporter.
+#
+# Everything is per process: with several gunicorn workers each scrape of
+# /metrics reports the worker that served it (tell them apart by the 'pid'
+# label on tutor_process_info).
+
+import atexit
+import contextvars
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+# Upper bounds (seconds) of the span duration histogram buckets.
+SPAN_BUCKETS = (0.005, 0.025, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+_lock = threading.Lock()
+_counters = defaultdict(float)      # (name, labels) -> value
+_spans = {}                         # span name -> [bucket counts, count, sum]
+_gauges = {}                        # name -> (help, callable)
+_collectors = []                    # callables returning extra exposition lines
+_help = {}
+
+# Spans of the request being handled, if tracing is on for it.
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+# --- Counters & Gauges ---
+
+def describe(name, help_text):
+    """Sets the HELP text shown for a metric."""
+    _help[name] = help_text
+
+
+def inc(name, value=1, **labels):
+    """Adds to a counter. Labels become Prometheus labels."""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] += value
+
+
+def register_gauge(name, func, help_text=""):
+    """Registers a gauge whose value is read from func() at scrape time."""
+    _gauges[name] = (help_text, func)
+
+
+def register_collector(func):
+    """Registers a function returning extra exposition lines (for stats kept elsewhere)."""
+    _collectors.append(func)
+
+
+# --- Spans ---
+
+def _observe(name, seconds):
+    with _lock:
+        entry = _spans.get(name)
+        if entry is None:
+            entry = _spans[name] = [[0] * len(SPAN_BUCKETS), 0, 0.0]
+        for i, bound in enumerate(SPAN_BUCKETS):
+            if seconds <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += 1
+        entry[2] += seconds
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.append((name, seconds))
+
+
+class span:
+    """
+    Times a block of code: `with metrics.span('evaluate_answer'): ...`
+
+    Durations feed the tutor_span_seconds histogram and, during a traced
+    request, that request's trace.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def timed(name):
+    """Decorator form of span(). Works on plain and async functions."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# --- Per-Request Traces ---
+
+def start_trace():
+    """Starts collecting spans for the current request; returns a token for end_trace."""
+    return _current_trace.set([])
+
+
+def current_trace():
+    """The current request's [(span name, seconds), ...] so far, or None outside a request."""
+    return _current_trace.get()
+
+
+def end_trace(token):
+    """Stops collecting and returns the request's [(span name, seconds), ...]."""
+    trace = _current_trace.get() or []
+    _current_trace.reset(token)
+    return trace
+
+
+def bind_trace(func):
+    """Wraps func so spans it records in another thread join the current request's trace."""
+    context = contextvars.copy_context()
+    return functools.partial(context.run, func)
+
+
+def server_timing_header(trace):
+    """Formats a trace as a Server-Timing header (shown in browser dev tools)."""
+    totals = defaultdict(float)
+    for name, seconds in trace:
+        totals[name] += seconds
+    return ", ".join(f"{name.replace('.', '_')};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+
+# --- Prometheus Exposition ---
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def format_bound(bound):
+    """Formats a histogram bucket bound for an 'le' label."""
+    return "+Inf" if bound == float('inf') else repr(bound)
+
+
+def render_prometheus():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = [
+        "# TYPE tutor_process_info gauge",
+        f'tutor_process_info{{pid="{os.getpid()}"}} 1',
+    ]
+
+    with _lock:
+        counters = sorted(_counters.items())
+        spans = {name: (list(entry[0]), entry[1], entry[2]) for name, entry in _spans.items()}
+
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            if name in _help:
+                lines.append(f"# HELP {name} {_help[name]}")
+            lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name}{_format_labels(labels)} {value:g}")
+
+    for name, (help_text, func) in sorted(_gauges.items()):
+        try:
+            value = func()
+        except Exception as e:
+            print(f"Metrics gauge '{name}' failed: {e}")
+            continue
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value:g}")
+
+    if spans:
+        lines.append("# HELP tutor_span_seconds Time spent in instrumented code paths.")
+        lines.append("# TYPE tutor_span_seconds histogram")
+        for name, (buckets, count, total) in sorted(spans.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(SPAN_BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f'tutor_span_seconds_bucket{{span="{name}",le="{format_bound(bound)}"}} {cumulative}')
+            lines.append(f'tutor_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'tutor_span_seconds_sum{{span="{name}"}} {total:.6f}')
+
+    for collector in _collectors:
+        try:
+            lines.extend(collector())
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+
+    return "\n".join(lines) + "\n"
+
+
+# --- Sampling Profiler ---
+# Set TUTOR_PROFILE=1 to sample every thread's stack every
+# TUTOR_PROFILE_INTERVAL seconds (default 0.01). Stacks are written in the
+# "folded" format used by flamegraph tools to profile-<pid>.folded (or
+# TUTOR_PROFILE_DIR) every 30 seconds and at exit.
+
+class SamplingProfiler:
+    """Periodically samples all thread stacks from a background thread."""
+
+    def __init__(self, interval, output_path, write_every=30.0):
+        self.interval = interval
+        self.output_path = output_path
+        self.write_every = write_every
+        self.samples = Counter()
+        self._samples_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        self.write()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        last_write = time.monotonic()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                with self._samples_lock:
+                    self.samples[";".join(reversed(stack))] += 1
+            if time.monotonic() - last_write >= self.write_every:
+                self.write()
+                last_write = time.monotonic()
+
+    def write(self):
+        with self._samples_lock:
+            samples = self.samples.most_common()
+        try:
+            with open(self.output_path, 'w', encoding='utf-8') as f:
+                for stack, count in samples:
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            print(f"Could not write profile '{self.output_path}': {e}")
+
+
+_profiler = None
+_profiler_pid = None
+
+
+def maybe_start_profiler():
+    """Starts the sampling profiler if TUTOR_PROFILE is set (once per worker process)."""
+    global _profiler, _profiler_pid
+    if _profiler_pid == os.getpid() or os.environ.get('TUTOR_PROFILE', '').lower() not in ('1', 'true', 'yes'):
+        return
+    _profiler_pid = os.getpid()
+    interval = float(os.environ.get('TUTOR_PROFILE_INTERVAL', '0.01'))
+    output_dir = os.environ.get('TUTOR_PROFILE_DIR', os.path.dirname(os.path.abspath(__file__)))
+    _profiler = SamplingProfiler(interval, os.path.join(output_dir, f"profile-{os.getpid()}.folded"))
+    _profiler.start()
+    print(f"Sampling profiler enabled; writing {_profiler.output_path}")
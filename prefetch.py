@@ -0,0 +1,182 @@
+# prefetch.py: Starts the LLM calls a student's next answer will likely need, while they type.
+#
+# When a question is served, the next /api/ask either moves on (and in Easy
+# mode needs a hint for the next question) or asks for a retry (and needs
+# remediation for this one). Both only depend on lesson content, so they are
+# started speculatively on a small thread pool. When the answer arrives, a
+# finished result is used as is, a running call is joined instead of being
+# repeated, and a call still waiting in the queue is cancelled and made
+# directly. Results also go through the LLM cache, so other workers and
+# other students reuse them.
+
+import asyncio
+import functools
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import config
+import metrics
+
+metrics.describe('tutor_prefetch_total', "Speculative hint/remediation calls, by kind and outcome.")
+
+
+class _Entry:
+    __slots__ = ('future', 'sessions')
+
+    def __init__(self, future):
+        self.future = future
+        self.sessions = set()
+
+
+class Prefetcher:
+    """Runs speculative calls on max_workers threads, tracking at most max_entries of them."""
+
+    def __init__(self, max_workers, max_entries):
+        self.max_workers = max_workers
+        self.max_entries = max_entries
+        self._executor = None
+        self._pid = None
+        self._entries = OrderedDict()   # (function name, args) -> _Entry, oldest first
+        self._sessions = OrderedDict()  # session id -> keys it is waiting for, least recent first
+        self._lock = threading.Lock()
+
+    def _submit(self, func, args):
+        # Threads do not survive a fork, so each worker starts its own pool.
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='prefetch')
+            self._pid = os.getpid()
+            self._entries.clear()
+            self._sessions.clear()
+        return self._executor.submit(func, *args)
+
+    def schedule(self, session_id, jobs):
+        """
+        Starts jobs, a list of (prefetchable function, args), for a session.
+
+        Jobs the session scheduled earlier and no longer needs are released;
+        if no other session wants them and they have not started, they are
+        cancelled.
+        """
+        with self._lock:
+            keys = set()
+            for func, args in jobs:
+                key = (func.__name__, args)
+                keys.add(key)
+                entry = self._entries.get(key)
+                if entry is None or entry.future.cancelled():
+                    entry = self._entries[key] = _Entry(self._submit(func.compute, args))
+                    metrics.inc('tutor_prefetch_total', kind=func.__name__, outcome='scheduled')
+                self._entries.move_to_end(key)
+                entry.sessions.add(session_id)
+            for key in self._sessions.get(session_id, set()) - keys:
+                self._release(key, session_id)
+            self._sessions.pop(session_id, None)
+            if keys:
+                self._sessions[session_id] = keys
+            # Sessions that were abandoned mid-quiz are forgotten eventually
+            while len(self._sessions) > self.max_entries:
+                self._sessions.popitem(last=False)
+            while len(self._entries) > self.max_entries:
+                key, entry = self._entries.popitem(last=False)
+                self._cancel(key, entry)
+
+    def release(self, session_id):
+        """Releases everything a session scheduled (e.g. when its quiz ends)."""
+        self.schedule(session_id, [])
+
+    def _release(self, key, session_id):
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry.sessions.discard(session_id)
+        if not entry.sessions and not entry.future.done():
+            del self._entries[key]
+            self._cancel(key, entry)
+
+    @staticmethod
+    def _cancel(key, entry):
+        if entry.future.cancel():
+            metrics.inc('tutor_prefetch_total', kind=key[0], outcome='cancelled')
+
+    def claim(self, func, args):
+        """
+        Returns the future of a finished or running prefetch of func(*args),
+        or None if the caller should make the call itself. A prefetch still
+        waiting for a thread is cancelled rather than waited for.
+        """
+        key = (func.__name__, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.future.cancelled():
+                outcome, future = 'miss', None
+            elif entry.future.done():
+                outcome, future = 'hit', entry.future
+            elif entry.future.cancel():
+                del self._entries[key]
+                outcome, future = 'cancelled', None
+            else:
+                outcome, future = 'joined', entry.future
+        metrics.inc('tutor_prefetch_total', kind=key[0], outcome=outcome)
+        if future is not None and future.done() and future.exception() is not None:
+            return None
+        return future
+
+    def is_prefetched(self, func, args):
+        """True if func(*args) has been prefetched successfully or is running now."""
+        with self._lock:
+            entry = self._entries.get((func.__name__, args))
+        if entry is None or entry.future.cancelled():
+            return False
+        if entry.future.done():
+            return entry.future.exception() is None
+        return entry.future.running()
+
+
+# --- Shared Instance ---
+_prefetcher = Prefetcher(config.PREFETCH_WORKERS, config.PREFETCH_MAX_ENTRIES) if config.PREFETCH_ENABLED else None
+
+
+def prefetchable(func):
+    """
+    Lets func's results be prefetched with schedule(); calls to the wrapper
+    use a prefetched result when there is one. func.compute is the
+    original function.
+    """
+    @functools.wraps(func)
+    def wrapper(*args):
+        future = _prefetcher.claim(wrapper, args) if _prefetcher is not None else None
+        if future is not None:
+            try:
+                return future.result()
+            except Exception:
+                pass  # Make the call ourselves
+        return func(*args)
+
+    wrapper.compute = func
+    return wrapper
+
+
+async def take_async(func, args):
+    """
+    For async callers of a prefetchable func: returns (True, result) if a
+    prefetch finished or could be joined, else (False, None).
+    """
+    future = _prefetcher.claim(func, args) if _prefetcher is not None else None
+    if future is None:
+        return False, None
+    try:
+        return True, await asyncio.wrap_future(future)
+    except Exception:
+        return False, None
+
+
+def is_prefetched(func, args):
+    """Whether a streamed call should use the prefetched result instead of streaming."""
+    return _prefetcher is not None and _prefetcher.is_prefetched(func, args)
+
+
+def schedule(session_id, jobs):
+    """Starts [(prefetchable function, args), ...] for a session in the background."""
+    if _prefetcher is not None:
+        _prefetcher.schedule(session_id, jobs)
@@ -0,0 +1,66 @@
+# pregrader.py: Grades clear-cut answers locally so they skip the LLM grader call.
+#
+# Only non-answers ("I don't know") are clear-cut: every grading mode gives
+# them zero. Everything else goes to the LLM grader, so a local grade never
+# differs from what the rubric would give.
+
+import re
+
+# Answers that mean "I don't know", compared after normalize(). Words that
+# can be a real answer or a request for help ("no", "none", "pass", "help")
+# are left to the LLM grader.
+NON_ANSWERS = {
+    "", "idk", "i dont know", "dont know", "i do not know", "no idea",
+    "i have no idea", "not sure", "im not sure", "i am not sure", "no clue",
+    "i have no clue", "dunno", "i dunno", "skip", "na", "n a",
+    "nothing", "i forgot", "forgot",
+}
+
+_NON_WORD = re.compile(r"[^\w\s]")
+_SPACES = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Lowercases, drops punctuation (so "don't" becomes "dont") and collapses whitespace."""
+    text = _NON_WORD.sub("", text.lower())
+    return _SPACES.sub(" ", text).strip()
+
+
+def _result(correctness, explanation, uncertainty, persona, evaluation_text):
+    final = correctness + explanation
+    return {
+        "scores": {
+            "correctness": correctness,
+            "explanation": explanation,
+            "bonus": 0,
+            "final": final
+        },
+        "signals": {
+            "correctness_explanation_gap": correctness - explanation >= 20,
+            "uncertainty_detected": uncertainty,
+            "persona": persona
+        },
+        "evaluation_text": f"**Scores: {final}/100** {evaluation_text}",
+        "follow_up_question": "None",
+        "graded_locally": True
+    }
+
+
+def pregrade(concept, ground_truth, user_answer, difficulty):
+    """
+    Grades an answer locally when the outcome is clear-cut.
+
+    Returns an evaluation dict shaped like evaluate_answer's, or None when
+    the answer needs the LLM grader.
+    """
+    normalized = normalize(user_answer or "")
+
+    if normalized in NON_ANSWERS:
+        # Matches the grader's REDUNDANCY BLOCKER: short, no explanation,
+        # because the remediation card comes next.
+        return _result(0, 0, True, "Honest Learner",
+                       "Thanks for your honesty! A helpful explanation is coming up next.")
+
+    # Anything else, including answers copied from the lesson, is graded by
+    # the LLM with the difficulty's rubric; grading it here could disagree.
+    return None
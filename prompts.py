@@ -0,0 +1,266 @@
+# prompts.py: Grader prompt templates, token estimates and prompt size budgets.
+#
+# Grading prompts are mostly fixed text: the role and leniency lines only
+# depend on the difficulty, and the instructions and JSON schema never
+# change. Each template is compiled once per difficulty at import into
+# literal chunks with the per-answer fields between them, so building a
+# prompt is a single join. Student answers and ground truths longer than
+# their budget ([Prompts] in settings.ini) are cut to their beginning and
+# end, so a pasted essay can't make a grading call arbitrarily slow or
+# expensive. Prompt and response sizes of every LLM call are recorded for
+# /metrics.
+
+import string
+import threading
+import config
+import metrics
+
+DIFFICULTIES = ('Easy', 'Normal', 'Strict')
+
+# Gemini averages about four characters of English per token; close enough
+# for budgets without shipping a tokenizer.
+CHARS_PER_TOKEN = 4
+
+TRUNCATION_MARKER = " [...] "
+
+metrics.describe('tutor_prompt_truncations_total', "Student answers or ground truths cut to fit the prompt budget, by field.")
+
+
+def difficulty_settings(difficulty):
+    """Returns the (system_role, leniency_instruction) prompt lines for a grading mode."""
+    if difficulty == "Strict":
+        system_role = "You are a strict academic professor grading a university exam."
+        leniency_instruction = "Deduct points for any missing technical details, lack of precision, or informal language."
+    elif difficulty == "Easy":
+        system_role = "You are a supportive middle-school tutor."
+        leniency_instruction = (
+            "EXTREME LENIENCY MODE ENABLED:\n"
+            "1. CONTEXT ASSUMPTION: If the student provides a correct GENERAL definition, COUNT IT AS 100% CORRECT.\n"
+            "2. NO NITPICKING: Ignore spelling/grammar.\n"
+            "3. ENCOURAGEMENT: Focus entirely on what they got RIGHT."
+        )
+    else: # Normal
+        system_role = "You are a fair high-school teacher."
+        leniency_instruction = "Balance precision with understanding. Award high points for the core concept, but require some specific details for a perfect score."
+    return system_role, leniency_instruction
+
+
+# --- Token Estimates & Budgets ---
+
+def estimate_tokens(text):
+    """Rough token count of a text."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def fit_to_budget(text, max_tokens, field=None):
+    """
+    Returns text cut to about max_tokens (0 = no limit). The first two
+    thirds and the last third of the budget are kept, split at spaces, so
+    the answer's opening and its conclusion both reach the grader.
+    """
+    if max_tokens <= 0 or estimate_tokens(text) <= max_tokens:
+        return text
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    head = text[:max_chars * 2 // 3]
+    tail = text[len(text) - max_chars // 3:]
+    if ' ' in head:
+        head = head.rsplit(' ', 1)[0]
+    if ' ' in tail:
+        tail = tail.split(' ', 1)[1]
+    if field:
+        metrics.inc('tutor_prompt_truncations_total', field=field)
+    return head + TRUNCATION_MARKER + tail
+
+
+# --- Templates ---
+
+class CompiledTemplate:
+    """A template split into literal text and the fields filled in per call."""
+
+    def __init__(self, template, **fixed):
+        # Literal text with the fixed fields already substituted, then
+        # (literal, field name) pairs; the last literal has no field after it.
+        self.parts = []
+        literal = ""
+        for text, field, _, _ in string.Formatter().parse(template):
+            literal += text
+            if field is None:
+                continue
+            if field in fixed:
+                literal += str(fixed[field])
+            else:
+                self.parts.append((literal, field))
+                literal = ""
+        self.parts.append((literal, None))
+        self.fields = {field for _, field in self.parts if field}
+        self.static_tokens = estimate_tokens("".join(text for text, _ in self.parts))
+
+    def render(self, **values):
+        return "".join(text + values[field] if field else text for text, field in self.parts)
+
+
+def _compact(template):
+    """Strips the indentation of triple-quoted templates and trailing spaces."""
+    return "\n".join(line.rstrip() for line in template.strip().splitlines())
+
+
+GRADER_TEMPLATE = _compact("""
+**Role:** {system_role}
+
+**Task:** Evaluate a student's answer against a Ground Truth definition.
+
+**Context:**
+- Topic: "{concept}"
+- Student's Answer: "{user_answer}"
+- Ground Truth (Reference Material): "{ground_truth}"
+- Grading Mode: "{difficulty}"
+
+**Grading Instructions:**
+1. {leniency_instruction}
+2. **Correctness (0-50):** How factually accurate is the answer?
+3. **Explanation (0-50):** Did they use their own words?
+4. **Feedback:** Write a helpful evaluation. Start with the score.
+5. **REDUNDANCY BLOCKER (CRITICAL):** - If the student scores less than 30 points OR says "I don't know":
+   - **DO NOT** explain the concept in the `evaluation_text`.
+   - **DO NOT** give the definition.
+   - ONLY say "Thanks for your honesty" or "Good effort" and mention that a helpful explanation is coming up next. Keep it under 20 words.
+   - *Reason:* The system will display a separate Remediation card immediately after this, so your explanation would be repetitive.
+
+**CRITICAL LOGIC FOR FOLLOW-UP QUESTIONS:**
+- **Constraint:** If the student is simply answering the quiz question (even incorrectly), set 'follow_up_question' to "None".
+- **Prevention:** Do NOT infer a question. If they didn't ask, the value MUST be "None".
+
+**JSON Output Format:**
+{{
+  "scores": {{"correctness": <int>, "explanation": <int>, "bonus": <0 or 5>, "final": <int>}},
+  "signals": {{"correctness_explanation_gap": <bool>, "uncertainty_detected": <bool>, "persona": "<string>"}},
+  "evaluation_text": "<string starting with '**Scores: ...**'>",
+  "follow_up_question": "<string or 'None'>"
+}}
+""")
+
+BATCH_GRADER_TEMPLATE = _compact("""
+**Role:** {system_role}
+
+**Task:** Evaluate several students' answers against a Ground Truth definition. Grade each answer independently.
+
+**Context:**
+- Topic: "{concept}"
+- Ground Truth (Reference Material): "{ground_truth}"
+- Grading Mode: "{difficulty}"
+
+**Student Answers:**
+{answers}
+
+**Grading Instructions:**
+1. {leniency_instruction}
+2. **Correctness (0-50):** How factually accurate is the answer?
+3. **Explanation (0-50):** Did they use their own words?
+4. **Feedback:** Write a short, helpful evaluation for each answer. Start with the score.
+
+**JSON Output Format:** one entry per answer, with the same ids.
+{{
+  "results": [
+    {{
+      "id": <int>,
+      "scores": {{"correctness": <int>, "explanation": <int>, "bonus": <0 or 5>, "final": <int>}},
+      "signals": {{"correctness_explanation_gap": <bool>, "uncertainty_detected": <bool>, "persona": "<string>"}},
+      "evaluation_text": "<string starting with '**Scores: ...**'>"
+    }}
+  ]
+}}
+""")
+
+
+def _compile_per_difficulty(template):
+    compiled = {}
+    for difficulty in DIFFICULTIES:
+        system_role, leniency_instruction = difficulty_settings(difficulty)
+        compiled[difficulty] = CompiledTemplate(template, system_role=system_role,
+                                                leniency_instruction=leniency_instruction, difficulty=difficulty)
+    return compiled
+
+
+_GRADER = _compile_per_difficulty(GRADER_TEMPLATE)
+_BATCH_GRADER = _compile_per_difficulty(BATCH_GRADER_TEMPLATE)
+
+
+def _for_difficulty(compiled, template, difficulty):
+    if difficulty in compiled:
+        return compiled[difficulty]
+    # Unknown modes are graded like Normal but keep their name, as before
+    system_role, leniency_instruction = difficulty_settings(difficulty)
+    return CompiledTemplate(template, system_role=system_role, leniency_instruction=leniency_instruction, difficulty=difficulty)
+
+
+def grader_prompt(concept, ground_truth, user_answer, difficulty):
+    """The grading prompt for one answer, with answer and ground truth fitted to their budgets."""
+    return _for_difficulty(_GRADER, GRADER_TEMPLATE, difficulty).render(
+        concept=concept,
+        user_answer=fit_to_budget(user_answer, config.PROMPT_ANSWER_TOKENS, 'answer'),
+        ground_truth=fit_to_budget(ground_truth, config.PROMPT_GROUND_TRUTH_TOKENS, 'ground_truth'),
+    )
+
+
+def batch_grader_prompt(concept, ground_truth, answers, difficulty):
+    """One grading prompt for several answers to the same concept."""
+    numbered = "\n".join(
+        f'- id {i}: "{fit_to_budget(answer, config.PROMPT_ANSWER_TOKENS, "answer")}"' for i, answer in enumerate(answers)
+    )
+    return _for_difficulty(_BATCH_GRADER, BATCH_GRADER_TEMPLATE, difficulty).render(
+        concept=concept,
+        ground_truth=fit_to_budget(ground_truth, config.PROMPT_GROUND_TRUTH_TOKENS, 'ground_truth'),
+        answers=numbered,
+    )
+
+
+# --- Size Histograms ---
+# Estimated tokens per LLM call, by direction (prompt/response) and call
+# kind (grader = JSON calls, text = tutor calls, stream = streamed replies).
+
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, float('inf'))
+
+_sizes_lock = threading.Lock()
+_sizes = {}  # (direction, kind) -> [bucket counts, count, sum]
+
+
+def _observe_size(direction, kind, tokens):
+    with _sizes_lock:
+        entry = _sizes.get((direction, kind))
+        if entry is None:
+            entry = _sizes[(direction, kind)] = [[0] * len(SIZE_BUCKETS), 0, 0]
+        for i, bound in enumerate(SIZE_BUCKETS):
+            if tokens <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += 1
+        entry[2] += tokens
+
+
+def record_call(kind, prompt, response):
+    """Records the estimated sizes of one LLM call's prompt and response."""
+    _observe_size('prompt', kind, estimate_tokens(prompt))
+    _observe_size('response', kind, estimate_tokens(response or ""))
+
+
+def _prometheus_lines():
+    with _sizes_lock:
+        sizes = {key: (list(entry[0]), entry[1], entry[2]) for key, entry in _sizes.items()}
+    if not sizes:
+        return []
+    lines = [
+        "# HELP tutor_llm_tokens Estimated tokens per LLM call, by direction and kind.",
+        "# TYPE tutor_llm_tokens histogram",
+    ]
+    for (direction, kind), (buckets, count, total) in sorted(sizes.items()):
+        labels = f'direction="{direction}",kind="{kind}"'
+        cumulative = 0
+        for bound, bucket_count in zip(SIZE_BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f'tutor_llm_tokens_bucket{{{labels},le="{metrics.format_bound(bound)}"}} {cumulative}')
+        lines.append(f'tutor_llm_tokens_count{{{labels}}} {count}')
+        lines.append(f'tutor_llm_tokens_sum{{{labels}}} {total}')
+    return lines
+
+
+metrics.register_collector(_prometheus_lines)
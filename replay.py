@@ -0,0 +1,256 @@
+# replay.py: Re-grades logged answers to show how a grading change would move scores.
+#
+# Rows are streamed from tutor_log.csv and its rotated files one at a time,
+# so the log is never loaded whole. Each answer is graded again with the
+# current grading prompt and the chosen difficulty on a bounded number of
+# threads, and the new final score is compared with the logged "Final Score"
+# per concept. Results go to a SQLite file keyed by the exact grading
+# prompt and the settings that let answers skip the LLM (local_pregrade and
+# answer_cache): an interrupted run resumes without repeating calls, and
+# answers that appear many times in the log are graded once. Run it offline by
+# pointing GEMINI_API_BASE at benchmarks/mock_gemini.py.
+
+import hashlib
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import config
+import log_analytics
+from evaluator import build_evaluation_prompt, evaluate_answer
+from knowledge_base import get_lesson
+
+# Results are committed to the cache file every this many grades.
+COMMIT_EVERY = 200
+
+# Log columns used (see data_logger.LOG_HEADER)
+_QUESTION, _ANSWER, _FINAL = 2, 3, 6
+
+
+class ReplayCache:
+    """Final scores of re-graded answers in a SQLite file, keyed by grading prompt and settings."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, final INTEGER, scores TEXT)")
+        self._conn.commit()
+        self._uncommitted = 0
+
+    @staticmethod
+    def make_key(prompt, settings=""):
+        return hashlib.sha256(f"{settings}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self._conn.execute("SELECT final FROM results WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, final, scores):
+        self._conn.execute("INSERT OR REPLACE INTO results (key, final, scores) VALUES (?, ?, ?)",
+                           (key, final, json.dumps(scores)))
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+
+# --- Log Rows ---
+
+def iter_logged_answers(paths=None):
+    """Yields (concept, answer, logged final score or None) for every logged row, oldest first."""
+    for path in paths or log_analytics.log_files():
+        end = log_analytics.complete_size(path) if path == config.LOCAL_LOG_FILE else None
+        for row, _ in log_analytics.iter_log_rows(path, 0, end):
+            if len(row) <= _FINAL:
+                continue
+            yield row[_QUESTION], row[_ANSWER], _parse_score(row[_FINAL])
+
+
+def _parse_score(value):
+    try:
+        return int(float(value))
+    except ValueError:
+        return None
+
+
+# --- Deltas ---
+
+class ConceptDeltas:
+    """Per-concept sums of logged and re-graded final scores."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.concepts = {}
+
+    def add(self, concept, logged, regraded):
+        entry = self.concepts.get(concept)
+        if entry is None:
+            entry = self.concepts[concept] = {
+                "rows": 0, "logged_sum": 0, "replay_sum": 0, "abs_delta_sum": 0,
+                "higher": 0, "lower": 0, "newly_passing": 0, "newly_failing": 0,
+            }
+        delta = regraded - logged
+        entry["rows"] += 1
+        entry["logged_sum"] += logged
+        entry["replay_sum"] += regraded
+        entry["abs_delta_sum"] += abs(delta)
+        if delta > 0:
+            entry["higher"] += 1
+        elif delta < 0:
+            entry["lower"] += 1
+        was_passing, passes = logged >= self.threshold, regraded >= self.threshold
+        if passes and not was_passing:
+            entry["newly_passing"] += 1
+        elif was_passing and not passes:
+            entry["newly_failing"] += 1
+
+    @staticmethod
+    def summarize(entry):
+        rows = entry["rows"]
+        return {
+            "rows": rows,
+            "avg_logged": round(entry["logged_sum"] / rows, 2),
+            "avg_replayed": round(entry["replay_sum"] / rows, 2),
+            "mean_delta": round((entry["replay_sum"] - entry["logged_sum"]) / rows, 2),
+            "mean_abs_delta": round(entry["abs_delta_sum"] / rows, 2),
+            "higher": entry["higher"],
+            "lower": entry["lower"],
+            "newly_passing": entry["newly_passing"],
+            "newly_failing": entry["newly_failing"],
+        }
+
+    def report(self):
+        overall = {key: 0 for key in ("rows", "logged_sum", "replay_sum", "abs_delta_sum",
+                                      "higher", "lower", "newly_passing", "newly_failing")}
+        for entry in self.concepts.values():
+            for key in overall:
+                overall[key] += entry[key]
+        return {
+            "concepts": {concept: self.summarize(entry) for concept, entry in sorted(self.concepts.items())},
+            "overall": self.summarize(overall) if overall["rows"] else None,
+        }
+
+
+# --- Replay ---
+
+def _grading_settings():
+    """The settings besides the prompt that change how an answer is graded."""
+    return f"local_pregrade={config.PREGRADER_ENABLED};answer_cache={config.ANSWER_CACHE_ENABLED}"
+
+
+def _grade(concept, ground_truth, answer, difficulty):
+    evaluation = evaluate_answer(concept, ground_truth, answer, difficulty)
+    if evaluation.get("grading_failed") or "scores" not in evaluation:
+        return None
+    return evaluation["scores"]
+
+
+def replay_log(paths=None, difficulty=None, lesson_id=None, workers=None, cache_file=None, limit=None, progress=None):
+    """
+    Re-grades logged answers and returns a report of score changes per concept.
+
+    Args:
+        paths (list): Log files to read; defaults to the rotated logs and tutor_log.csv.
+        difficulty (str): Grading mode to replay with; defaults to config.GRADER_DIFFICULTY.
+        lesson_id (str): Lesson the logged concepts come from; defaults to the default lesson.
+        workers (int): Max concurrent grading calls; defaults to config.REPLAY_WORKERS.
+        cache_file (str): Result cache; defaults to config.REPLAY_CACHE_FILE.
+        limit (int): Stop after this many rows.
+        progress (callable): Called with the running counters every COMMIT_EVERY rows.
+
+    Answers whose grading fails are not cached, so running again retries them.
+    """
+    difficulty = difficulty or config.GRADER_DIFFICULTY
+    workers = workers or config.REPLAY_WORKERS
+    lesson = get_lesson(lesson_id)
+    if lesson is None:
+        raise ValueError(f"Unknown lesson: {lesson_id}")
+
+    cache = ReplayCache(cache_file or config.REPLAY_CACHE_FILE)
+    deltas = ConceptDeltas(config.REMEDIATION_THRESHOLD)
+    settings = _grading_settings()
+    counts = {"rows": 0, "graded": 0, "from_cache": 0, "failed": 0, "unknown_concept": 0, "no_logged_score": 0}
+    pending = {}  # cache key -> (future, concept, [logged scores of rows waiting for it])
+
+    def finish(futures):
+        for key in [key for key, (future, _, _) in pending.items() if future in futures]:
+            future, concept, logged_scores = pending.pop(key)
+            try:
+                scores = future.result()
+            except Exception as e:
+                print(f"Replay grading failed: {e}")
+                scores = None
+            if scores is None:
+                counts["failed"] += len(logged_scores)
+                continue
+            final = scores.get("final", 0)
+            cache.put(key, final, scores)
+            counts["graded"] += 1
+            for logged in logged_scores:
+                deltas.add(concept, logged, final)
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='replay') as pool:
+            for concept, answer, logged in iter_logged_answers(paths):
+                if limit is not None and counts["rows"] >= limit:
+                    break
+                counts["rows"] += 1
+                if progress and counts["rows"] % COMMIT_EVERY == 0:
+                    progress(dict(counts))
+                if logged is None:
+                    counts["no_logged_score"] += 1
+                    continue
+                index = lesson.concept_index.get(concept.lower())
+                if index is None:
+                    counts["unknown_concept"] += 1
+                    continue
+                ground_truth = lesson.items[index]["description"]
+
+                key = cache.make_key(build_evaluation_prompt(concept, ground_truth, answer, difficulty), settings)
+                if key in pending:
+                    pending[key][2].append(logged)
+                    continue
+                final = cache.get(key)
+                if final is not None:
+                    counts["from_cache"] += 1
+                    deltas.add(concept, logged, final)
+                    continue
+                pending[key] = (pool.submit(_grade, concept, ground_truth, answer, difficulty), concept, [logged])
+
+                # Keep a bounded number of rows in flight, however long the log is
+                if len(pending) >= workers * 2:
+                    done, _ = wait([future for future, _, _ in pending.values()], return_when=FIRST_COMPLETED)
+                    finish(done)
+            finish({future for future, _, _ in pending.values()})
+    finally:
+        cache.close()
+
+    report = deltas.report()
+    report.update({"difficulty": difficulty, "threshold": deltas.threshold, "counts": counts})
+    return report
+
+
+def format_report(report):
+    """Renders a replay report as a plain-text table, largest average shift first."""
+    lines = [
+        f"Replayed with difficulty {report['difficulty']} (passing score {report['threshold']}).",
+        "Rows: " + ", ".join(f"{name} {count}" for name, count in report["counts"].items()),
+        "",
+        f"{'Concept':<40} {'Rows':>6} {'Logged':>7} {'Replay':>7} {'Delta':>7} {'|Delta|':>7} {'+Pass':>6} {'-Pass':>6}",
+    ]
+    concepts = sorted(report["concepts"].items(), key=lambda item: -abs(item[1]["mean_delta"]))
+    if report["overall"]:
+        concepts.append(("(all)", report["overall"]))
+    for concept, entry in concepts:
+        lines.append(
+            f"{concept[:40]:<40} {entry['rows']:>6} {entry['avg_logged']:>7} {entry['avg_replayed']:>7} "
+            f"{entry['mean_delta']:>+7} {entry['mean_abs_delta']:>7} {entry['newly_passing']:>6} {entry['newly_failing']:>6}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,487 @@
+# session_store.py: Pluggable storage for quiz session state.
+#
+# Backends:
+#   memory - per-process dict with TTL and LRU eviction (single worker only)
+#   sqlite - one WAL-mode SQLite file shared by every worker on a machine
+#   redis  - any server speaking the Redis protocol, shared across machines
+#
+# A session is a QuizSession: a handful of numbers that point into the
+# lesson rather than copies of its text, so a worker holding thousands of
+# sessions stays small. A reaper thread drops idle sessions even when no
+# new ones arrive to push them out.
+
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+import config
+import metrics
+from knowledge_base import get_lesson, lesson_concepts, new_question_seed, next_question, question_at
+
+metrics.describe('tutor_sessions_reaped_total', "Idle sessions removed by the session reaper.")
+
+
+class QuizSession:
+    """
+    One student's progress through a lesson.
+
+    The question order is fixed by seed, position is how far into that order
+    the session has got, asked is a bitset of the question indices already
+    served, and current is the index of the question being answered (-1
+    when there is none). Concept and ground truth are looked up
+    in the lesson when needed. Indices are only valid for the lesson
+    version they were stored with: after a reload changes the lesson's
+    questions, they are remapped by concept name before any is used, and a
+    current question the reload removed becomes REMOVED.
+    """
+
+    # current when a lesson reload removed the question being answered
+    REMOVED = -2
+
+    __slots__ = ('lesson_id', 'seed', 'asked', 'current', 'attempts', 'started', 'version', 'concept_key', 'position')
+
+    def __init__(self, lesson_id=None, seed=0, asked=0, current=-1, attempts=0, started=0.0, version=None, concept_key=None,
+                 position=0):
+        # Lesson ids and concept keys repeat across sessions; share one string per value
+        self.lesson_id = sys.intern(lesson_id) if lesson_id else None
+        self.seed = seed
+        self.asked = asked
+        self.current = current
+        self.attempts = attempts
+        self.started = started
+        self.version = version
+        self.concept_key = sys.intern(concept_key) if concept_key else None
+        self.position = position
+
+    @classmethod
+    def new(cls, lesson_id):
+        lesson = get_lesson(lesson_id)
+        return cls(lesson_id, new_question_seed(), version=lesson.version if lesson else None)
+
+    def lesson(self):
+        """Returns the session's Lesson, first remapping the stored indices if it changed since they were stored."""
+        lesson = get_lesson(self.lesson_id)
+        if lesson is not None and lesson.version != self.version:
+            self._remap(lesson)
+        return lesson
+
+    def _remap(self, lesson):
+        if self.version is None:
+            # Stored before sessions recorded the lesson version; the indices are all there is
+            self.version = lesson.version
+            if self.current >= 0 and self.concept_key is None:
+                self.concept_key = sys.intern(lesson.keys[self.current]) if self.current < len(lesson.keys) else None
+            return
+
+        # Questions asked under the old version, by name. A worker that never
+        # loaded that version can't tell, and only keeps the current question.
+        asked = 0
+        for old_index, key in enumerate(lesson_concepts(self.lesson_id, self.version) or ()):
+            if self.asked >> old_index & 1:
+                new_index = lesson.concept_index.get(key)
+                if new_index is not None:
+                    asked |= 1 << new_index
+        if self.current >= 0:
+            current = lesson.concept_index.get(self.concept_key)
+            if current is None:
+                print(f"Lesson '{lesson.lesson_id}' was reloaded without the question '{self.concept_key}'; ending it.")
+                self.current, self.concept_key = self.REMOVED, None
+            else:
+                self.current = current
+                asked |= 1 << current
+        self.asked = asked
+        self.version = lesson.version
+        self.position = 0  # The order depends on the question count; skip the asked ones once
+
+    def question(self):
+        """Returns (concept, description) of the current question, or (None, None)."""
+        lesson = self.lesson()  # May remap self.current
+        return question_at(self.current, lesson)
+
+    @property
+    def concept(self):
+        return self.question()[0]
+
+    @property
+    def ground_truth(self):
+        return self.question()[1]
+
+    @property
+    def question_removed(self):
+        """True if a lesson reload removed the question the student was answering."""
+        self.lesson()
+        return self.current == self.REMOVED
+
+    def next_question(self):
+        """Returns (concept, description, index) of the question after the current one."""
+        lesson = self.lesson()  # May remap self.asked
+        # Moving the cursor past questions already asked never changes the answer
+        concept, description, index, self.position = next_question(self.seed, self.asked, lesson, self.position)
+        return concept, description, index
+
+    def ask(self, index, concept):
+        """
+        Makes a question the current one and starts its timer. index comes
+        from next_question(); if the lesson was reloaded since, the question
+        is found again by its concept name.
+        """
+        lesson = self.lesson()
+        key = concept.lower()
+        if lesson is not None and question_at(index, lesson)[0] != concept:
+            index = lesson.concept_index.get(key, self.REMOVED)
+        if index < 0:
+            self.current, self.concept_key = self.REMOVED, None
+            return
+        self.current = index
+        self.concept_key = sys.intern(key)
+        self.asked |= 1 << index
+        self.attempts = 1
+        self.started = time.time()
+
+    def finish(self):
+        """Marks the quiz as complete."""
+        self.current = -1
+        self.concept_key = None
+
+    def approx_size(self):
+        """Approximate bytes held by this record (the shared lesson id and concept key are not counted)."""
+        return (sys.getsizeof(self) + sys.getsizeof(self.seed) + sys.getsizeof(self.asked)
+                + sys.getsizeof(self.started) + sys.getsizeof(self.version) + sys.getsizeof(self.position))
+
+
+# Short keys keep serialized records small; see serialize_session().
+_FIELD_KEYS = {
+    'lesson_id': 'l',
+    'seed': 's',
+    'asked': 'a',
+    'current': 'c',
+    'attempts': 'n',
+    'started': 't',
+    'version': 'v',
+    'concept_key': 'k',
+    'position': 'p',
+}
+
+
+def serialize_session(session):
+    """Encodes a QuizSession as compact JSON bytes."""
+    record = {short: getattr(session, field) for field, short in _FIELD_KEYS.items()}
+    return json.dumps(record, separators=(',', ':')).encode('utf-8')
+
+
+def deserialize_session(raw):
+    """Decodes bytes produced by serialize_session back into a QuizSession."""
+    record = json.loads(raw)
+    if 's' not in record:
+        # Stored by a version that copied the question text; treat it as expired.
+        return None
+    return QuizSession(**{field: record[short] for field, short in _FIELD_KEYS.items() if short in record})
+
+
+class SessionStore:
+    """Interface shared by all session backends."""
+
+    # Seconds between reaper runs; 0 = only expire sessions while saving
+    reap_interval = 0
+    _reaper_pid = None
+    _reaper_lock = threading.Lock()
+
+    def get(self, session_id):
+        """Returns the QuizSession, or None if it is unknown or expired."""
+        raise NotImplementedError
+
+    def save(self, session_id, data):
+        """Stores (or replaces) a session and refreshes its TTL."""
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """Removes a session if it exists."""
+        raise NotImplementedError
+
+    def __len__(self):
+        """Number of live sessions (approximate for shared backends)."""
+        raise NotImplementedError
+
+    def approx_bytes(self):
+        """Approximate bytes used by live sessions, or None if the backend can't tell."""
+        return None
+
+    def reap(self):
+        """Removes expired sessions; returns how many were removed."""
+        return 0
+
+    def _start_reaper(self):
+        # Threads do not survive a fork, so each worker process starts its own.
+        if self.reap_interval <= 0 or self._reaper_pid == os.getpid():
+            return
+        with self._reaper_lock:
+            if self._reaper_pid == os.getpid():
+                return
+            self._reaper_pid = os.getpid()
+        threading.Thread(target=self._reap_forever, name='session-reaper', daemon=True).start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(self.reap_interval)
+            try:
+                removed = self.reap()
+            except Exception as e:
+                print(f"Session reaper failed: {e}")
+                continue
+            if removed:
+                metrics.inc('tutor_sessions_reaped_total', removed)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process store with idle TTL and LRU eviction.
+
+    Sessions are kept in access order, so both expired and least recently
+    used entries are always at the front and eviction is O(1).
+    """
+
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session_id -> (last_access, data)
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        evicted = 0
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if now - last_access < self.ttl and len(self._sessions) <= self.max_sessions:
+                break
+            del self._sessions[session_id]
+            evicted += 1
+        return evicted
+
+    def get(self, session_id):
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            if now - entry[0] >= self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = (now, entry[1])
+            self._sessions.move_to_end(session_id)
+            return entry[1]
+
+    def save(self, session_id, data):
+        self._start_reaper()
+        now = time.time()
+        with self._lock:
+            self._sessions[session_id] = (now, data)
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def reap(self):
+        with self._lock:
+            return self._evict(time.time())
+
+    def approx_bytes(self):
+        # Per entry: the id string, the (last access, session) tuple and its
+        # float, and the record itself; plus the dict's own table.
+        entry_overhead = sys.getsizeof((0.0, None)) + sys.getsizeof(0.0)
+        with self._lock:
+            total = sys.getsizeof(self._sessions)
+            for session_id, (_, session) in self._sessions.items():
+                total += sys.getsizeof(session_id) + entry_overhead + session.approx_size()
+        return total
+
+
+class SQLiteSessionStore(SessionStore):
+    """Stores sessions in a SQLite file in WAL mode, so all local workers see them."""
+
+    # Expired rows are purged once every this many saves.
+    PURGE_EVERY = 200
+
+    def __init__(self, db_path, ttl):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def _connection(self):
+        # SQLite connections must not cross a fork, so reconnect per process.
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            conn = sqlite3.connect(self.db_path, timeout=10, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, data BLOB, updated REAL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+            conn.commit()
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def get(self, session_id):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT data, updated FROM sessions WHERE id = ?", (session_id,)
+            ).fetchone()
+        if row is None or time.time() - row[1] >= self.ttl:
+            return None
+        return deserialize_session(row[0])
+
+    def save(self, session_id, data):
+        self._start_reaper()
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, updated) VALUES (?, ?, ?)",
+                (session_id, serialize_session(data), now)
+            )
+            self._saves += 1
+            if self._saves % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM sessions WHERE updated < ?", (now - self.ttl,))
+            conn.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+            conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT COUNT(*) FROM sessions WHERE updated >= ?", (time.time() - self.ttl,)
+            ).fetchone()
+        return row[0]
+
+    def reap(self):
+        with self._lock:
+            conn = self._connection()
+            removed = conn.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - self.ttl,)).rowcount
+            conn.commit()
+        return removed
+
+    def approx_bytes(self):
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT SUM(LENGTH(id) + LENGTH(data)) FROM sessions WHERE updated >= ?", (time.time() - self.ttl,)
+            ).fetchone()
+        return row[0] or 0
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Stores sessions in any server that speaks the Redis protocol (RESP).
+
+    Talks to the server over a plain socket, one connection per thread, so
+    no client library is needed. Expiry is handled by the server (SET ... EX).
+    """
+
+    def __init__(self, url, ttl, prefix='tutor:session:'):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.ttl = int(ttl)
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        self._local.sock = sock
+        self._local.reader = sock.makefile('rb')
+        self._local.pid = os.getpid()
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def _send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+        self._local.sock.sendall(b''.join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("Session store connection closed.")
+        kind, body = line[:1], line[1:-2]
+        if kind == b'+':
+            return body.decode('utf-8')
+        if kind == b'-':
+            raise RuntimeError(f"Session store error: {body.decode('utf-8')}")
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            length = int(body)
+            if length < 0:
+                return None
+            return self._local.reader.read(length + 2)[:-2]
+        if kind == b'*':
+            return [self._read_reply() for _ in range(int(body))]
+        raise RuntimeError(f"Unexpected session store reply: {line!r}")
+
+    def _command(self, *args):
+        # Reconnect once if the connection is missing, stale, or was inherited from a fork.
+        for attempt in range(2):
+            try:
+                if getattr(self._local, 'pid', None) != os.getpid():
+                    self._connect()
+                return self._send(*args)
+            except (OSError, ConnectionError):
+                self._local.pid = None
+                if attempt:
+                    raise
+
+    def get(self, session_id):
+        raw = self._command('GET', self.prefix + session_id)
+        return deserialize_session(raw) if raw is not None else None
+
+    def save(self, session_id, data):
+        self._command('SET', self.prefix + session_id, serialize_session(data), 'EX', self.ttl)
+
+    def delete(self, session_id):
+        self._command('DEL', self.prefix + session_id)
+
+    def __len__(self):
+        # DBSIZE counts every key in the database, which is close enough for
+        # a dedicated session database.
+        return self._command('DBSIZE')
+
+
+def create_session_store():
+    """Builds the backend selected by [Sessions] backend in settings.ini."""
+    backend = config.SESSION_BACKEND
+    if backend == 'sqlite':
+        store = SQLiteSessionStore(config.SESSION_SQLITE_FILE, config.SESSION_TTL)
+    elif backend == 'redis':
+        # The server expires keys itself, so there is nothing to reap
+        return RedisSessionStore(config.SESSION_REDIS_URL, config.SESSION_TTL)
+    else:
+        if backend != 'memory':
+            print(f"Warning: unknown session backend '{backend}'. Using memory.")
+        store = MemorySessionStore(config.SESSION_TTL, config.SESSION_MAX_SESSIONS)
+    store.reap_interval = config.SESSION_REAP_INTERVAL
+    return store
@@ -1,23 +1,51 @@
 # tutor.py: Generates helpful hints, remediation, and other tutor-like responses.
 
-from evaluator import get_llm_response
+from concurrent.futures import ThreadPoolExecutor
+from evaluator import get_llm_response, get_llm_response_async, stream_llm_response, stream_llm_response_async
+from llm_cache import cached_call, cached_call_async, cached_stream, cached_stream_async
+import metrics
+import prefetch
 
+def _remediation_prompt(concept, ground_truth):
+    return f"You are a friendly and encouraging tutor. A student is struggling to understand '{concept}'. Please provide a simple, clear explanation of this concept based on the following information: '{ground_truth}'. Start with a friendly phrase like 'No worries!' or 'Let's break that down.' and keep it concise."
+
+def _follow_up_prompt(concept, user_question):
+    return f"You are a helpful AI Tutor. A student asked a follow-up question about '{concept}'. Their question is: '{user_question}'. Please provide a clear and concise answer to their question."
+
+@prefetch.prefetchable
+@metrics.timed('tutor.generate_remediation')
 def generate_remediation(concept, ground_truth):
     """Generates a simple explanation for a concept the user struggled with."""
-    prompt = f"You are a friendly and encouraging tutor. A student is struggling to understand '{concept}'. Please provide a simple, clear explanation of this concept based on the following information: '{ground_truth}'. Start with a friendly phrase like 'No worries!' or 'Let's break that down.' and keep it concise."
-    return get_llm_response(prompt)
+    prompt = _remediation_prompt(concept, ground_truth)
+    # Only depends on lesson content, so it is served from the cache when possible
+    return cached_call('remediation', prompt, (concept, ground_truth), lambda: get_llm_response(prompt))
 
+@metrics.timed('tutor.answer_follow_up')
 def answer_follow_up(concept, user_question):
     """Answers a follow-up question asked by the user."""
-    prompt = f"You are a helpful AI Tutor. A student asked a follow-up question about '{concept}'. Their question is: '{user_question}'. Please provide a clear and concise answer to their question."
+    prompt = _follow_up_prompt(concept, user_question)
     return get_llm_response(prompt)
 
+def stream_remediation(concept, ground_truth):
+    """Streaming version of generate_remediation; yields text chunks."""
+    prompt = _remediation_prompt(concept, ground_truth)
+    return cached_stream('remediation', prompt, (concept, ground_truth), lambda: stream_llm_response(prompt))
+
+def stream_follow_up(concept, user_question):
+    """Streaming version of answer_follow_up; yields text chunks."""
+    return stream_llm_response(_follow_up_prompt(concept, user_question))
+
+def _hint_prompt(concept):
+    # We ask for a "fun analogy" to make it kid-friendly
+    return f"Write a very short, fun hint (under 15 words) for a middle schooler about the concept: '{concept}'. Do NOT give away the definition. Just give a clue or analogy."
+
+@metrics.timed('tutor.generate_hint')
 def generate_hint(concept):
     """Generates a subtle hint for the student (used in Easy Mode)."""
-    # We ask for a "fun analogy" to make it kid-friendly
-    prompt = f"Write a very short, fun hint (under 15 words) for a middle schooler about the concept: '{concept}'. Do NOT give away the definition. Just give a clue or analogy."
-    return get_llm_response(prompt)
+    prompt = _hint_prompt(concept)
+    return cached_call('hint', prompt, (concept,), lambda: get_llm_response(prompt))
 
+@metrics.timed('tutor.generate_fallout_message')
 def generate_fallout_message(concept, time_exceeded, attempts_exceeded):
     """Creates a message for when the fallout handler is triggered."""
     reason = ""
@@ -29,3 +57,53 @@ def generate_fallout_message(concept, time_exceeded, attempts_exceeded):
     message = f"That was a tricky one! No problem, let's move on for now since {reason} We can always come back to the topic of '{concept}' later."
     return message
 
+
+# --- Async Variants (asgi_app.py) ---
+
+@metrics.timed('tutor.generate_remediation')
+async def generate_remediation_async(concept, ground_truth):
+    """Async version of generate_remediation."""
+    prefetched, text = await prefetch.take_async(generate_remediation, (concept, ground_truth))
+    if prefetched:
+        return text
+    prompt = _remediation_prompt(concept, ground_truth)
+    return await cached_call_async('remediation', prompt, (concept, ground_truth), lambda: get_llm_response_async(prompt))
+
+@metrics.timed('tutor.answer_follow_up')
+async def answer_follow_up_async(concept, user_question):
+    """Async version of answer_follow_up."""
+    return await get_llm_response_async(_follow_up_prompt(concept, user_question))
+
+@metrics.timed('tutor.generate_hint')
+async def generate_hint_async(concept):
+    """Async version of generate_hint."""
+    prompt = _hint_prompt(concept)
+    return await cached_call_async('hint', prompt, (concept,), lambda: get_llm_response_async(prompt))
+
+def stream_remediation_async(concept, ground_truth):
+    """Async version of stream_remediation; an async iterator of text chunks."""
+    prompt = _remediation_prompt(concept, ground_truth)
+    return cached_stream_async('remediation', prompt, (concept, ground_truth), lambda: stream_llm_response_async(prompt))
+
+def stream_follow_up_async(concept, user_question):
+    """Async version of stream_follow_up; an async iterator of text chunks."""
+    return stream_llm_response_async(_follow_up_prompt(concept, user_question))
+
+
+def warm_cache(knowledge_base, workers=4):
+    """
+    Pre-generates the hint and remediation for every topic in a knowledge base.
+
+    Args:
+        knowledge_base (list): Parsed topics, as returned by load_and_parse_kb.
+        workers (int): How many LLM calls to run at once.
+
+    Returns the number of topics processed.
+    """
+    def warm(item):
+        generate_hint(item["concept"])
+        generate_remediation(item["concept"], item["description"])
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(warm, knowledge_base))
+    return len(knowledge_base)